@@ -9,6 +9,7 @@
 #include "ESPAsyncWebServer.h"
 #include <Adafruit_Sensor.h>
 #include <DHT.h>
+#include <time.h>
 
 // Replace with your network credentials
 const char* ssid = "Galaxy A52s 5G7F2E";
@@ -22,6 +23,17 @@ int ledState = LOW;                   // the current state of the output pin
 #define BUTTON_INPUT        35        // Pin for button input
 #define LED_OUTPUT          25        // Pin for LED Output
 
+// Buffered readings served in binary on /readings (see pythonNASA/wire_format.py)
+#define SAMPLE_INTERVAL_MS  10000     // How often loop() takes a sample
+#define READINGS_CAPACITY   64        // Samples kept; the oldest is overwritten
+#define PACKET_VERSION      1
+#define CLOCK_UPTIME        1         // Packet flag: times are seconds since boot
+#define HEADER_SIZE         16
+#define RECORD_SIZE         14
+#define MISSING_I16         -32768    // Sensor could not be read
+#define MISSING_U16         65535
+#define READINGS_TYPE       "application/x-aquiferst-readings"
+
 
 /*DECLARATIONS*/
 DHT dht(DHTPIN, DHTTYPE);
@@ -29,6 +41,22 @@ DHT dht(DHTPIN, DHTTYPE);
 // Create AsyncWebServer object on port 80
 AsyncWebServer server(80);
 
+// One buffered sample, values in hundredths
+struct Sample {
+  uint32_t seq;
+  uint32_t uptime;                    // Seconds since boot when it was taken
+  int16_t temperature;
+  uint16_t humidity;
+  uint16_t moisture;
+};
+
+Sample samples[READINGS_CAPACITY];
+int sampleCount = 0;                  // Samples held, up to READINGS_CAPACITY
+int sampleNext = 0;                   // Slot the next sample goes in
+uint32_t nextSeq = 1;
+unsigned long lastSampleMs = 0;
+portMUX_TYPE samplesLock = portMUX_INITIALIZER_UNLOCKED;  // loop() writes, the web server reads
+
 String readDHTTemperature() {
   // Sensor readings may also be up to 2 seconds 'old' (its a very slow sensor)
   // Read temperature as Celsius (the default)
@@ -47,19 +75,23 @@ String readDHTTemperature() {
 }
 
   
-// Define moisture return function
-String readMoisture(void) {
+// Read the moisture sensor as a percentage
+int readMoisturePercent(void) {
   int moistureValue = analogRead(MOISTURE_LEVEL_PIN);
   int moisturePercent = map(moistureValue, 800, 3500, 0, 100);
   if (moisturePercent > 100) moisturePercent = 100;
   if (moisturePercent < 0) moisturePercent = 0;
-  
+
   Serial.print("Raw Moisture Value: ");
   Serial.print(moistureValue);
   Serial.print(" -> Moisture Percent: ");
   Serial.println(moisturePercent);
+  return moisturePercent;
+}
 
-  String moisturePercentStr = String(moisturePercent);
+// Define moisture return function
+String readMoisture(void) {
+  String moisturePercentStr = String(readMoisturePercent());
   return moisturePercentStr;
 }
 
@@ -76,6 +108,81 @@ String readDHTHumidity() {
   }
 }
 
+// Scale a reading to hundredths, clamped to the field, or the missing value
+int32_t toFixed(float value, int32_t low, int32_t high, int32_t missing) {
+  if (isnan(value)) return missing;
+  int32_t fixed = lroundf(value * 100.0f);
+  if (fixed < low) return low;
+  if (fixed > high) return high;
+  return fixed;
+}
+
+// Read every sensor into the ring buffer, overwriting the oldest sample
+void takeSample() {
+  Sample sample;
+  sample.uptime = millis() / 1000;
+  sample.temperature = toFixed(dht.readTemperature(), -32767, 32767, MISSING_I16);
+  sample.humidity = toFixed(dht.readHumidity(), 0, 65534, MISSING_U16);
+  sample.moisture = toFixed(readMoisturePercent(), 0, 65534, MISSING_U16);
+
+  portENTER_CRITICAL(&samplesLock);
+  sample.seq = nextSeq++;
+  samples[sampleNext] = sample;
+  sampleNext = (sampleNext + 1) % READINGS_CAPACITY;
+  if (sampleCount < READINGS_CAPACITY) sampleCount++;
+  portEXIT_CRITICAL(&samplesLock);
+}
+
+// Little-endian field writers for the packet
+void putU16(uint8_t *out, uint16_t value) {
+  out[0] = value & 0xFF;
+  out[1] = value >> 8;
+}
+
+void putU32(uint8_t *out, uint32_t value) {
+  putU16(out, value & 0xFFFF);
+  putU16(out + 2, value >> 16);
+}
+
+// Build the packet of every sample newer than `since` into `out`; returns
+// its length. A `since` ahead of the newest sample means the server saw an
+// earlier boot, so everything buffered is sent.
+size_t buildPacket(uint8_t *out, uint32_t since) {
+  Sample copy[READINGS_CAPACITY];
+  int count = 0;
+  portENTER_CRITICAL(&samplesLock);
+  if (since >= nextSeq) since = 0;
+  for (int i = 0; i < sampleCount; i++) {
+    const Sample &sample = samples[(sampleNext - sampleCount + i + READINGS_CAPACITY) % READINGS_CAPACITY];
+    if (sample.seq > since) copy[count++] = sample;
+  }
+  portEXIT_CRITICAL(&samplesLock);
+
+  // Unix time once NTP has synced, otherwise seconds since boot
+  uint32_t uptime = millis() / 1000;
+  time_t now = time(nullptr);
+  bool synced = now > 1600000000;
+  uint32_t nodeId = (uint32_t)(ESP.getEfuseMac() >> 16);  // Device-specific MAC bytes
+
+  out[0] = 'A';
+  out[1] = 'Q';
+  out[2] = PACKET_VERSION;
+  out[3] = synced ? 0 : CLOCK_UPTIME;
+  putU32(out + 4, nodeId);
+  putU32(out + 8, synced ? (uint32_t)now : uptime);
+  putU16(out + 12, count);
+  putU16(out + 14, RECORD_SIZE);
+  uint8_t *record = out + HEADER_SIZE;
+  for (int i = 0; i < count; i++, record += RECORD_SIZE) {
+    putU32(record, copy[i].seq);
+    putU32(record + 4, synced ? (uint32_t)now - (uptime - copy[i].uptime) : copy[i].uptime);
+    putU16(record + 8, (uint16_t)copy[i].temperature);
+    putU16(record + 10, copy[i].humidity);
+    putU16(record + 12, copy[i].moisture);
+  }
+  return HEADER_SIZE + count * RECORD_SIZE;
+}
+
 const char index_html[] PROGMEM = R"rawliteral(
 <!DOCTYPE HTML><html>
 <head>
@@ -260,6 +367,11 @@ void setup(){
   // Print ESP32 Local IP Address
   Serial.println(WiFi.localIP());
 
+  // Sample times are Unix time once this syncs
+  configTime(0, 0, "pool.ntp.org");
+  takeSample();
+  lastSampleMs = millis();
+
   // Route for root / web page
   server.on("/", HTTP_GET, [](AsyncWebServerRequest *request){
     request->send_P(200, "text/html", index_html, processor);
@@ -273,6 +385,20 @@ void setup(){
   server.on("/humidity", HTTP_GET, [](AsyncWebServerRequest *request){
     request->send_P(200, "text/plain", readDHTHumidity().c_str());
   });
+
+  // Every buffered sample newer than ?since=<seq> in one binary packet,
+  // instead of one text request per sensor
+  server.on("/readings", HTTP_GET, [](AsyncWebServerRequest *request){
+    uint32_t since = 0;
+    if (request->hasParam("since")) {
+      since = strtoul(request->getParam("since")->value().c_str(), nullptr, 10);
+    }
+    static uint8_t packet[HEADER_SIZE + READINGS_CAPACITY * RECORD_SIZE];
+    size_t length = buildPacket(packet, since);
+    AsyncResponseStream *response = request->beginResponseStream(READINGS_TYPE, length);
+    response->write(packet, length);
+    request->send(response);
+  });
   
   // Send a GET request to <ESP_IP>/update?state=<inputMessage>
   server.on("/update", HTTP_GET, [] (AsyncWebServerRequest *request) {
@@ -304,6 +430,10 @@ void setup(){
  
 void loop(){
   digitalWrite(LED_OUTPUT, ledState);
+  if (millis() - lastSampleMs >= SAMPLE_INTERVAL_MS) {
+    lastSampleMs = millis();
+    takeSample();
+  }
   // // Wait a few seconds between measurements.
   // delay(2000);
 
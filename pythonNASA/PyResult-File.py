@@ -1,5 +1,6 @@
 import logging
-from bs4 import BeautifulSoup
+from sensor_page import parse_sensor_page
+from soil_health import flatten_sensor_data
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -8,23 +9,6 @@ logger = logging.getLogger(__name__)
 # File path of your local HTML file that contains the sensor readings
 file_path = r'C:\Users\miaaz\Downloads\please.html'  # Use a raw string to handle backslashes
 
-def get_float_from_text(soup, sensor_name):
-    p_tags = soup.find_all('p')
-    for p in p_tags:
-        text = p.get_text(strip=True)
-        if sensor_name in text:
-            # Extract the value after '='
-            parts = text.split('=')
-            if len(parts) == 2:
-                value_str = parts[1].strip()
-                try:
-                    return float(value_str)
-                except ValueError:
-                    logger.warning(f"Value for '{sensor_name}' is not a valid float.")
-                    return None
-    logger.warning(f"Sensor '{sensor_name}' not found in the HTML.")
-    return None
-
 def fetch_sensor_data(file_path):
     try:
         with open(file_path, 'r', encoding='utf-8') as f:
@@ -33,31 +17,12 @@ def fetch_sensor_data(file_path):
         logger.error(f"Error reading file {file_path}: {e}")
         exit(1)
     
-    soup = BeautifulSoup(html_content, 'html.parser')
-    
-    # Extract sensor readings using the updated function
-    nitrogen = get_float_from_text(soup, 'Nitrogen')
-    phosphorus = get_float_from_text(soup, 'Phosphorus')
-    potassium = get_float_from_text(soup, 'Potassium')
-    humidity = get_float_from_text(soup, 'Humidity')
-    temperature = get_float_from_text(soup, 'Temperature')
-    soil_moisture = get_float_from_text(soup, 'Soil Moisture')  # Note the space
+    # Extract all sensor readings in a single pass over the page
+    sensor_data = parse_sensor_page(html_content)
 
-    sensor_values = [nitrogen, phosphorus, potassium, humidity, temperature, soil_moisture]
-    if any(value is None for value in sensor_values):
+    if any(value is None for value in flatten_sensor_data(sensor_data)):
         logger.error("One or more sensor values are missing or invalid.")
         exit(1)
-    
-    sensor_data = {
-        'NPK_levels': {
-            'Nitrogen': nitrogen,
-            'Phosphorus': phosphorus,
-            'Potassium': potassium
-        },
-        'Humidity': humidity,
-        'Temperature': temperature,
-        'Soil_Moisture': soil_moisture
-    }
     return sensor_data
 
 ideal_thresholds = {
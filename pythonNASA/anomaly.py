@@ -0,0 +1,493 @@
+import argparse
+import time
+
+import numpy as np
+
+from metrics import anomalies
+from soil_health import flatten_sensor_data, ideal_thresholds, sensor_columns, unflatten_sensor_data
+
+# Streaming sensor-fault detection, ahead of scoring.
+#
+# A stuck DHT11 or a shorted moisture probe reports numbers that look like
+# readings; scored as-is they turn into confident advice. The detector checks
+# every value of every reading against the node's recent history and its
+# neighbours, with the same fixed amount of state per node (a ring of the
+# last `window` accepted values per sensor, about half a kilobyte):
+#
+#   range     - outside what the sensor can report (sensor_limits), or more
+#               than `implausible_widths` band widths outside the ideal band
+#               (a Nitrogen of 553 against a 40-60 band: one digit too many)
+#   spike     - further from the median of the node's window than `spike_k`
+#               robust standard deviations (1.4826 x MAD), and at least a
+#               quarter of a band width, once the window holds `min_history`
+#               values. After `shift_after` spikes in a row the new level
+#               is accepted: irrigation does move moisture for real.
+#   flatline  - the same value repeated `flatline_factor` times longer than
+#               the sensor's usual runs of equal values (a running average),
+#               and at least `flatline_after` times. A sensor that has never
+#               changed has no usual run and is not flagged: constant
+#               placeholders such as the NPK values of ESP32 probes. Only
+#               `flatline_columns` are checked; by default not the NPK
+#               probes, whose whole-mg/kg readings legitimately sit on one
+#               value for hours.
+#   neighbour - further from the median of the latest values of the other
+#               nodes in its group than `neighbour_k` robust standard
+#               deviations and at least a band width; only in groups with
+#               `min_neighbours` other reporting nodes. Group statistics are
+#               refreshed every `neighbour_refresh` seconds.
+#
+# In 'quarantine' mode flagged values are replaced by NaN (None in sensor_data
+# dicts), which every scorer treats as a missing sensor: scored 0, no advice.
+# In 'flag' mode they are reported but scored as they are. Flagged values
+# never enter the node's window, so a fault does not become the baseline.
+#
+# check_batch works on the (n, 6) arrays of the ingest path, a batch at a
+# time; check does one sensor_data dict, for the page and probe paths.
+
+RANGE, SPIKE, FLATLINE, NEIGHBOUR = 1, 2, 4, 8
+checks = {RANGE: 'range', SPIKE: 'spike', FLATLINE: 'flatline', NEIGHBOUR: 'neighbour'}
+
+# What the sensors can report at all, in sensor_columns order: RS485 NPK
+# probes (mg/kg), DHT11 humidity and temperature, capacitive moisture (%)
+sensor_limits = np.array([(0.0, 1999.0), (0.0, 1999.0), (0.0, 1999.0),
+                          (0.0, 100.0), (-40.0, 80.0), (0.0, 100.0)])
+
+mad_scale = 1.4826  # MAD of a normal distribution -> standard deviation
+
+
+# Function to describe a row of flags: {column name: [check names]}
+def describe_flags(flags):
+    found = {}
+    for (group, name), flag in zip(sensor_columns, flags):
+        if flag:
+            found[name] = [label for bit, label in checks.items() if flag & bit]
+    return found
+
+
+class AnomalyDetector:
+    # `groups` maps node id -> neighbour group (zone, field); nodes without
+    # one are not cross-checked
+    def __init__(self, thresholds=ideal_thresholds, mode='quarantine', groups=None, window=16, min_history=8,
+                 spike_k=6.0, shift_after=4, flatline_after=30, flatline_factor=10.0,
+                 flatline_columns=('Humidity', 'Temperature', 'Soil_Moisture'), implausible_widths=8.0, neighbour_k=4.0,
+                 min_neighbours=3, neighbour_refresh=10.0):
+        if mode not in ('quarantine', 'flag'):
+            raise ValueError(f"mode must be 'quarantine' or 'flag', got {mode!r}")
+        self.mode = mode
+        self.groups = dict(groups or {})
+        self.window = window
+        self.min_history = min_history
+        self.spike_k = spike_k
+        self.shift_after = shift_after
+        self.flatline_after = flatline_after
+        self.flatline_factor = flatline_factor
+        self.flatline_columns = np.array([name in flatline_columns for group, name in sensor_columns])
+        self.neighbour_k = neighbour_k
+        self.min_neighbours = min_neighbours
+        self.neighbour_refresh = neighbour_refresh
+
+        bands = np.array(flatten_sensor_data(thresholds), dtype=np.float64)
+        width = bands[:, 1] - bands[:, 0]
+        self.low = np.maximum(sensor_limits[:, 0], bands[:, 0] - implausible_widths * width)
+        self.high = np.minimum(sensor_limits[:, 1], bands[:, 1] + implausible_widths * width)
+        self.spike_floor = 0.25 * width
+        self.neighbour_floor = width
+        # The same per column, as Python numbers for check()
+        self.column_limits = list(zip(self.low.tolist(), self.high.tolist(), self.spike_floor.tolist(),
+                                      self.neighbour_floor.tolist(), self.flatline_columns.tolist()))
+
+        self.rows = {}  # node id -> state row
+        self.group_codes = {}  # group -> code
+        self._allocate(1024)
+        self.group_centre = self.group_spread = self.group_count = None
+        self.groups_refreshed = None
+        self.stats = {'readings': 0, 'flagged': 0, **{label: 0 for label in checks.values()}}
+
+    def _allocate(self, capacity):
+        n_columns = len(sensor_columns)
+        old = getattr(self, 'history', None)
+        size = 0 if old is None else len(self.rows)
+        arrays = {
+            'history': np.full((capacity, n_columns, self.window), np.nan, dtype=np.float32),
+            'position': np.zeros((capacity, n_columns), dtype=np.int16),
+            'count': np.zeros((capacity, n_columns), dtype=np.int16),
+            'last': np.full((capacity, n_columns), np.nan),  # last value seen, flagged or not
+            'run': np.zeros((capacity, n_columns), dtype=np.int32),  # repeats of `last`
+            'usual_run': np.full((capacity, n_columns), np.nan, dtype=np.float32),  # average run of `last`
+            'spikes': np.zeros((capacity, n_columns), dtype=np.int16),  # spikes in a row
+            'latest': np.full((capacity, n_columns), np.nan),  # last accepted value
+            'group': np.full(capacity, -1, dtype=np.int64),
+        }
+        for name, array in arrays.items():
+            if old is not None:
+                array[:size] = getattr(self, name)[:size]
+            setattr(self, name, array)
+        self.capacity = capacity
+
+    def _row(self, node_id):
+        row = self.rows.get(node_id)
+        if row is None:
+            row = len(self.rows)
+            if row >= self.capacity:
+                self._allocate(self.capacity * 2)
+            self.rows[node_id] = row
+            group = self.groups.get(node_id)
+            if group is not None:
+                self.group[row] = self.group_codes.setdefault(group, len(self.group_codes))
+                self.groups_refreshed = None  # a new member changes its group's statistics
+        return row
+
+    # Recompute the median and MAD of every group's latest accepted values:
+    # per column, one sort by (group, value) puts each group's values in a
+    # contiguous, ordered run (NaN last), and the medians are picked out of it
+    def refresh_groups(self):
+        n_groups = len(self.group_codes)
+        n_columns = len(sensor_columns)
+        self.group_centre = np.full((n_groups, n_columns), np.nan)
+        self.group_spread = np.zeros((n_groups, n_columns))
+        self.group_count = np.zeros((n_groups, n_columns), dtype=np.int64)
+        members = np.flatnonzero(self.group[:len(self.rows)] >= 0)
+        if len(members):
+            codes = self.group[members]
+            size = np.bincount(codes, minlength=n_groups)
+            first = np.r_[0, np.cumsum(size)[:-1]]
+            present = size > 0
+            for column in range(n_columns):
+                values = self.latest[members, column]
+                count = np.bincount(codes, np.isfinite(values), minlength=n_groups).astype(np.int64)
+                self.group_count[:, column] = count
+                usable = present & (count > 0)
+                lo = (first + np.maximum(count - 1, 0) // 2)[usable]
+                hi = (first + count // 2)[usable]
+                ordered = values[np.lexsort((values, codes))]
+                centre = np.full(n_groups, np.nan)
+                centre[usable] = (ordered[lo] + ordered[hi]) / 2
+                deviation = np.abs(values - centre[codes])
+                ordered = deviation[np.lexsort((deviation, codes))]
+                self.group_centre[:, column] = centre
+                self.group_spread[usable, column] = (ordered[lo] + ordered[hi]) / 2
+        self.groups_refreshed = time.monotonic()
+
+    # Check a batch of readings: `node_ids` (n,) and `values` (n, 6) in
+    # sensor_columns order, NaN where missing, in arrival order. Returns
+    # (flags, values): flags is (n, 6) uint8 of RANGE | SPIKE | FLATLINE |
+    # NEIGHBOUR bits, values the readings to score (flagged values NaN in
+    # quarantine mode; the input array is not modified).
+    def check_batch(self, node_ids, values):
+        values = np.asarray(values, dtype=np.float64)
+        n = len(node_ids)
+        flags = np.zeros(values.shape, dtype=np.uint8)
+        if not n:
+            return flags, values
+        rows = np.fromiter((self._row(node_id) for node_id in node_ids), dtype=np.int64, count=n)
+        if self.group_codes and (self.groups_refreshed is None
+                                 or time.monotonic() - self.groups_refreshed >= self.neighbour_refresh):
+            self.refresh_groups()
+
+        # A node can report more than once per batch; its readings are taken
+        # in order, one round per repeat
+        _, first = np.unique(rows, return_index=True)
+        if len(first) == n:
+            self._check_round(np.arange(n), rows, values, flags)
+        else:
+            seen = {}
+            rounds = np.empty(n, dtype=np.int64)
+            for i, row in enumerate(rows.tolist()):
+                rounds[i] = seen[row] = seen.get(row, -1) + 1
+            for r in range(int(rounds.max()) + 1):
+                items = np.flatnonzero(rounds == r)
+                self._check_round(items, rows[items], values[items], flags)
+
+        flagged = flags.any(axis=1)
+        self.stats['readings'] += n
+        n_flagged = int(flagged.sum())
+        if n_flagged:
+            self.stats['flagged'] += n_flagged
+            for bit, label in checks.items():
+                hits = int(np.count_nonzero(flags & bit))
+                if hits:
+                    self.stats[label] += hits
+                    anomalies.inc(hits, (label,))
+            if self.mode == 'quarantine':
+                values = np.where(flags > 0, np.nan, values)
+        return flags, values
+
+    def _check_round(self, items, rows, x, flags):
+        finite = np.isfinite(x)
+        round_flags = np.zeros(x.shape, dtype=np.uint8)
+        with np.errstate(invalid='ignore'):
+            round_flags[(x < self.low) | (x > self.high)] |= RANGE
+
+            # Robust centre and spread of each window: sort (NaN last) and
+            # pick the middle of the filled part
+            count = self.count[rows].astype(np.int64)
+            history = np.sort(self.history[rows], axis=2)
+            lo = np.maximum((count - 1) // 2, 0)[..., None]
+            hi = (count // 2)[..., None]
+            median = (np.take_along_axis(history, lo, 2) + np.take_along_axis(history, hi, 2))[..., 0] / 2
+            deviation = np.sort(np.abs(self.history[rows] - median[..., None]), axis=2)
+            mad = (np.take_along_axis(deviation, lo, 2) + np.take_along_axis(deviation, hi, 2))[..., 0] / 2
+            limit = np.maximum(self.spike_k * mad_scale * mad, self.spike_floor)
+            spike = (count >= self.min_history) & (np.abs(x - median) > limit)
+            spikes = np.where(spike, self.spikes[rows] + 1, 0)
+            self.spikes[rows] = spikes
+            round_flags[spike & (spikes <= self.shift_after)] |= SPIKE
+
+            # Runs of equal values: `run` counts repeats of `last`; when a
+            # run ends its length joins the average
+            last = self.last[rows]
+            same = x == last
+            run = self.run[rows]
+            usual = self.usual_run[rows]
+            ended = finite & np.isfinite(last) & ~same
+            ended_length = (run + 1).astype(np.float32)
+            usual = np.where(ended, np.where(np.isnan(usual), ended_length, 0.9 * usual + 0.1 * ended_length), usual)
+            run = np.where(same, run + 1, np.where(finite, 0, run))
+            self.run[rows] = run
+            self.usual_run[rows] = usual
+            self.last[rows] = np.where(finite, x, last)
+            round_flags[self.flatline_columns & (run + 1 >= np.maximum(self.flatline_factor * usual,
+                                                                      self.flatline_after))] |= FLATLINE
+
+            if self.group_centre is not None and len(self.group_centre):
+                group = self.group[rows]
+                grouped = group >= 0
+                if grouped.any():
+                    g = np.where(grouped, group, 0)
+                    centre = self.group_centre[g]
+                    # The node's own latest value is among the group's; it
+                    # needs min_neighbours others
+                    enough = grouped[:, None] & (self.group_count[g] - np.isfinite(self.latest[rows]) >= self.min_neighbours)
+                    limit = np.maximum(self.neighbour_k * mad_scale * self.group_spread[g], self.neighbour_floor)
+                    round_flags[enough & (np.abs(x - centre) > limit)] |= NEIGHBOUR
+
+        round_flags[~finite] = 0
+        flags[items] = round_flags
+
+        # Accepted values join the window and become the node's latest
+        accepted = finite & (round_flags == 0)
+        item, column = np.nonzero(accepted)
+        if len(item):
+            row = rows[item]
+            position = self.position[row, column]
+            self.history[row, column, position] = x[item, column]
+            self.position[row, column] = (position + 1) % self.window
+            self.count[row, column] = np.minimum(self.count[row, column] + 1, self.window)
+            self.latest[row, column] = x[item, column]
+
+    # Check one reading in the sensor_data dict format (or any six values in
+    # sensor_columns order). Returns (flags, sensor_data to score), flags as
+    # from describe_flags. The same checks as check_batch, but on the node's
+    # own state row in plain Python numbers: for one reading, numpy's
+    # per-call overhead costs far more than the arithmetic.
+    def check(self, node_id, sensor_data):
+        x = [np.nan if value is None else float(value) for value in flatten_sensor_data(sensor_data)]
+        row = self._row(node_id)
+        if self.group_codes and (self.groups_refreshed is None
+                                 or time.monotonic() - self.groups_refreshed >= self.neighbour_refresh):
+            self.refresh_groups()
+        flags = self._check_row(row, x)
+
+        self.stats['readings'] += 1
+        if not any(flags):
+            return {}, sensor_data
+        self.stats['flagged'] += 1
+        for bit, label in checks.items():
+            hits = sum(1 for flag in flags if flag & bit)
+            if hits:
+                self.stats[label] += hits
+                anomalies.inc(hits, (label,))
+        found = describe_flags(flags)
+        if self.mode == 'flag':
+            return found, sensor_data
+        return found, unflatten_sensor_data([None if flag or value != value else value
+                                             for value, flag in zip(x, flags)])
+
+    # _check_round for one reading `x` (six floats, NaN where missing) of
+    # state row `row`; returns its flags as a list
+    def _check_row(self, row, x):
+        history = self.history[row].tolist()
+        count = self.count[row].tolist()
+        spikes = self.spikes[row].tolist()
+        last = self.last[row].tolist()
+        run = self.run[row].tolist()
+        usual = self.usual_run[row].tolist()
+        latest = self.latest[row].tolist()
+        group = int(self.group[row])
+        grouped = group >= 0 and self.group_centre is not None and len(self.group_centre) > 0
+        if grouped:
+            centre = self.group_centre[group].tolist()
+            spread = self.group_spread[group].tolist()
+            group_count = self.group_count[group].tolist()
+
+        flags = [0] * len(x)
+        for column, (value, (low, high, spike_floor, neighbour_floor, flatline)) in enumerate(
+                zip(x, self.column_limits)):
+            if value != value:
+                spikes[column] = 0
+                continue
+            flag = RANGE if value < low or value > high else 0
+
+            # The spread is only needed when the value is beyond the floor
+            n = count[column]
+            spike = False
+            if n and n >= self.min_history:
+                window = history[column]
+                ordered = sorted(window if n == self.window else [v for v in window if v == v])
+                lo, hi = (n - 1) // 2, n // 2
+                median = (ordered[lo] + ordered[hi]) / 2
+                distance = abs(value - median)
+                if distance > spike_floor:
+                    deviation = sorted([abs(v - median) for v in ordered])
+                    spike = distance > self.spike_k * mad_scale * (deviation[lo] + deviation[hi]) / 2
+            spikes[column] = spikes[column] + 1 if spike else 0
+            if spike and spikes[column] <= self.shift_after:
+                flag |= SPIKE
+
+            previous = last[column]
+            if value == previous:
+                run[column] += 1
+            else:
+                if previous == previous:
+                    length = run[column] + 1
+                    # In float32, as usual_run is kept
+                    usual[column] = length if usual[column] != usual[column] else \
+                        float(np.float32(0.9) * np.float32(usual[column]) + np.float32(0.1) * np.float32(length))
+                run[column] = 0
+            last[column] = value
+            if flatline and run[column] + 1 >= max(float(self.flatline_factor * np.float32(usual[column])),
+                                                   self.flatline_after):
+                flag |= FLATLINE
+
+            if grouped and group_count[column] - (latest[column] == latest[column]) >= self.min_neighbours \
+                    and abs(value - centre[column]) > max(self.neighbour_k * mad_scale * spread[column],
+                                                          neighbour_floor):
+                flag |= NEIGHBOUR
+
+            flags[column] = flag
+            if not flag:
+                position = int(self.position[row, column])
+                self.history[row, column, position] = value
+                self.position[row, column] = (position + 1) % self.window
+                self.count[row, column] = min(n + 1, self.window)
+                self.latest[row, column] = value
+
+        self.spikes[row] = spikes
+        self.last[row] = last
+        self.run[row] = run
+        self.usual_run[row] = usual
+        return flags
+
+
+# Function to generate `steps` readings of `n_nodes` probes in groups of
+# `group_size` that share weather and soil, with faults injected into
+# `fault_rate` of the nodes. Returns (values (steps, nodes, 6), truth mask of
+# faulty values, node ids, groups).
+def synthetic_streams(n_nodes, steps, group_size=20, fault_rate=0.05, seed=0):
+    rng = np.random.default_rng(seed)
+    bands = np.array(flatten_sensor_data(ideal_thresholds), dtype=np.float64)
+    centre = bands.mean(axis=1)
+    width = bands[:, 1] - bands[:, 0]
+    n_groups = -(-n_nodes // group_size)
+    group_of = np.arange(n_nodes) // group_size
+    t = np.arange(steps)[:, None, None]
+    # Slow group-wide drift and a daily temperature/humidity cycle (one step
+    # is ten minutes), nodes a little apart from their group, sensor noise
+    drift = np.cumsum(rng.normal(0, 0.01, (steps, n_groups, 6)), axis=0)[:, group_of] * width
+    daily = np.sin(2 * np.pi * t / 144) * np.array([0, 0, 0, -8, 4, 0])
+    offset = rng.normal(0, 0.15, (n_nodes, 6)) * width
+    noise = rng.normal(0, 0.02, (steps, n_nodes, 6)) * width
+    values = centre + offset + drift + daily + noise
+    values[..., 3] = np.clip(values[..., 3], 0, 100)
+    values[..., 5] = np.clip(values[..., 5], 0, 100)
+    values[..., :3] = np.round(values[..., :3])  # NPK probes report whole mg/kg
+    values[..., 3:5] = np.round(values[..., 3:5])  # DHT11: whole % and degrees
+
+    faulty = np.zeros(values.shape, dtype=bool)
+    nodes = rng.choice(n_nodes, int(n_nodes * fault_rate), replace=False)
+    for k, node in enumerate(nodes.tolist()):
+        start = int(rng.integers(steps // 4, steps // 2))
+        kind = k % 3
+        if kind == 0:  # stuck DHT11: humidity and temperature freeze
+            values[start:, node, 3:5] = values[start, node, 3:5]
+            faulty[start:, node, 3:5] = True
+        elif kind == 1:  # shorted moisture probe
+            values[start:, node, 5] = 0.0
+            faulty[start:, node, 5] = True
+        else:  # loose wire: occasional wild readings on one sensor
+            column = int(rng.integers(6))
+            hits = start + rng.choice(steps - start, max(1, (steps - start) // 20), replace=False)
+            values[hits, node, column] = rng.uniform(*sensor_limits[column], len(hits))
+            faulty[hits, node, column] = True
+    node_ids = [f"probe-{i}" for i in range(n_nodes)]
+    groups = {node_id: f"group-{g}" for node_id, g in zip(node_ids, group_of.tolist())}
+    return values, faulty, node_ids, groups
+
+
+# Time the detector per reading against batch scoring, and measure how many
+# injected faults it catches and how many clean values it flags
+def benchmark(n_nodes=10_000, steps=200, batch_size=5_000):
+    from batch_scoring import score_batch
+
+    values, faulty, node_ids, groups = synthetic_streams(n_nodes, steps)
+    detector = AnomalyDetector(groups=groups, neighbour_refresh=0.0)
+    stream_ids = node_ids * steps
+    stream = values.reshape(-1, len(sensor_columns))
+    flags = np.empty(stream.shape, dtype=np.uint8)
+    detect_seconds = score_seconds = 0.0
+    for start in range(0, len(stream), batch_size):
+        batch = stream[start:start + batch_size]
+        began = time.perf_counter()
+        flags[start:start + batch_size], cleaned = detector.check_batch(stream_ids[start:start + batch_size], batch)
+        detect_seconds += time.perf_counter() - began
+        began = time.perf_counter()
+        score_batch(cleaned)
+        score_seconds += time.perf_counter() - began
+
+    truth = faulty.reshape(-1, len(sensor_columns))
+    flagged = flags > 0
+    # A stuck sensor cannot be told from a steady one until it has repeated
+    # for flatline_after readings; those are not counted as misses
+    countable = truth.copy()
+    stuck = values.reshape(steps, n_nodes, -1)
+    for step in range(1, detector.flatline_after):
+        same = np.zeros_like(faulty)
+        same[step:] = faulty[step:] & ~faulty[:-step]
+        countable.reshape(faulty.shape)[same] = False
+    caught = (flagged & countable).sum() / max(countable.sum(), 1)
+    false_rate = (flagged & ~truth).sum() / (~truth).sum()
+    n = len(stream)
+    print(f"{n_nodes:,} nodes x {steps} readings in batches of {batch_size:,}")
+    print(f"detector {detect_seconds / n * 1e6:.2f} us/reading ({n / detect_seconds:,.0f} readings/s), "
+          f"score_batch {score_seconds / n * 1e6:.2f} us/reading")
+    print(f"caught {caught:.1%} of faulty values, flagged {false_rate:.3%} of clean ones; "
+          f"by check: {', '.join(f'{label} {detector.stats[label]:,}' for label in checks.values())}")
+    state = ('history', 'position', 'count', 'last', 'run', 'usual_run', 'spikes', 'latest', 'group')
+    print(f"state: {sum(getattr(detector, name).nbytes for name in state) / detector.capacity:.0f} bytes per node")
+
+    # One reading at a time, as the page and probe paths call it
+    single = AnomalyDetector()
+    sensor_data = unflatten_sensor_data(values[-1, 0].tolist())
+    repeat = 20_000
+    began = time.perf_counter()
+    for _ in range(repeat):
+        single.check(node_ids[0], sensor_data)
+    print(f"check() on one sensor_data dict: {(time.perf_counter() - began) / repeat * 1e6:.1f} us")
+
+    page = AnomalyDetector()
+    found, cleaned = page.check('local', {'NPK_levels': {'Nitrogen': 553.0, 'Phosphorus': 4.0, 'Potassium': 25.0},
+                                          'Humidity': 60.0, 'Temperature': 35.0, 'Soil_Moisture': 10.0})
+    print(f"page with Nitrogen = 553: flagged {found}, scored as {cleaned}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark streaming sensor-fault detection.')
+    parser.add_argument('--nodes', type=int, default=10_000)
+    parser.add_argument('--steps', type=int, default=200, help='readings per node')
+    parser.add_argument('--batch-size', type=int, default=5_000)
+    args = parser.parse_args()
+    benchmark(args.nodes, args.steps, args.batch_size)
+
+
+if __name__ == "__main__":
+    main()
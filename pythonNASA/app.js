@@ -1,69 +1,207 @@
 const express = require('express');
 const path = require('path');
-const { exec } = require('child_process');
+const readline = require('readline');
+const { spawn } = require('child_process');
 
 const app = express();
 const port = 100;
 
+// Python interpreter used to run the scoring worker
+const pythonCommand = process.env.PYTHON || 'python';
+// How long to wait for the worker to answer one request
+const workerTimeoutMs = 30000;
+
 // Store sensor data globally so it can be returned quickly
 let cachedSensorData = {
     score: null,
-    suggestions: [],
+    recommendations: [],
     lastUpdated: null
 };
 
-// Function to run the Python script and update cached data
-function updateSensorData() {
-    exec('python -u "c:\\Users\\miaaz\\OneDrive\\Desktop\\pythonNASA\\soil_health.py"', (error, stdout, stderr) => {
-        if (error) {
-            console.error(`Error executing Python script: ${error}`);
+// Long-lived Python scoring worker (scoring_worker.py), started once and reused.
+// Requests and responses are single-line JSON objects matched up by id.
+let worker = null;
+let nextRequestId = 1;
+const pendingRequests = new Map();
+
+// Fail every request still waiting for an answer
+function rejectPending(message) {
+    for (const pending of pendingRequests.values()) {
+        clearTimeout(pending.timer);
+        pending.reject(new Error(message));
+    }
+    pendingRequests.clear();
+}
+
+function startWorker() {
+    const child = spawn(pythonCommand, ['-u', path.join(__dirname, 'scoring_worker.py')], {
+        stdio: ['pipe', 'pipe', 'inherit']
+    });
+    worker = child;
+
+    readline.createInterface({ input: child.stdout }).on('line', line => {
+        let response;
+        try {
+            response = JSON.parse(line);
+        } catch (err) {
+            console.error('Unparseable response from scoring worker:', line);
             return;
         }
+        const pending = pendingRequests.get(response.id);
+        if (!pending) {
+            return;
+        }
+        pendingRequests.delete(response.id);
+        clearTimeout(pending.timer);
+        if (response.error) {
+            pending.reject(new Error(response.error));
+        } else {
+            pending.resolve(response.result);
+        }
+    });
 
-        // Combine stdout and stderr to capture all output
-        const output = stdout + stderr;
-        console.log("Python Script Output:\n", output);
+    child.on('exit', (code, signal) => {
+        console.error(`Scoring worker exited (code ${code}, signal ${signal}); restarting`);
+        rejectPending('Scoring worker exited');
+        worker = null;
+        setTimeout(startWorker, 1000);
+    });
 
-        const outputLines = output.split('\n').filter(line => line);  // Remove empty lines
+    child.on('error', err => {
+        console.error(`Failed to start scoring worker: ${err}`);
+    });
 
-        // Find the line with the Soil Health Score
-        const scoreLine = outputLines.find(line => line.includes('Soil Health Score'));
+    // A write to a worker that has died or closed its input fails with
+    // EPIPE; unhandled, that would take this process down. Nothing more can
+    // be sent to it, so fail what is waiting and stop it; its exit handler
+    // starts a new one.
+    child.stdin.on('error', err => {
+        console.error(`Cannot write to scoring worker: ${err.message}`);
+        if (worker === child) {
+            worker = null;
+        }
+        rejectPending('Scoring worker is not accepting requests');
+        child.kill();
+    });
+}
 
-        if (!scoreLine) {
-            console.error('Could not find the soil health score in the output');
+// Send one request to the worker and resolve with its result
+function callWorker(method, params) {
+    return new Promise((resolve, reject) => {
+        if (!worker) {
+            reject(new Error('Scoring worker is not running'));
             return;
         }
+        const id = nextRequestId++;
+        const timer = setTimeout(() => {
+            pendingRequests.delete(id);
+            reject(new Error(`Scoring worker did not answer within ${workerTimeoutMs} ms`));
+        }, workerTimeoutMs);
+        pendingRequests.set(id, { resolve, reject, timer });
+        worker.stdin.write(JSON.stringify({ id, method, params }) + '\n');
+    });
+}
 
-        // Extract the score using a regular expression
-        const scoreMatch = scoreLine.match(/Soil Health Score:\s*([0-9.]+)/);
-        const score = scoreMatch ? parseFloat(scoreMatch[1]) : NaN;
+// Dashboards subscribed to /events (server-sent events): response -> its
+// heartbeat timer
+const eventClients = new Map();
+let nextEventId = 1;
+// A client with this much unsent data is too slow; it is dropped and its
+// browser reconnects, sending the id of the last event it got
+// (Last-Event-ID) so the events it missed can be replayed
+const maxBufferedBytes = 64 * 1024;
+// Recent frames kept for replay: [{id, frame}], oldest first
+const recentFrames = [];
+const maxRecentFrames = 100;
+const reconnectMs = 3000;
 
-        console.log("Score Line:", scoreLine);
-        console.log("Extracted Score:", score);
+// Write to one dashboard, dropping it if its stream has already ended
+function sendEvent(res, text) {
+    if (res.writableEnded || res.destroyed) {
+        dropClient(res);
+        return;
+    }
+    res.write(text);
+}
 
-        if (isNaN(score)) {
-            console.error('Failed to extract valid soil health score');
-            return;
+// Stop sending to a dashboard and close its stream
+function dropClient(res) {
+    clearInterval(eventClients.get(res));
+    eventClients.delete(res);
+    if (!res.writableEnded && !res.destroyed) {
+        res.end(`retry: ${reconnectMs}\n\n`);
+    }
+}
+
+// Push one changed result to every subscribed dashboard
+function broadcastSensorData(data) {
+    const id = nextEventId++;
+    const frame = `id: ${id}\nevent: score\ndata: ${JSON.stringify(data)}\n\n`;
+    recentFrames.push({ id, frame });
+    if (recentFrames.length > maxRecentFrames) {
+        recentFrames.shift();
+    }
+    for (const res of [...eventClients.keys()]) {
+        if (res.writableLength > maxBufferedBytes) {
+            dropClient(res);
+            continue;
         }
+        sendEvent(res, frame);
+    }
+}
 
-        // Extract recommendations (find lines starting with "Recommendations to improve soil health:")
-        const recommendationsIndex = outputLines.findIndex(line => line.includes("Recommendations to improve soil health:"));
-        const recommendations = outputLines.slice(recommendationsIndex + 1);
+// Catch a reconnecting dashboard up from the id of the last event it got:
+// replay the frames it missed, or, when they are no longer kept, send the
+// current result under the newest id
+function replayEvents(res, lastEventId) {
+    if (!(lastEventId >= 0) || lastEventId >= nextEventId - 1) {
+        return;
+    }
+    if (recentFrames.length && recentFrames[0].id <= lastEventId + 1) {
+        for (const { id, frame } of recentFrames) {
+            if (id > lastEventId) {
+                sendEvent(res, frame);
+            }
+        }
+    } else if (cachedSensorData.lastUpdated) {
+        sendEvent(res, `id: ${nextEventId - 1}\nevent: score\ndata: ${JSON.stringify(cachedSensorData)}\n\n`);
+    }
+}
 
-        const formattedRecommendations = recommendations.map(rec => rec.trim());
+// Ask the scoring worker for a fresh assessment and update cached data
+function updateSensorData() {
+    callWorker('assess', {})
+        .then(result => {
+            if (result.errors && result.errors.length) {
+                console.error('Errors while reading the ESP32:', result.errors);
+            }
 
-        // Update the cached sensor data
-        cachedSensorData = {
-            score: score,
-            suggestions: formattedRecommendations,
-            lastUpdated: new Date().toISOString() // Store last update time
-        };
+            // Update the cached sensor data; the worker reports whether
+            // anything changed since the last cycle
+            cachedSensorData = {
+                score: result.score,
+                // Advice as records ({kind, variable, direction, amount,
+                // unit, current, limit}); the dashboard renders the
+                // sentences when it shows them
+                recommendations: result.recommendations || [],
+                // Sensors that could not be read and show their last good
+                // value instead: {sensor: age in seconds}
+                stale: result.stale || {},
+                lastUpdated: new Date().toISOString() // Store last update time
+            };
 
-        console.log('Updated sensor data:', cachedSensorData);
-    });
+            if (result.changed) {
+                console.log('Updated sensor data:', cachedSensorData);
+                broadcastSensorData(cachedSensorData);
+            }
+        })
+        .catch(err => {
+            console.error(`Error assessing soil health: ${err.message}`);
+        });
 }
 
-// Schedule the Python script to run every 10 seconds
+// Ask for a new assessment every 10 seconds
+startWorker();
 setInterval(updateSensorData, 10000);
 
 // Serve static files (CSS, client-side JS)
@@ -83,10 +221,60 @@ app.get('/sensor-data', (req, res) => {
     }
 });
 
+// Route to stream changed results as server-sent events
+app.get('/events', (req, res) => {
+    res.writeHead(200, {
+        'Content-Type': 'text/event-stream',
+        'Cache-Control': 'no-cache',
+        'Connection': 'keep-alive'
+    });
+    res.write(`retry: ${reconnectMs}\n\n`);
+    eventClients.set(res, setInterval(() => sendEvent(res, ': keep-alive\n\n'), 15000));
+    res.on('error', err => {
+        console.error(`Event stream error: ${err.message}`);
+        dropClient(res);
+    });
+    req.on('close', () => dropClient(res));
+    const lastEventId = req.get('Last-Event-ID');
+    if (lastEventId !== undefined) {
+        replayEvents(res, Number(lastEventId));
+    }
+});
+
+// Route to expose pipeline metrics to Prometheus: the scoring worker's,
+// plus how many requests are waiting on it
+app.get('/metrics', (req, res) => {
+    callWorker('metrics', {})
+        .then(text => {
+            res.type('text/plain; version=0.0.4; charset=utf-8').send(text +
+                '# HELP aquiferst_worker_pending_requests Requests waiting for the scoring worker\n' +
+                '# TYPE aquiferst_worker_pending_requests gauge\n' +
+                `aquiferst_worker_pending_requests ${pendingRequests.size}\n`);
+        })
+        .catch(err => {
+            res.status(503).type('text/plain').send(`Scoring worker unavailable: ${err.message}\n`);
+        });
+});
+
+// Route to fetch downsampled history for trend charts.
+// Query parameters (all optional): node, start and end (Unix seconds; default
+// the last 7 days) and points (maximum number of buckets, default 500).
+app.get('/history', (req, res) => {
+    const params = {
+        node_id: req.query.node,
+        start: req.query.start ? Number(req.query.start) : undefined,
+        end: req.query.end ? Number(req.query.end) : undefined,
+        points: req.query.points ? Number(req.query.points) : undefined
+    };
+    callWorker('history', params)
+        .then(result => res.json(result))
+        .catch(err => res.status(500).json({ error: err.message }));
+});
+
 // Start the server
 app.listen(port, () => {
     console.log(`Server is running at http://localhost:${port}`);
 });
 
-// Run the script once at the start to initialize the data
+// Assess once at the start to initialize the data
 updateSensorData();
@@ -1,42 +1,249 @@
-from flask import Flask, jsonify, send_from_directory
+from flask import Flask, Response, request, send_from_directory
+import argparse
 import logging
 import os
-from sensor_utils import fetch_sensor_data, assess_soil_health  # Import your functions
+import threading
+import time
+from anomaly import AnomalyDetector
+from broadcast import BroadcastRing
+from incremental import IncrementalScorer
+from metrics import content_type, registry
+from score_cache import ScoreCache
+from sensor_page import fetch_sensor_data
+from sensor_sources import PageFileSource, SourcePipeline
+from soil_health import assess_soil_health, ideal_thresholds
 
 app = Flask(__name__)
+logger = logging.getLogger(__name__)
+
+# Sensor page scored for /sensor-data; SENSOR_PAGE overrides the location
+page_path = os.environ.get('SENSOR_PAGE', os.path.join(app.root_path, 'data', 'please.html'))
+page_node_id = 'local'
+
+# Results are computed when readings change, never per request: a background
+# thread re-checks the sensor page every REFRESH_SECONDS and the routes below
+# serve whatever the cache holds. With INGEST_PORT set, readings pushed by
+# probes (see ingest_server.py) are scored and cached as they arrive too.
+score_cache = ScoreCache()
+scorer = IncrementalScorer(ideal_thresholds)
+refresh_seconds = float(os.environ.get('REFRESH_SECONDS', 1.0))
+
+# Implausible readings (a stuck or shorted sensor) are left out of scoring;
+# ANOMALY_MODE=flag only logs them and ANOMALY_MODE=off skips the check
+anomaly_mode = os.environ.get('ANOMALY_MODE', 'quarantine')
+
+# Every cache change is also pushed to /events subscribers
+events = BroadcastRing()
+score_cache.listeners.append(lambda node_id, entry: events.publish(node_id, dict(entry, node=node_id)))
+
+
+# Function to build the anomaly detector for ANOMALY_MODE, None when off
+def anomaly_detector():
+    return None if anomaly_mode == 'off' else AnomalyDetector(ideal_thresholds, anomaly_mode)
+
+
+# Function to build the pipeline that reads and scores the sensor page at `path`
+def page_pipeline(path):
+    return SourcePipeline([PageFileSource({page_node_id: path})], scorer=scorer, loop='page',
+                          detector=anomaly_detector())
+
+
+# Function to re-score the sensor page and cache the result if it changed
+def refresh_page(pipeline):
+    batch, results = pipeline.cycle()
+    for node_id, error in batch['errors'].items():
+        logger.warning(f"Cannot read sensor page for {node_id}: {error}")
+    for node_id, found in batch['anomalies'].items():
+        logger.warning(f"Implausible readings from {node_id}: {found}")
+    for node_id, (total_score, records, changed) in results.items():
+        if changed:
+            score_cache.update(node_id, total_score, records)
+
+
+def run_refresher(path, interval):
+    pipeline = page_pipeline(path)
+    while True:
+        refresh_page(pipeline)
+        time.sleep(interval)
+
+
+# Function to tell whether an If-None-Match header lists `etag`: exact
+# comparison of each comma-separated tag, weak (W/) or not, or '*'
+def etag_matches(header, etag):
+    for tag in header.split(','):
+        tag = tag.strip()
+        if tag == '*':
+            return True
+        if tag.startswith('W/'):
+            tag = tag[2:]
+        if tag == etag:
+            return True
+    return False
+
+
+# Function to answer from a CachedBody: 304 when the client already has this
+# version, gzip when the client accepts it
+def cached_response(body):
+    if body is None:
+        return Response('{"error":"Sensor data not yet available. Please try again later."}',
+                        status=503, mimetype='application/json')
+    headers = {'ETag': body.etag, 'Cache-Control': 'no-cache', 'Vary': 'Accept-Encoding'}
+    if etag_matches(request.headers.get('If-None-Match', ''), body.etag):
+        return Response(status=304, headers=headers)
+    if body.gzipped is not None and 'gzip' in request.headers.get('Accept-Encoding', ''):
+        headers['Content-Encoding'] = 'gzip'
+        return Response(body.gzipped, mimetype='application/json', headers=headers)
+    return Response(body.body, mimetype='application/json', headers=headers)
 
-# Ideal thresholds dictionary
-ideal_thresholds = {
-    'NPK_levels': {
-        'Nitrogen': (40, 60),
-        'Phosphorus': (25, 35),
-        'Potassium': (20, 30)
-    },
-    'Humidity': (50, 75),
-    'Temperature': (15, 25),
-    'Soil_Moisture': (25, 40)
-}
 
 @app.route('/sensor-data')
 def get_sensor_data():
-    # Construct the file path relative to the app root
-    file_path = os.path.join(app.root_path, 'data', 'please.html')
+    return cached_response(score_cache.node_body(page_node_id))
 
-    # Fetch sensor data using the function defined above
-    sensor_data = fetch_sensor_data(file_path)
-    total_score, suggestions = assess_soil_health(sensor_data, ideal_thresholds)
+# Route to fetch the latest result of one node
+@app.route('/nodes/<node_id>/sensor-data')
+def get_node_sensor_data(node_id):
+    return cached_response(score_cache.node_body(node_id))
+
+# Route to fetch the latest result of every node in one response
+@app.route('/nodes/scores')
+def get_node_scores():
+    return cached_response(score_cache.bulk_body())
 
-    # Return JSON response
-    response = {
-        'score': total_score,
-        'suggestions': suggestions
-    }
-    return jsonify(response)
+# Route to stream changed results as server-sent events. `node` selects one
+# node (default: the node /sensor-data shows) or `*` for every node.
+@app.route('/events')
+def get_events():
+    node = request.args.get('node', page_node_id)
+    stream = events.stream(None if node == '*' else node, request.headers.get('Last-Event-ID'))
+    return Response(stream, mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+# Route to expose pipeline metrics to Prometheus
+@app.route('/metrics')
+def get_metrics():
+    return Response(registry.render(), content_type=content_type)
 
 # Route to serve the main page
 @app.route('/')
 def index():
     return send_from_directory('templates', 'index.html')
 
+
+# Start the background work that keeps score_cache current
+def start_background():
+    threading.Thread(target=run_refresher, args=(page_path, refresh_seconds), daemon=True).start()
+    ingest_port = os.environ.get('INGEST_PORT')
+    if ingest_port:
+        from ingest_server import IngestServer
+
+        # Pushed readings get recommendation records like the page's, from
+        # a scorer of their own (this runs on the ingest batcher thread)
+        ingest_scorer = IncrementalScorer(ideal_thresholds)
+
+        def on_batch(batch):
+            results = [ingest_scorer.assess(node_id, [None if value != value else value for value in row],
+                                            structured=True)
+                       for node_id, row in zip(batch['node_ids'], batch['values'].tolist())]
+            score_cache.update_many(batch['node_ids'], results, batch['timestamps'].tolist())
+
+        IngestServer(port=int(ingest_port), on_batch=on_batch, detector=anomaly_detector()).start()
+
+
+# The handler this module used to have: read, parse and score on every request
+def recompute_sensor_data():
+    sensor_data = fetch_sensor_data(page_path)
+    total_score, suggestions = assess_soil_health(sensor_data, ideal_thresholds)
+    return {'score': total_score, 'suggestions': suggestions}
+
+
+# Compare per-request recompute with the cached routes over real HTTP
+def load_test(duration=5.0, clients=8, n_nodes=1000):
+    import multiprocessing
+    import shutil
+    import tempfile
+    from recommendations import water
+    from werkzeug.serving import WSGIRequestHandler, make_server
+
+    global page_path
+    directory = tempfile.mkdtemp(prefix='aquiferst-api-')
+    page_path = os.path.join(directory, 'please.html')
+    shutil.copy(os.path.join(app.root_path, 'please.html'), page_path)
+    refresh_page(page_pipeline(page_path))
+    for i in range(n_nodes):
+        score_cache.update(f"probe-{i}", 0.5 + i % 50 / 100, [water(float(i % 7), 20.0, 25)])
+    app.add_url_rule('/sensor-data/recompute', 'recompute', lambda: recompute_sensor_data())
+
+    class QuietHandler(WSGIRequestHandler):
+        protocol_version = 'HTTP/1.1'  # keep-alive, like a browser
+
+        def log_request(self, *args):
+            pass
+
+    server = make_server('127.0.0.1', 0, app, threaded=True, request_handler=QuietHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    port = server.server_port
+
+    cases = [
+        ('per-request recompute', '/sensor-data/recompute', {}),
+        ('cached, 200', '/sensor-data', {}),
+        ('cached, 304', '/sensor-data', {'If-None-Match': score_cache.node_body(page_node_id).etag}),
+        (f'bulk {n_nodes} nodes, 200', '/nodes/scores', {}),
+        (f'bulk {n_nodes} nodes, gzip', '/nodes/scores', {'Accept-Encoding': 'gzip'}),
+        (f'bulk {n_nodes} nodes, 304', '/nodes/scores', {'If-None-Match': score_cache.bulk_body().etag}),
+    ]
+    client = app.test_client()
+    try:
+        for label, path, headers in cases:
+            # The app alone, without the HTTP server
+            requests_done = 0
+            start = time.perf_counter()
+            while time.perf_counter() - start < duration / 5:
+                client.get(path, headers=headers)
+                requests_done += 1
+            in_process = requests_done / (time.perf_counter() - start)
+
+            counts = multiprocessing.Value('l', 0)
+            sizes = multiprocessing.Value('l', 0)
+            processes = [multiprocessing.Process(target=_load_client, args=(port, path, headers, duration, counts, sizes))
+                         for _ in range(clients)]
+            for process in processes:
+                process.start()
+            for process in processes:
+                process.join()
+            print(f"{label:>28}: {counts.value / duration:>8,.0f} requests/s over HTTP, "
+                  f"{in_process:>8,.0f} requests/s in-process, "
+                  f"{sizes.value / max(counts.value, 1):>7,.0f} bytes/response")
+    finally:
+        server.shutdown()
+        shutil.rmtree(directory)
+
+
+def _load_client(port, path, headers, duration, counts, sizes):
+    import http.client
+
+    connection = http.client.HTTPConnection('127.0.0.1', port)
+    count = size = 0
+    deadline = time.monotonic() + duration
+    while time.monotonic() < deadline:
+        connection.request('GET', path, headers=headers)
+        response = connection.getresponse()
+        size += len(response.read())
+        if response.status not in (200, 304):
+            raise RuntimeError(f"{path} answered {response.status}")
+        count += 1
+    with counts.get_lock():
+        counts.value += count
+    with sizes.get_lock():
+        sizes.value += size
+
+
 if __name__ == "__main__":
-    app.run()
+    parser = argparse.ArgumentParser(description='Soil health API.')
+    parser.add_argument('--load-test', action='store_true', help='compare cached routes with per-request recompute')
+    args = parser.parse_args()
+    if args.load_test:
+        load_test()
+    else:
+        start_background()
+        app.run()
@@ -0,0 +1,180 @@
+import argparse
+import time
+
+import numpy as np
+
+from soil_health import (
+    assess_soil_health,
+    compute_score,
+    flatten_sensor_data,
+    ideal_thresholds,
+    sensor_columns,
+    soil_bulk_density,
+    unflatten_sensor_data,
+)
+
+# Column indexes into a readings array (see soil_health.sensor_columns)
+column_index = {name: i for i, (group, name) in enumerate(sensor_columns)}
+nutrient_columns = [i for i, (group, name) in enumerate(sensor_columns) if group == 'NPK_levels']
+moisture_column = column_index['Soil_Moisture']
+
+
+# Function to pack a list of readings (sensor_data dicts or readings.Reading)
+# into an (n, 6) float64 array
+def readings_to_array(readings):
+    return np.array([flatten_sensor_data(sensor_data) for sensor_data in readings], dtype=np.float64)
+
+
+# Function to flatten a thresholds dict into an (6, 2) array of (ideal_min, ideal_max)
+def thresholds_to_array(thresholds):
+    return np.array(flatten_sensor_data(thresholds), dtype=np.float64)
+
+
+# Vectorised compute_score for one column.
+# The arithmetic mirrors compute_score term by term so results are bit-identical;
+# NaN (a missing reading) falls through every comparison and scores 0.0, exactly
+# as the scalar function does.
+def compute_score_array(values, ideal_min, ideal_max):
+    delta = ideal_max - ideal_min
+    min_val = ideal_min - delta
+    max_val = ideal_max + delta
+
+    # Both ramps are evaluated everywhere (cheap, branch-free) and masked out
+    # afterwards, which is much faster than boolean fancy-indexing.
+    rising = np.subtract(values, min_val)
+    rising /= ideal_min - min_val
+    falling = np.subtract(max_val, values)
+    falling /= max_val - ideal_max
+
+    scores = np.where((values >= min_val) & (values < ideal_min), rising, 0.0)
+    np.copyto(scores, falling, where=(values > ideal_max) & (values <= max_val))
+    np.copyto(scores, 1.0, where=(values >= ideal_min) & (values <= ideal_max))
+    return scores
+
+
+# Score a whole batch of readings at once.
+#
+# `readings` is an (n, 6) array in soil_health.sensor_columns order, one row per
+# node/timestamp, or a readings.ReadingBatch (scored in place, without a copy).
+# `soil_volume_m3` may be a scalar or a length-n array.
+# Returns a dict of arrays:
+#   'scores'           - (n, 6) per-variable scores
+#   'total_score'      - (n,) mean score, as returned by assess_soil_health
+#   'water_needed'     - (n,) litres of water suggested (0 where none)
+#   'nutrient_needed'  - (n, 3) grams of N, P, K fertiliser suggested (0 where none)
+def score_batch(readings, thresholds=ideal_thresholds, soil_volume_m3=1.0):
+    readings = np.asarray(readings, dtype=np.float64)
+    if readings.ndim != 2 or readings.shape[1] != len(sensor_columns):
+        raise ValueError(f"readings must have shape (n, {len(sensor_columns)}), got {readings.shape}")
+    bands = thresholds_to_array(thresholds)
+    n_rows = readings.shape[0]
+
+    # Work column by column: each column has its own band, and it keeps the
+    # temporaries at one column's worth of memory even for 10^7 rows.
+    # Columns are copied out contiguously first; strided access into a
+    # row-major array is several times slower.
+    scores = np.empty(readings.shape, dtype=np.float64)
+    for i, (ideal_min, ideal_max) in enumerate(bands):
+        column = np.ascontiguousarray(readings[:, i])
+        scores[:, i] = compute_score_array(column, ideal_min, ideal_max)
+
+    # Sum left to right like sum(scores) in the scalar path, so floating-point
+    # rounding is identical.
+    total_score = scores[:, 0].copy()
+    for i in range(1, len(sensor_columns)):
+        total_score += scores[:, i]
+    total_score /= len(sensor_columns)
+
+    soil_volume_m3 = np.broadcast_to(np.asarray(soil_volume_m3, dtype=np.float64), (n_rows,))
+    soil_mass_kg = soil_bulk_density * soil_volume_m3
+
+    # calculate_water_needed, only where moisture is below the band
+    moisture = readings[:, moisture_column]
+    moisture_min = bands[moisture_column, 0]
+    water_needed = np.where(
+        moisture < moisture_min,
+        (moisture_min - moisture) / 100.0 * soil_volume_m3 * 1000,
+        0.0,
+    )
+
+    # calculate_nutrient_needed, only where a nutrient is below its band
+    nutrient_needed = np.zeros((n_rows, len(nutrient_columns)), dtype=np.float64)
+    for j, i in enumerate(nutrient_columns):
+        level = readings[:, i]
+        ideal_min = bands[i, 0]
+        nutrient_needed[:, j] = np.where(
+            level < ideal_min,
+            (ideal_min - level) * soil_mass_kg / 1000.0,
+            0.0,
+        )
+
+    return {
+        'scores': scores,
+        'total_score': total_score,
+        'water_needed': water_needed,
+        'nutrient_needed': nutrient_needed,
+    }
+
+
+# Function to generate n random readings spread around and outside the ideal bands
+def synthetic_readings(n_rows, seed=0):
+    rng = np.random.default_rng(seed)
+    bands = thresholds_to_array(ideal_thresholds)
+    width = bands[:, 1] - bands[:, 0]
+    low = bands[:, 0] - 2 * width
+    high = bands[:, 1] + 2 * width
+    return rng.uniform(low, high, size=(n_rows, len(sensor_columns)))
+
+
+# Function to score rows one at a time through the existing scalar code
+def score_scalar(readings):
+    return np.array([
+        assess_soil_health(unflatten_sensor_data(row), ideal_thresholds)[0]
+        for row in readings.tolist()
+    ])
+
+
+# Function to compute per-variable scalar scores, for checking the batch output
+def compute_scalar_scores(readings):
+    bands = flatten_sensor_data(ideal_thresholds)
+    return np.array([
+        [compute_score(value, *band) for value, band in zip(row, bands)]
+        for row in readings.tolist()
+    ])
+
+
+def benchmark(max_exponent=7, scalar_limit=100_000):
+    print(f"{'rows':>10} {'batch s':>10} {'rows/s':>12} {'scalar s':>10} {'speedup':>8}")
+    for exponent in range(3, max_exponent + 1):
+        n_rows = 10 ** exponent
+        readings = synthetic_readings(n_rows)
+
+        start = time.perf_counter()
+        result = score_batch(readings)
+        batch_seconds = time.perf_counter() - start
+
+        # The scalar path is timed on at most scalar_limit rows and scaled up
+        sample = readings[:scalar_limit]
+        start = time.perf_counter()
+        scalar_totals = score_scalar(sample)
+        scalar_seconds = (time.perf_counter() - start) * n_rows / len(sample)
+
+        if not (np.array_equal(scalar_totals, result['total_score'][:scalar_limit])
+                and np.array_equal(compute_scalar_scores(sample), result['scores'][:scalar_limit])):
+            raise AssertionError("batch scores differ from the scalar path")
+
+        print(f"{n_rows:>10} {batch_seconds:>10.4f} {n_rows / batch_seconds:>12.0f} "
+              f"{scalar_seconds:>10.3f} {scalar_seconds / batch_seconds:>7.0f}x")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark batch scoring against the scalar path.')
+    parser.add_argument('--max-exponent', type=int, default=7, help='largest batch is 10**N rows')
+    parser.add_argument('--scalar-limit', type=int, default=100_000,
+                        help='rows actually run through the scalar path per size')
+    args = parser.parse_args()
+    benchmark(args.max_exponent, args.scalar_limit)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,328 @@
+import argparse
+import contextlib
+import cProfile
+import io
+import itertools
+import json
+import os
+import platform
+import pstats
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+from batch_scoring import score_batch, synthetic_readings
+from incremental import IncrementalScorer
+from sensor_page import fetch_sensor_data, parse_sensor_values, soup_sensor_values, synthetic_page
+from soil_health import assess_soil_health, ideal_thresholds, unflatten_sensor_data
+
+# Benchmark suite for the read -> parse -> score pipeline.
+#
+# Every stage runs against local stand-ins only (synthetic pages, synthetic
+# readings, a FakeESP32Server, a scoring_worker subprocess), so the suite runs
+# offline and the numbers measure our code rather than the network.
+#
+# Stages, each timed at 1, 10, 100, ... nodes up to --max-nodes:
+#   page.parse        - parse_sensor_values on one synthetic page per node
+#   page.soup         - the BeautifulSoup scan of the PyResult scripts'
+#                       get_float_from_text, as the baseline (needs bs4)
+#   page.fetch        - fetch_sensor_data: read a page file, parse it
+#   score.scalar      - assess_soil_health, one call per node
+#   score.incremental - IncrementalScorer with 10% of nodes changing per cycle
+#   score.batch       - batch_scoring.score_batch over all nodes at once
+#   fetch.collector   - one ESP32Collector cycle against a FakeESP32Server
+#   worker.assess     - one app.js cycle: an `assess` request to a running
+#                       scoring_worker.py over stdio, fetching from the fake
+#
+# Slow per-node stages stop at their own limits (see stage_limits) so a full
+# run at 10^6 nodes stays in the minutes.
+#
+# Results go to a JSON file (--output) with one record per (stage, nodes);
+# --compare OLD.json prints the ratio to an earlier run and exits non-zero when
+# any stage's fastest run got slower by more than --tolerance.
+#
+# Profiling is switched on from the environment and never touches the timed
+# runs; each stage gets one extra, untimed run under the profiler:
+#   BENCH_CPROFILE=DIR     write DIR/<stage>-<nodes>.prof (open with pstats
+#                          or snakeviz) and record the top functions
+#   BENCH_TRACEMALLOC=1    record peak traced memory and the top allocation
+#                          sites of the run
+
+results_schema = 1
+
+# Largest node count each stage runs at; None means --max-nodes
+stage_limits = {
+    'page.parse': 10_000,
+    'page.soup': 100,
+    'page.fetch': 1_000,
+    'score.scalar': 100_000,
+    'score.incremental': 100_000,
+    'score.batch': None,
+    'fetch.collector': 100,
+    'worker.assess': 1,
+}
+
+
+# Function to call `fn` until it has run `min_repeat` times and for at least
+# `min_seconds`; returns the sorted per-call times in seconds
+def measure(fn, min_repeat=3, min_seconds=0.2, max_repeat=1000):
+    fn()  # warm-up: imports, caches, connections
+    times = []
+    started = time.perf_counter()
+    while len(times) < max_repeat and (len(times) < min_repeat or time.perf_counter() - started < min_seconds):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    times.sort()
+    return times
+
+
+# Function to run `fn` once under whichever profilers the environment asks
+# for and return what they found, to be stored with the stage's timings
+def profile(fn, label):
+    found = {}
+    profile_dir = os.environ.get('BENCH_CPROFILE')
+    if profile_dir:
+        os.makedirs(profile_dir, exist_ok=True)
+        profiler = cProfile.Profile()
+        profiler.runcall(fn)
+        path = os.path.join(profile_dir, f"{label}.prof")
+        profiler.dump_stats(path)
+        stats = pstats.Stats(profiler, stream=io.StringIO()).sort_stats('cumulative')
+        found['cprofile'] = path
+        found['top_functions'] = [
+            {'function': f"{os.path.basename(file)}:{line}({name})", 'calls': calls, 'cumulative_s': cumulative}
+            for (file, line, name), (prim, calls, total, cumulative, callers) in
+            sorted(stats.stats.items(), key=lambda item: -item[1][3])[:10]
+        ]
+    if os.environ.get('BENCH_TRACEMALLOC'):
+        tracemalloc.start()
+        try:
+            fn()
+            current, peak = tracemalloc.get_traced_memory()
+            snapshot = tracemalloc.take_snapshot()
+        finally:
+            tracemalloc.stop()
+        found['peak_bytes'] = peak
+        found['top_allocations'] = [
+            {'site': f"{os.path.basename(stat.traceback[0].filename)}:{stat.traceback[0].lineno}",
+             'bytes': stat.size, 'blocks': stat.count}
+            for stat in snapshot.statistics('lineno')[:10]
+        ]
+    return found
+
+
+# Stage factories: each takes the node count (and an ExitStack for anything
+# that must be shut down) and returns the callable to time
+
+def stage_page_parse(n_nodes, resources):
+    pages = [synthetic_page(filler=20, values=(553 + i % 7, 4, 25, 60, 35, 10)) for i in range(n_nodes)]
+    return lambda: [parse_sensor_values(html) for html in pages]
+
+
+def stage_page_soup(n_nodes, resources):
+    try:
+        import bs4  # noqa: F401
+    except ImportError:
+        return None
+    pages = [synthetic_page(filler=20, values=(553 + i % 7, 4, 25, 60, 35, 10)) for i in range(n_nodes)]
+    return lambda: [soup_sensor_values(html) for html in pages]
+
+
+def stage_page_fetch(n_nodes, resources):
+    directory = resources.enter_context(tempfile.TemporaryDirectory(prefix='aquiferst-bench-'))
+    paths = []
+    for i in range(n_nodes):
+        paths.append(os.path.join(directory, f"node-{i}.html"))
+        with open(paths[-1], 'w', encoding='utf-8') as f:
+            f.write(synthetic_page(filler=20, values=(553 + i % 7, 4, 25, 60, 35, 10)))
+    return lambda: [fetch_sensor_data(path) for path in paths]
+
+
+def stage_score_scalar(n_nodes, resources):
+    batch = [unflatten_sensor_data(row) for row in synthetic_readings(n_nodes).tolist()]
+    return lambda: [assess_soil_health(sensor_data, ideal_thresholds) for sensor_data in batch]
+
+
+# The dict inputs are built before timing, as for the scalar stage: two
+# batches that differ in one variable of a tenth of the nodes, scored in
+# turn, so every cycle has the same tenth changed
+def stage_score_incremental(n_nodes, resources):
+    readings = synthetic_readings(n_nodes)
+    rng = np.random.default_rng(1)
+    n_changing = max(1, n_nodes // 10)
+    first = [unflatten_sensor_data(row) for row in readings.tolist()]
+    rows = rng.choice(n_nodes, n_changing, replace=False)
+    readings[rows, rng.integers(0, readings.shape[1], n_changing)] += rng.uniform(-5, 5, n_changing)
+    second = list(first)
+    for row in rows.tolist():
+        second[row] = unflatten_sensor_data(readings[row].tolist())
+    batches = itertools.cycle([first, second])
+    scorer = IncrementalScorer()
+
+    def cycle():
+        for node, sensor_data in enumerate(next(batches)):
+            scorer.assess(node, sensor_data)
+    return cycle
+
+
+def stage_score_batch(n_nodes, resources):
+    readings = synthetic_readings(n_nodes)
+    return lambda: score_batch(readings)
+
+
+def stage_fetch_collector(n_nodes, resources):
+    from esp32_collector import ESP32Collector
+    from fake_esp32 import FakeESP32Server
+
+    server = FakeESP32Server()
+    server.start()
+    resources.callback(server.stop)
+    collector = resources.enter_context(
+        ESP32Collector({f"node-{i}": server.node_url(i) for i in range(n_nodes)}, max_in_flight=min(n_nodes, 64))
+    )
+    return collector.collect
+
+
+def stage_worker_assess(n_nodes, resources):
+    from fake_esp32 import FakeESP32Server
+
+    server = FakeESP32Server()
+    server.start()
+    resources.callback(server.stop)
+    here = os.path.dirname(os.path.abspath(__file__))
+    env = {key: value for key, value in os.environ.items() if key != 'SENSOR_STORE'}
+    env['ESP32_IP'] = server.base_url
+    worker = subprocess.Popen(
+        [sys.executable, '-u', os.path.join(here, 'scoring_worker.py')],
+        env=env, stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True,
+    )
+
+    def stop():
+        worker.stdin.close()
+        worker.wait()
+    resources.callback(stop)
+
+    def cycle():
+        worker.stdin.write('{"id": 1, "method": "assess"}\n')
+        worker.stdin.flush()
+        response = json.loads(worker.stdout.readline())
+        if 'error' in response:
+            raise RuntimeError(response['error'])
+    return cycle
+
+
+stages = {
+    'page.parse': stage_page_parse,
+    'page.soup': stage_page_soup,
+    'page.fetch': stage_page_fetch,
+    'score.scalar': stage_score_scalar,
+    'score.incremental': stage_score_incremental,
+    'score.batch': stage_score_batch,
+    'fetch.collector': stage_fetch_collector,
+    'worker.assess': stage_worker_assess,
+}
+
+
+# Function to identify the code being measured, so result files can be told apart
+def code_version():
+    try:
+        return subprocess.run(['git', 'describe', '--always', '--dirty'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+# Function to run the selected stages and return the results document
+def run(selected=None, max_nodes=1_000_000, min_seconds=0.2):
+    results = []
+    sizes = [10 ** exponent for exponent in range(len(str(max_nodes)))]
+    sizes = [size for size in sizes if size <= max_nodes]
+    print(f"{'stage':>18} {'nodes':>8} {'runs':>5} {'median ms':>10} {'p95 ms':>10} {'us/node':>10}")
+    for name in selected or stages:
+        limit = stage_limits[name] or max_nodes
+        for n_nodes in sizes:
+            if n_nodes > limit:
+                break
+            with contextlib.ExitStack() as resources:
+                fn = stages[name](n_nodes, resources)
+                if fn is None:
+                    print(f"{name:>18} skipped: missing optional dependency")
+                    break
+                times = measure(fn, min_seconds=min_seconds)
+                record = {
+                    'stage': name,
+                    'nodes': n_nodes,
+                    'runs': len(times),
+                    'median_s': times[len(times) // 2],
+                    'p95_s': times[min(len(times) - 1, int(len(times) * 0.95))],
+                    'min_s': times[0],
+                }
+                record['per_node_us'] = record['median_s'] / n_nodes * 1e6
+                record.update(profile(fn, f"{name}-{n_nodes}"))
+            results.append(record)
+            print(f"{name:>18} {n_nodes:>8} {record['runs']:>5} {record['median_s'] * 1000:>10.3f} "
+                  f"{record['p95_s'] * 1000:>10.3f} {record['per_node_us']:>10.2f}"
+                  + (f"  peak {record['peak_bytes'] / 1e6:.1f} MB" if 'peak_bytes' in record else ''))
+    return {
+        'schema': results_schema,
+        'created': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'version': code_version(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'results': results,
+    }
+
+
+# Function to print how `new` compares to `old`, stage by stage. Returns the
+# (stage, nodes) pairs whose fastest run got slower by more than `tolerance`;
+# the fastest run is compared because it is the least disturbed by noise.
+def compare(old, new, tolerance=0.10):
+    before = {(record['stage'], record['nodes']): record for record in old['results']}
+    regressions = []
+    print(f"\n{old.get('version')} -> {new.get('version')}")
+    print(f"{'stage':>18} {'nodes':>8} {'old min ms':>10} {'new min ms':>10} {'ratio':>7}")
+    for record in new['results']:
+        key = (record['stage'], record['nodes'])
+        if key not in before:
+            continue
+        ratio = record['min_s'] / before[key]['min_s']
+        flag = ''
+        if ratio > 1 + tolerance:
+            regressions.append(key)
+            flag = '  REGRESSION'
+        print(f"{key[0]:>18} {key[1]:>8} {before[key]['min_s'] * 1000:>10.3f} "
+              f"{record['min_s'] * 1000:>10.3f} {ratio:>6.2f}x{flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the read -> parse -> score pipeline offline.')
+    parser.add_argument('--stages', nargs='+', choices=list(stages), help='stages to run (default: all)')
+    parser.add_argument('--max-nodes', type=int, default=1_000_000)
+    parser.add_argument('--min-seconds', type=float, default=0.2, help='minimum timed seconds per measurement')
+    parser.add_argument('--output', default='bench_results.json', help='results file to write')
+    parser.add_argument('--compare', metavar='OLD_JSON', help='earlier results file to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.10,
+                        help='slow-down, as a fraction, reported as a regression by --compare')
+    args = parser.parse_args()
+
+    document = run(args.stages, args.max_nodes, args.min_seconds)
+    with open(args.output, 'w') as f:
+        json.dump(document, f, indent=1)
+    print(f"results written to {args.output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            old = json.load(f)
+        if compare(old, document, args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
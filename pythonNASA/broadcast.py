@@ -0,0 +1,211 @@
+import argparse
+import json
+import os
+import threading
+import time
+
+# Server-sent events fan-out for dashboards.
+#
+# Every change is encoded once as an SSE frame and appended to a fixed-size
+# ring shared by all subscribers. A subscriber is only a cursor into the
+# ring: each connection's thread waits on one condition, copies the frames
+# past its cursor and writes them to its socket. Publishing never waits for a
+# subscriber. A client too slow to keep up falls off the end of the ring and
+# gets a single `resync` event instead of its backlog; it should then refetch
+# the full state (/sensor-data or /nodes/scores) and carry on from the newest
+# frame. Browsers reconnecting with Last-Event-ID resume where they left off
+# when the ring still holds that frame.
+
+heartbeat_seconds = 15.0
+resync_frame = b'event: resync\ndata: {}\n\n'
+heartbeat_frame = b': keep-alive\n\n'
+
+
+class BroadcastRing:
+    def __init__(self, capacity=4096):
+        self.capacity = capacity
+        self.frames = [None] * capacity  # (node id, frame bytes) by sequence % capacity
+        self.next_seq = 1                # sequence number of the next frame
+        self.condition = threading.Condition()
+        self.subscribers = 0
+        self.resyncs = 0
+
+    # Append one event for `node_id`; `data` is JSON-serialisable
+    def publish(self, node_id, data, event='score'):
+        body = json.dumps(data, separators=(',', ':'))
+        with self.condition:
+            seq = self.next_seq
+            frame = f'id: {seq}\nevent: {event}\ndata: {body}\n\n'.encode('utf-8')
+            self.frames[seq % self.capacity] = (node_id, frame)
+            self.next_seq = seq + 1
+            self.condition.notify_all()
+        return seq
+
+    # Wait up to `timeout` for frames after `cursor` and return
+    # (new cursor, frames). Only frames for `node_id` are returned, or every
+    # frame when node_id is None. A cursor older than the ring yields
+    # [resync_frame] and jumps to the newest frame.
+    def read(self, cursor, node_id=None, timeout=heartbeat_seconds):
+        with self.condition:
+            if cursor >= self.next_seq:
+                self.condition.wait(timeout)
+            head = self.next_seq
+            if head - cursor > self.capacity:
+                self.resyncs += 1
+                return head, [resync_frame]
+            entries = [self.frames[seq % self.capacity] for seq in range(cursor, head)]
+        if node_id is None:
+            return head, [frame for node, frame in entries]
+        return head, [frame for node, frame in entries if node == node_id]
+
+    # Cursor for a new subscriber: the frame after `last_event_id` if the ring
+    # still has it, otherwise only new frames
+    def cursor_after(self, last_event_id=None):
+        with self.condition:
+            head = self.next_seq
+            try:
+                resume = int(last_event_id) + 1
+            except (TypeError, ValueError):
+                return head
+            return resume if head - self.capacity < resume <= head else head
+
+    # Yield SSE bytes for one connection until the client goes away. The
+    # caller's server closes the generator when a write fails.
+    def stream(self, node_id=None, last_event_id=None):
+        cursor = self.cursor_after(last_event_id)
+        with self.condition:
+            self.subscribers += 1
+        try:
+            yield b'retry: 3000\n\n'
+            while True:
+                cursor, frames = self.read(cursor, node_id)
+                if frames:
+                    yield b''.join(frames)
+                else:
+                    yield heartbeat_frame
+        finally:
+            with self.condition:
+                self.subscribers -= 1
+
+
+# Function to read this process's resident memory in bytes (Linux only)
+def resident_bytes():
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) * 1024
+    return 0
+
+
+# Client side of the benchmark: hold `n` SSE connections from one process and
+# record, for each event, when the last subscriber received it. Stops once
+# every subscriber has `n_events` events, or after `stop_after` seconds.
+def _subscribers(port, n, ready, results, n_events, stop_after):
+    import selectors
+    import socket
+
+    selector = selectors.DefaultSelector()
+    for i in range(n):
+        sock = socket.create_connection(('127.0.0.1', port))
+        sock.sendall(b'GET /events?node=* HTTP/1.1\r\nHost: localhost\r\nAccept: text/event-stream\r\n\r\n')
+        sock.setblocking(False)
+        selector.register(sock, selectors.EVENT_READ, bytearray())
+        if i % 100 == 99:
+            time.sleep(0.05)  # stay inside the listen backlog
+    ready.set()
+
+    last_seen = {}  # sequence -> (published at, received by the last subscriber, count)
+    deadline = time.monotonic() + stop_after
+    delivered = 0
+    while time.monotonic() < deadline and delivered < n * n_events:
+        for key, mask in selector.select(timeout=0.5):
+            try:
+                data = key.fileobj.recv(65536)
+            except BlockingIOError:
+                continue
+            now = time.time()
+            buffer = key.data
+            buffer += data
+            while True:
+                marker = buffer.find(b'"t":')
+                if marker < 0:
+                    break
+                end = buffer.find(b'}', marker)
+                if end < 0:
+                    break
+                seq_start = buffer.rfind(b'id: ', 0, marker)
+                seq = int(buffer[seq_start + 4:buffer.find(b'\n', seq_start)]) if seq_start >= 0 else -1
+                published = float(buffer[marker + 4:end])
+                first, last, count = last_seen.get(seq, (published, now, 0))
+                last_seen[seq] = (published, max(last, now), count + 1)
+                delivered += 1
+                del buffer[:end + 1]
+    results.put({seq: (published, last, count) for seq, (published, last, count) in last_seen.items()})
+    for key in list(selector.get_map().values()):
+        key.fileobj.close()
+
+
+def benchmark(n_subscribers=1000, n_events=50, interval=0.1):
+    import multiprocessing
+    from werkzeug.serving import WSGIRequestHandler, make_server
+    from flask import Flask, Response, request
+
+    ring = BroadcastRing()
+    app = Flask(__name__)
+
+    @app.route('/events')
+    def events():
+        node = request.args.get('node')
+        return Response(ring.stream(None if node == '*' else node), mimetype='text/event-stream')
+
+    class QuietHandler(WSGIRequestHandler):
+        def log_request(self, *args):
+            pass
+
+    server = make_server('127.0.0.1', 0, app, threaded=True, request_handler=QuietHandler)
+    server.socket.listen(1024)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    rss_before = resident_bytes()
+    context = multiprocessing.get_context('spawn')
+    ready, results = context.Event(), context.Queue()
+    client = context.Process(target=_subscribers, args=(server.server_port, n_subscribers, ready, results,
+                                                        n_events, 30 + n_events * interval))
+    client.start()
+    ready.wait()
+    while ring.subscribers < n_subscribers:
+        time.sleep(0.05)
+    time.sleep(0.5)
+    rss_idle = resident_bytes()
+    print(f"{ring.subscribers} idle subscribers: server RSS +{(rss_idle - rss_before) / 1e6:.1f} MB, "
+          f"{(rss_idle - rss_before) / n_subscribers / 1024:.1f} KB per connection "
+          f"(one thread each; {threading.active_count()} threads)")
+
+    for i in range(n_events):
+        ring.publish(f"probe-{i % 10}", {'node': f"probe-{i % 10}", 'score': 0.5, 'suggestions': [], 't': time.time()})
+        time.sleep(interval)
+    received = results.get()
+    client.join()
+    server.shutdown()
+
+    complete = [(last - published) for published, last, count in received.values() if count == n_subscribers]
+    complete.sort()
+    if not complete:
+        print("no event reached every subscriber")
+        return
+    print(f"{len(complete)}/{n_events} events reached all {n_subscribers} subscribers; time until the last "
+          f"one had it: p50 {complete[len(complete) // 2] * 1000:.1f} ms, "
+          f"p99 {complete[min(len(complete) - 1, int(len(complete) * 0.99))] * 1000:.1f} ms")
+    print(f"slow-client resyncs: {ring.resyncs}; CPUs: {os.cpu_count()}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark server-sent event fan-out.')
+    parser.add_argument('--subscribers', type=int, default=1000)
+    parser.add_argument('--events', type=int, default=50)
+    args = parser.parse_args()
+    benchmark(args.subscribers, args.events)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,274 @@
+import argparse
+import functools
+import json
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from metrics import (
+    breaker_skips,
+    cycle_seconds,
+    fetch_failures,
+    fetch_seconds,
+    hedged_requests,
+    readings_dropped,
+    stale_values,
+)
+from readings import ReadingBatch
+from resilient_fetch import CircuitBreaker, LastGoodValues, hedged_call
+from soil_health import (
+    assess_soil_health,
+    esp32_sensors,
+    format_esp32_readings,
+    ideal_thresholds,
+    parse_esp32_value,
+)
+
+logger = logging.getLogger(__name__)
+
+
+# Function to load a node registry: a JSON object mapping node id -> ESP32 base URL
+def load_node_registry(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        registry = json.load(f)
+    return {str(node_id): url.rstrip('/') for node_id, url in registry.items()}
+
+
+# Polls a whole registry of ESP32 probes concurrently.
+#
+# Each node is handled by one worker thread that reads its endpoints back to
+# back over a pooled keep-alive connection, so a poll costs one TCP handshake
+# per node instead of one per sensor. `max_in_flight` bounds how many nodes
+# are being talked to at once, `node_deadline` bounds the total time spent on
+# any single node, and a dead probe only ever costs its own worker slot.
+#
+# Probes that send an ETag are polled conditionally (If-None-Match); a 304
+# reuses the value parsed last time, and a node whose endpoints all answered
+# 304 is reported in the batch as unchanged so callers can skip re-scoring it.
+#
+# Failing probes are contained with the pieces in resilient_fetch.py:
+#   - a circuit breaker per node opens after `breaker_threshold` unreachable
+#     cycles in a row, and the node is skipped (no request, no timeout) until
+#     its exponential backoff expires; None disables breakers
+#   - a sensor request that has not answered after `hedge_after` seconds is
+#     sent again and the first answer wins; None disables hedging
+#   - a sensor that cannot be read (unreachable, skipped, or garbage text) is
+#     filled in from its last good value if that is at most `max_stale`
+#     seconds old, and reported in the batch's 'stale'; otherwise it is None
+class ESP32Collector:
+    def __init__(self, nodes, max_in_flight=64, node_deadline=5.0, connect_timeout=1.0,
+                 breaker_threshold=3, hedge_after=0.5, max_stale=3600.0):
+        self.nodes = dict(nodes)
+        self.max_in_flight = max_in_flight
+        self.node_deadline = node_deadline
+        self.connect_timeout = connect_timeout
+        self.breaker_threshold = breaker_threshold
+        self.hedge_after = hedge_after
+        self.breakers = {}  # node id -> CircuitBreaker
+        self.last_good = LastGoodValues(max_stale)
+
+        # One shared session: the adapter keeps a keep-alive pool per host
+        # and urllib3 pools are safe to share between threads. Pools only open
+        # connections on demand, so sizing them for the worst case (every
+        # worker on one host, e.g. a gateway in front of many probes) is free.
+        self.session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=max(len(self.nodes), 1),
+            pool_maxsize=2 * max_in_flight,
+            max_retries=0,
+        )
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.executor = ThreadPoolExecutor(max_workers=max_in_flight, thread_name_prefix='esp32')
+        # Requests themselves run here so a slow one can be hedged; up to two
+        # attempts per node in flight
+        self.requests = ThreadPoolExecutor(max_workers=2 * max_in_flight, thread_name_prefix='esp32-request')
+        self.etags = {}  # (node id, sensor) -> (etag, parsed value)
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        self.requests.shutdown(wait=False, cancel_futures=True)
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    # Fetch every sensor of one node, giving up once the node deadline passes.
+    # Returns (node_id, raw, error, unchanged, reachable): `raw` holds None
+    # for every sensor not read, `unchanged` is True when every endpoint
+    # answered 304 Not Modified and `reachable` is False when the node could
+    # not be talked to at all.
+    def fetch_node(self, node_id, base_url):
+        started = time.monotonic()
+        deadline = started + self.node_deadline
+        raw = {sensor: None for sensor in esp32_sensors}
+        error = None
+        not_modified = 0
+        answered = 0
+
+        for sensor in esp32_sensors:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                error = f"deadline of {self.node_deadline}s exceeded"
+                break
+            cached = self.etags.get((node_id, sensor))
+            headers = {'If-None-Match': cached[0]} if cached else None
+            try:
+                # Bound now: a hedge may still be running after this loop has
+                # moved on to the next sensor
+                response, hedged = hedged_call(
+                    self.requests,
+                    functools.partial(
+                        self.session.get,
+                        f"{base_url}/{sensor}",
+                        headers=headers,
+                        timeout=(min(self.connect_timeout, remaining), remaining),
+                    ),
+                    self.hedge_after,
+                    remaining,
+                )
+                if hedged:
+                    hedged_requests.inc()
+                answered += 1
+                if response.status_code == 304 and cached:
+                    raw[sensor] = cached[1]
+                    not_modified += 1
+                    continue
+                response.raise_for_status()
+                raw[sensor] = parse_esp32_value(sensor, response.text)
+                etag = response.headers.get('ETag')
+                if etag:
+                    self.etags[(node_id, sensor)] = (etag, raw[sensor])
+                else:
+                    self.etags.pop((node_id, sensor), None)
+            except (requests.exceptions.RequestException, TimeoutError) as e:
+                error = f"{sensor}: {e or 'timed out'}"
+                # An unreachable node will not answer the next endpoint either
+                if not isinstance(e, requests.exceptions.HTTPError):
+                    break
+
+        fetch_seconds.observe(time.monotonic() - started, (node_id,))
+        if error:
+            fetch_failures.inc(1, (node_id,))
+        return node_id, raw, error, not_modified == len(esp32_sensors), answered > 0
+
+    # Run one poll cycle over the whole registry (or only `node_ids`) and
+    # return a single batch.
+    #
+    # The batch is a dict with:
+    #   'started'  - wall-clock time the cycle began
+    #   'duration' - seconds the cycle took
+    #   'readings' - node id -> sensor data in the assess_soil_health format
+    #   'raw'      - node id -> {sensor: float or None} as read from the probe
+    #   'errors'   - node id -> description of the first failure, if any
+    #   'unchanged' - ids of nodes whose endpoints all answered 304
+    #   'stale'    - node id -> {sensor: age in seconds} for sensors in
+    #                'readings' served from their last good value
+    #   'skipped'  - node id -> seconds until its open breaker lets a probe
+    #                through; these nodes were not contacted
+    #   'packed'   - 'readings' as a ReadingBatch stamped with 'started', for
+    #                batch scoring (batch_scoring.score_batch takes it as is)
+    # Readings in 'raw' are always fresh (None if not read); only 'readings'
+    # and 'packed' carry stale values.
+    def collect(self, node_ids=None):
+        nodes = self.nodes if node_ids is None else {node_id: self.nodes[node_id] for node_id in node_ids}
+        started = time.time()
+        start = time.monotonic()
+        batch = {'started': started, 'duration': 0.0, 'readings': {}, 'raw': {}, 'errors': {}, 'unchanged': set(),
+                 'stale': {}, 'skipped': {}}
+        futures = []
+        for node_id, base_url in nodes.items():
+            breaker = self.breakers.get(node_id)
+            if breaker is not None and not breaker.allow(start):
+                batch['skipped'][node_id] = breaker.retry_in(start)
+                breaker_skips.inc(1, (node_id,))
+                self.record(batch, node_id, {sensor: None for sensor in esp32_sensors},
+                            f"circuit open, next probe in {batch['skipped'][node_id]:.0f}s")
+                continue
+            futures.append(self.executor.submit(self.fetch_node, node_id, base_url))
+
+        # Nodes only start their own deadline when a worker picks them up, so
+        # the cycle as a whole may need several deadline "waves".
+        waves = -(-len(futures) // self.max_in_flight) if futures else 0
+        done, not_done = wait(futures, timeout=waves * (self.node_deadline + self.connect_timeout) + 1.0)
+
+        for future in done:
+            node_id, raw, error, unchanged, reachable = future.result()
+            self.record(batch, node_id, raw, error)
+            if not error and unchanged:
+                batch['unchanged'].add(node_id)
+            if self.breaker_threshold is not None:
+                breaker = self.breakers.get(node_id)
+                if reachable:
+                    if breaker is not None:
+                        breaker.record_success()
+                else:
+                    if breaker is None:
+                        breaker = self.breakers[node_id] = CircuitBreaker(self.breaker_threshold)
+                    breaker.record_failure()
+        for future in not_done:
+            future.cancel()
+        for node_id in nodes:
+            if node_id not in batch['raw']:
+                self.record(batch, node_id, {sensor: None for sensor in esp32_sensors}, 'cycle deadline exceeded')
+        if not_done:
+            readings_dropped.inc(len(not_done), ('cycle_deadline',))
+
+        packed = batch['packed'] = ReadingBatch(len(batch['readings']))
+        for node_id, sensor_data in batch['readings'].items():
+            packed.append(node_id, started, sensor_data)
+
+        batch['duration'] = time.monotonic() - start
+        cycle_seconds.observe(batch['duration'], ('collector',))
+        return batch
+
+    # Add one node's result to a batch, filling unread sensors from their
+    # last good values
+    def record(self, batch, node_id, raw, error):
+        batch['raw'][node_id] = raw
+        filled, stale = self.last_good.fill(node_id, raw)
+        batch['readings'][node_id] = format_esp32_readings(filled)
+        if stale:
+            batch['stale'][node_id] = stale
+            stale_values.inc(len(stale), (node_id,))
+        if error:
+            batch['errors'][node_id] = error
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Poll a registry of ESP32 probes concurrently.')
+    parser.add_argument('registry', help='JSON file mapping node id to ESP32 base URL')
+    parser.add_argument('--interval', type=float, default=10.0, help='seconds between poll cycles')
+    parser.add_argument('--max-in-flight', type=int, default=64)
+    parser.add_argument('--node-deadline', type=float, default=5.0)
+    parser.add_argument('--once', action='store_true', help='run a single cycle and exit')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    nodes = load_node_registry(args.registry)
+
+    with ESP32Collector(nodes, args.max_in_flight, args.node_deadline) as collector:
+        while True:
+            batch = collector.collect()
+            logger.info(
+                f"Polled {len(nodes)} nodes in {batch['duration']:.2f}s "
+                f"({len(batch['errors'])} with errors)"
+            )
+            for node_id, sensor_data in sorted(batch['readings'].items()):
+                total_score, suggestions = assess_soil_health(sensor_data, ideal_thresholds)
+                logger.info(f"{node_id}: Soil Health Score {total_score:.2f} ({len(suggestions)} suggestions)")
+            for node_id, error in sorted(batch['errors'].items()):
+                logger.warning(f"{node_id}: {error}")
+            if args.once:
+                break
+            time.sleep(max(0.0, args.interval - batch['duration']))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,233 @@
+import argparse
+import random
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from sensor_page import synthetic_element_page
+from wire_format import encode_packet, media_type
+
+# Local stand-in for a field of ESP32 ground probes.
+# A single server emulates many nodes: node N answers under /node/N/<sensor>,
+# and /<sensor> without a prefix behaves like a lone probe. /page (or
+# /node/N/page) serves all of a node's readings as one HTML page in the
+# element-id layout Python1.py scrapes. /readings?since=<seq> serves the
+# node's buffered samples newer than `since` as a binary packet
+# (wire_format.py), like the GroundSensorCode_v3 firmware.
+
+# Readings served when a node has no explicit values configured
+default_values = {
+    'temperature': 21.5,
+    'humidity': 60.0,
+    'moisture': 30.0
+}
+
+
+class FakeESP32Handler(BaseHTTPRequestHandler):
+    # Keep-alive like the ESPAsyncWebServer so clients can pool connections.
+    # Headers and body go out as separate writes, so Nagle must be off or
+    # every keep-alive response stalls on the client's delayed ACK.
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        fleet = self.server.fleet
+        path, _, query = self.path.partition('?')
+        parts = [part for part in path.split('/') if part]
+        if len(parts) == 3 and parts[0] == 'node':
+            node_id, sensor = parts[1], parts[2]
+        elif len(parts) == 1:
+            node_id, sensor = None, parts[0]
+        else:
+            self.send_text(404, 'Not found')
+            return
+
+        fleet.request_count += 1
+        delay = fleet.latency_for(node_id)
+        if delay:
+            time.sleep(delay)
+
+        if sensor == 'readings':
+            since = query.partition('since=')[2].partition('&')[0]
+            self.send_bytes(200, fleet.packet_for(node_id, int(since) if since.isdigit() else None))
+            return
+        value = fleet.page_for(node_id) if sensor == 'page' else fleet.value_for(node_id, sensor)
+        if value is not None and node_id in fleet.garbage_nodes:
+            value = 'nan\x00ERR'  # what a probe with a failing sensor bus sends
+        if value is None:
+            self.send_text(404, 'Not found')
+        elif fleet.etags:
+            etag = f'"{zlib.crc32(value.encode("utf-8")):08x}"'
+            if self.headers.get('If-None-Match') == etag:
+                fleet.not_modified_count += 1
+                self.send_text(304, '', etag)
+            else:
+                self.send_text(200, value, etag)
+        else:
+            self.send_text(200, value)
+
+    def send_text(self, status, text, etag=None):
+        body = text.encode('utf-8')
+        self.send_response(status)
+        if etag:
+            self.send_header('ETag', etag)
+        if status != 304:
+            self.send_header('Content-Type', 'text/plain')
+            self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if not body:
+            return
+        try:
+            self.wfile.write(body)
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # The client gave up on a slow node before we answered
+
+    def send_bytes(self, status, body):
+        self.send_response(status)
+        self.send_header('Content-Type', media_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        try:
+            self.wfile.write(body)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    def log_message(self, format, *args):
+        pass  # Keep benchmark and demo output quiet
+
+
+# Configuration shared by every request handled by one FakeESP32Server
+class FakeFleet:
+    # With `etags`, responses carry an ETag and conditional requests for an
+    # unchanged value get 304 Not Modified. `garbage_nodes` answer with text
+    # that is not a number; a `slow_rate` fraction of requests to any node
+    # takes `slow_latency` extra seconds, like a probe dropping a packet.
+    def __init__(self, latency=0.0, jitter=0.0, dead_nodes=(), dead_latency=30.0, etags=False,
+                 garbage_nodes=(), slow_rate=0.0, slow_latency=1.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.dead_nodes = set(str(node) for node in dead_nodes)
+        self.dead_latency = dead_latency
+        self.garbage_nodes = set(str(node) for node in garbage_nodes)
+        self.slow_rate = slow_rate
+        self.slow_latency = slow_latency
+        self.values = {}  # node_id -> {sensor: text}
+        self.etags = etags
+        self.request_count = 0
+        self.not_modified_count = 0
+        self.samples = {}  # node_id -> [(seq, time, temperature, humidity, moisture)], newest last
+        self.buffer_size = 64
+
+    def latency_for(self, node_id):
+        if node_id in self.dead_nodes:
+            return self.dead_latency
+        latency = self.latency
+        if self.jitter:
+            latency += random.uniform(0, self.jitter)
+        if self.slow_rate and random.random() < self.slow_rate:
+            latency += self.slow_latency
+        return latency
+
+    def value_for(self, node_id, sensor):
+        node_values = self.values.get(node_id, {})
+        if sensor in node_values:
+            return node_values[sensor]
+        if sensor in default_values:
+            return str(default_values[sensor])
+        return None
+
+    # HTML page with every reading of a node; the ESP32 has no NPK sensor, so
+    # those are the placeholders format_esp32_readings uses
+    def page_for(self, node_id):
+        return synthetic_element_page(values=(50.0, 30.0, 25.0, self.value_for(node_id, 'humidity'),
+                                              self.value_for(node_id, 'temperature'),
+                                              self.value_for(node_id, 'moisture')))
+
+    # `node_id` None sets the value served to un-prefixed (lone probe) requests.
+    # Every change is also buffered as a new sample for /readings.
+    def set_value(self, node_id, sensor, text):
+        key = None if node_id is None else str(node_id)
+        self.values.setdefault(key, {})[sensor] = text
+        self.sample(key)
+
+    # Buffer the node's current values as its next sample, keeping the last
+    # `buffer_size` like the firmware's ring buffer
+    def sample(self, node_id):
+        samples = self.samples.setdefault(node_id, [])
+        values = []
+        for sensor in ('temperature', 'humidity', 'moisture'):
+            try:
+                values.append(float(self.value_for(node_id, sensor)))
+            except (TypeError, ValueError):
+                values.append(None)
+        samples.append((samples[-1][0] + 1 if samples else 1, int(time.time()), *values))
+        del samples[:-self.buffer_size]
+
+    # Binary packet of the node's samples newer than `since` (all of them
+    # when `since` is None or ahead of the newest, i.e. the node restarted)
+    def packet_for(self, node_id, since=None):
+        if node_id not in self.samples:
+            self.sample(node_id)
+        samples = self.samples[node_id]
+        if since is not None and since <= samples[-1][0]:
+            samples = [sample for sample in samples if sample[0] > since]
+        wire_id = int(node_id) if node_id and node_id.isdigit() else zlib.crc32(str(node_id).encode('utf-8'))
+        return encode_packet(wire_id, samples)
+
+
+class FakeESP32Server(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def __init__(self, fleet=None, host='127.0.0.1', port=0):
+        self.fleet = fleet or FakeFleet()
+        super().__init__((host, port), FakeESP32Handler)
+
+    @property
+    def base_url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    # Base URL a collector should use for emulated node `node_id`
+    def node_url(self, node_id):
+        return f"{self.base_url}/node/{node_id}"
+
+    # Serve in a background thread; returns the thread so callers can join it
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return thread
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve fake ESP32 sensor endpoints.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every response')
+    parser.add_argument('--jitter', type=float, default=0.0, help='random extra latency, in seconds')
+    parser.add_argument('--dead', nargs='*', default=[], help='node ids that never answer in time')
+    parser.add_argument('--etags', action='store_true', help='send ETags and answer If-None-Match with 304')
+    parser.add_argument('--garbage', nargs='*', default=[], help='node ids that answer with non-numeric text')
+    parser.add_argument('--slow-rate', type=float, default=0.0, help='fraction of requests delayed by --slow-latency')
+    parser.add_argument('--slow-latency', type=float, default=1.0)
+    args = parser.parse_args()
+
+    fleet = FakeFleet(latency=args.latency, jitter=args.jitter, dead_nodes=args.dead, etags=args.etags,
+                      garbage_nodes=args.garbage, slow_rate=args.slow_rate, slow_latency=args.slow_latency)
+    server = FakeESP32Server(fleet, args.host, args.port)
+    print(f"Fake ESP32 fleet listening on {server.base_url} (nodes under /node/<id>)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
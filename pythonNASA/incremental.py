@@ -0,0 +1,217 @@
+import argparse
+import hashlib
+import os
+import time
+
+from soil_health import (
+    assess_soil_health,
+    flatten_sensor_data,
+    flatten_thresholds,
+    ideal_thresholds,
+    recommend_variable,
+    sensor_columns,
+    unflatten_sensor_data,
+)
+
+# Change-driven scoring: skip work when inputs have not changed.
+#
+# FileChangeDetector decides cheaply whether a sensor page such as please.html
+# needs re-parsing: an unchanged stat() means no read at all, and a changed
+# stat() with identical content (e.g. the file was rewritten with the same
+# readings) is caught by a content hash. ESP32 endpoints get the same treatment
+# in ESP32Collector through ETag / If-None-Match.
+#
+# IncrementalScorer keeps the last reading, per-variable scores and
+# recommendation records of every node, and only re-scores the variables whose
+# value moved. Results are identical to assess_soil_health on the same reading;
+# suggestion text is rendered from the records only when asked for.
+
+
+# Tracks one file by (mtime, size) and, when those move, by content hash
+class FileChangeDetector:
+    def __init__(self, path):
+        self.path = path
+        self.stat_key = None
+        self.digest = None
+        self.content = None
+        self.checks = 0
+        self.reads = 0
+        self.changes = 0
+
+    # Return (changed, content). Content is the file text, re-read only when
+    # the file's mtime or size moved.
+    def check(self):
+        self.checks += 1
+        st = os.stat(self.path)
+        stat_key = (st.st_mtime_ns, st.st_size)
+        if stat_key == self.stat_key:
+            return False, self.content
+
+        with open(self.path, 'rb') as f:
+            data = f.read()
+        self.reads += 1
+        self.stat_key = stat_key
+        digest = hashlib.blake2b(data, digest_size=16).digest()
+        if digest == self.digest:
+            return False, self.content
+
+        self.digest = digest
+        self.content = data.decode('utf-8')
+        self.changes += 1
+        return True, self.content
+
+
+# Marks a variable that has not been scored yet (None is a missing reading)
+unscored = object()
+
+
+# Cached per-node scoring state
+class NodeState:
+    __slots__ = ('values', 'scores', 'suggestions', 'total_score', 'dirty', 'bands')
+
+    def __init__(self):
+        self.values = [unscored] * len(sensor_columns)
+        self.scores = [None] * len(sensor_columns)
+        self.suggestions = [None] * len(sensor_columns)
+        self.total_score = None
+        self.dirty = False
+        self.bands = None
+
+
+# Function to list a node's recommendations, as records or rendered text
+def suggestion_list(state, structured):
+    if structured:
+        return [s for s in state.suggestions if s]
+    return [s.text for s in state.suggestions if s]
+
+
+class IncrementalScorer:
+    # `tolerances` maps a variable name to the absolute change that still
+    # counts as "unchanged" (default exact). A non-zero tolerance trades exact
+    # agreement with assess_soil_health for fewer re-scores of noisy sensors.
+    def __init__(self, thresholds=ideal_thresholds, soil_volume_m3=1.0, tolerances=None):
+        self.soil_volume_m3 = soil_volume_m3
+        self.tolerances = [
+            (tolerances or {}).get(name, 0.0) for group, name in sensor_columns
+        ]
+        self.nodes = {}
+        self.stats = {
+            'cycles': 0,
+            'cycles_skipped': 0,
+            'variables_scored': 0,
+            'variables_skipped': 0,
+        }
+        self.set_thresholds(thresholds)
+
+    # Replace the thresholds; every node is re-scored on its next reading
+    def set_thresholds(self, thresholds):
+        self.thresholds = thresholds
+        self.bands = flatten_thresholds(thresholds)
+
+    # Score one reading for `node_id` and return (total_score, suggestions),
+    # exactly as assess_soil_health would, re-scoring only changed variables.
+    # With structured=True the suggestions are Recommendation records.
+    # `bands` overrides the scorer's thresholds for this node (six (min, max)
+    # pairs in sensor_columns order, e.g. from a ThresholdTable); a node is
+    # fully re-scored whenever its bands change.
+    def assess(self, node_id, sensor_data, bands=None, structured=False):
+        values = flatten_sensor_data(sensor_data)
+        state = self.nodes.get(node_id)
+        if state is None:
+            state = self.nodes[node_id] = NodeState()
+        bands = self.bands if bands is None else bands
+        if state.bands != bands:
+            state.bands = bands
+            state.values = [unscored] * len(sensor_columns)
+
+        self.stats['cycles'] += 1
+        changed = 0
+        for i, value in enumerate(values):
+            old = state.values[i]
+            if value is None or old is None or old is unscored:
+                if value is old:
+                    continue
+            elif value == old or abs(value - old) <= self.tolerances[i]:
+                continue
+            group, name = sensor_columns[i]
+            ideal_min, ideal_max = bands[i]
+            state.scores[i], state.suggestions[i] = recommend_variable(
+                group, name, value, ideal_min, ideal_max, self.soil_volume_m3
+            )
+            state.values[i] = value
+            changed += 1
+
+        self.stats['variables_scored'] += changed
+        self.stats['variables_skipped'] += len(values) - changed
+        if changed:
+            state.total_score = sum(state.scores) / len(state.scores)
+            state.dirty = True
+        else:
+            self.stats['cycles_skipped'] += 1
+        return state.total_score, suggestion_list(state, structured)
+
+    # Count a cycle that was skipped before any reading was even parsed
+    # (unchanged file, every endpoint answered 304, ...)
+    def skip_cycle(self):
+        self.stats['cycles'] += 1
+        self.stats['cycles_skipped'] += 1
+        self.stats['variables_skipped'] += len(sensor_columns)
+
+    # Return the cached (total_score, suggestions) of a node, or None
+    def result(self, node_id, structured=False):
+        state = self.nodes.get(node_id)
+        if state is None or state.total_score is None:
+            return None
+        return state.total_score, suggestion_list(state, structured)
+
+    # Return and clear the ids of nodes whose result changed since the last call
+    def pop_dirty(self):
+        dirty = [node_id for node_id, state in self.nodes.items() if state.dirty]
+        for node_id in dirty:
+            self.nodes[node_id].dirty = False
+        return dirty
+
+
+def benchmark(n_nodes=1000, cycles=20, change_rate=0.1):
+    import random
+
+    rng = random.Random(0)
+    bands = flatten_sensor_data(ideal_thresholds)
+    readings = [[rng.uniform(lo - (hi - lo), hi + (hi - lo)) for lo, hi in bands] for _ in range(n_nodes)]
+
+    scorer = IncrementalScorer()
+    full_seconds = incremental_seconds = 0.0
+    for cycle in range(cycles):
+        # A fraction of the fleet reports a new value for one variable
+        for node in rng.sample(range(n_nodes), int(n_nodes * change_rate)):
+            readings[node][rng.randrange(len(bands))] += rng.uniform(-5, 5)
+        batch = [unflatten_sensor_data(row) for row in readings]
+
+        start = time.perf_counter()
+        full = [assess_soil_health(sensor_data, ideal_thresholds) for sensor_data in batch]
+        full_seconds += time.perf_counter() - start
+
+        start = time.perf_counter()
+        incremental = [scorer.assess(node, sensor_data) for node, sensor_data in enumerate(batch)]
+        incremental_seconds += time.perf_counter() - start
+
+        if full != incremental:
+            raise AssertionError("incremental results differ from assess_soil_health")
+
+    print(f"{n_nodes} nodes x {cycles} cycles, {change_rate:.0%} of nodes changing per cycle")
+    print(f"full recompute: {full_seconds / cycles * 1000:.2f} ms/cycle")
+    print(f"incremental:    {incremental_seconds / cycles * 1000:.2f} ms/cycle")
+    print(f"stats: {scorer.stats}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark incremental against full re-scoring.')
+    parser.add_argument('--nodes', type=int, default=1000)
+    parser.add_argument('--cycles', type=int, default=20)
+    parser.add_argument('--change-rate', type=float, default=0.1)
+    args = parser.parse_args()
+    benchmark(args.nodes, args.cycles, args.change_rate)
+
+
+if __name__ == "__main__":
+    main()
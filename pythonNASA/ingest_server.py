@@ -0,0 +1,474 @@
+import argparse
+import json
+import logging
+import multiprocessing
+import socket
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+from anomaly import AnomalyDetector
+from batch_scoring import score_batch
+from metrics import content_type, cycle_seconds, queue_depth, readings_dropped, readings_late, registry, score_seconds
+from readings import ReadingBatch
+from soil_health import esp32_sensors, flatten_sensor_data, format_esp32_readings, ideal_thresholds
+from wire_format import WireFormatError, decode_batch, encode_packet, magic, media_type
+
+logger = logging.getLogger(__name__)
+
+# Push ingestion for ESP32 probes, so the server no longer polls every endpoint.
+#
+# Probes (or a gateway in front of them) push newline-delimited JSON, one
+# reading per line:
+#
+#   {"node": "probe-17", "t": 1700000000.5, "temperature": 21.5, "humidity": 60, "moisture": 30}
+#
+# `node` is required; `t` is the reading time in Unix seconds and defaults to
+# the time it was received; the sensor names are the ESP32 endpoint names.
+# Probes can instead push the binary packets of wire_format.py (what the
+# firmware serves on GET /readings), several samples per packet and several
+# packets per body, sent as application/x-aquiferst-readings over HTTP.
+# Transports:
+#   HTTP  POST /ingest with any number of lines or packets; answers 202 with
+#         {"accepted": n, "rejected": m}
+#   UDP   one or more lines, or packets, per datagram, no answer
+#
+# Receivers only parse and enqueue. A bounded queue sits between them and a
+# single batcher thread, which drains it every `batch_interval` seconds (or as
+# soon as `batch_size` readings are waiting) and scores the whole batch at once
+# with batch_scoring.score_batch. An optional anomaly.AnomalyDetector checks
+# the batch first, so stuck or shorted sensors are flagged or quarantined
+# before they are scored. When scoring falls behind, the oldest queued
+# readings are dropped and counted rather than letting memory grow. A batch
+# that fails to score is logged, counted and dropped; the batcher carries on.
+# Nodes that have not reported for `latest_max_age` seconds are forgotten.
+#
+# GET /metrics on the HTTP port returns the process's pipeline metrics
+# (see metrics.py), including queue depth, drops and batch timings.
+
+
+# Function to parse one pushed line into (node_id, timestamp, row, received).
+# Raises ValueError on malformed input.
+def parse_push_line(line, received):
+    record = json.loads(line)
+    if not isinstance(record, dict) or 'node' not in record:
+        raise ValueError("reading has no 'node'")
+    raw = {}
+    for sensor in esp32_sensors:
+        value = record.get(sensor)
+        raw[sensor] = None if value is None else float(value)
+    timestamp = float(record['t']) if record.get('t') is not None else received
+    return str(record['node']), timestamp, flatten_sensor_data(format_esp32_readings(raw)), received
+
+
+# Bounded FIFO between the receivers and the batcher. deque.append and
+# deque.popleft are atomic, so neither side takes a lock; when the queue is
+# full, appending evicts the oldest reading.
+class IngestQueue:
+    def __init__(self, maxlen=100_000):
+        self.items = deque(maxlen=maxlen)
+        self.maxlen = maxlen
+        self.dropped = 0
+        self.ready = threading.Event()
+        self.ready_size = maxlen
+
+    def put(self, item):
+        if len(self.items) >= self.maxlen:
+            self.dropped += 1
+            readings_dropped.inc(1, ('queue_full',))
+        self.items.append(item)
+        if len(self.items) >= self.ready_size:
+            self.ready.set()
+
+    # Remove and return up to `limit` of the oldest readings
+    def drain(self, limit):
+        items = []
+        popleft = self.items.popleft
+        try:
+            for _ in range(limit):
+                items.append(popleft())
+        except IndexError:
+            pass
+        return items
+
+    def __len__(self):
+        return len(self.items)
+
+
+class IngestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        if self.path.rstrip('/') != '/metrics':
+            self.send_json(404, {'error': 'Not found'})
+            return
+        body = registry.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        if self.path.rstrip('/') != '/ingest':
+            self.send_json(404, {'error': 'Not found'})
+            return
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length)
+        if self.headers.get('Content-Type', '').startswith(media_type):
+            accepted, rejected = self.server.ingest.ingest_packets(body)
+        else:
+            accepted, rejected = self.server.ingest.ingest_lines(body)
+        self.send_json(202, {'accepted': accepted, 'rejected': rejected})
+
+    def send_json(self, status, payload):
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        try:
+            self.wfile.write(body)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    def log_message(self, format, *args):
+        pass  # One line per push would drown everything else
+
+
+class IngestHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def __init__(self, ingest, host, port):
+        self.ingest = ingest
+        super().__init__((host, port), IngestHandler)
+
+
+class IngestServer:
+    # `on_batch` is called from the batcher thread with a dict of
+    #   'node_ids'   - list of node ids, one per reading
+    #   'timestamps' - (n,) reading times in seconds
+    #   'values'     - (n, 6) readings in sensor_columns order, after any
+    #                  quarantine by `detector`
+    #   'flags'      - (n, 6) anomaly flags from `detector`, or None
+    #   'scored'     - the score_batch result for those readings
+    #   'readings'   - the same readings as a ReadingBatch (no copy)
+    # e.g. to append to a SensorStore or fold into Rollups.
+    def __init__(self, host='127.0.0.1', port=8090, udp_port=None, queue_size=100_000,
+                 batch_size=5_000, batch_interval=0.5, thresholds=ideal_thresholds, on_batch=None, detector=None,
+                 latest_max_age=3600.0):
+        self.thresholds = thresholds
+        self.detector = detector
+        self.on_batch = on_batch
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+        self.queue = IngestQueue(queue_size)
+        self.queue.ready_size = batch_size
+
+        self.http = IngestHTTPServer(self, host, port)
+        self.udp = None
+        if udp_port is not None:
+            self.udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.udp.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 1024 * 1024)
+            self.udp.bind((host, udp_port))
+
+        self.latest = {}  # node id -> (timestamp, total score) of its newest reading
+        self.latest_max_age = latest_max_age
+        self.next_expiry = time.time() + latest_max_age / 10
+        # Receivers and the batcher run on different threads, so counters are
+        # only changed through count()
+        self.stats_lock = threading.Lock()
+        self.stats = {'received': 0, 'rejected': 0, 'scored': 0, 'batches': 0, 'failed_batches': 0, 'failed': 0}
+        self.latencies = deque(maxlen=100_000)  # seconds from receipt to scored
+        self.running = False
+        self.threads = []
+        queue_depth.track(lambda: len(self.queue), ('ingest',))
+
+    @property
+    def http_url(self):
+        host, port = self.http.server_address[:2]
+        return f"http://{host}:{port}"
+
+    @property
+    def udp_address(self):
+        return self.udp.getsockname() if self.udp else None
+
+    # Add to stats counters, e.g. count(received=3, rejected=1)
+    def count(self, **increments):
+        with self.stats_lock:
+            for name, n in increments.items():
+                self.stats[name] += n
+
+    # Parse a push body and enqueue its readings; returns (accepted, rejected)
+    def ingest_lines(self, body):
+        received = time.time()
+        accepted = rejected = 0
+        for line in body.splitlines():
+            if not line.strip():
+                continue
+            try:
+                self.queue.put(parse_push_line(line, received))
+                accepted += 1
+            except (ValueError, TypeError, KeyError) as e:
+                rejected += 1
+                logger.debug(f"Rejected pushed reading {line[:80]!r}: {e}")
+        self.count(received=accepted, rejected=rejected)
+        if rejected:
+            readings_dropped.inc(rejected, ('rejected',))
+        return accepted, rejected
+
+    # Decode a body of binary packets and enqueue its readings. A malformed
+    # body is rejected whole; returns (accepted, rejected).
+    def ingest_packets(self, body):
+        received = time.time()
+        try:
+            readings, seqs = decode_batch(body, received)
+        except WireFormatError as e:
+            logger.debug(f"Rejected pushed packets: {e}")
+            self.count(rejected=1)
+            readings_dropped.inc(1, ('rejected',))
+            return 0, 1
+        for node_id, timestamp, row in zip(readings.node_ids, readings.timestamps.tolist(),
+                                           readings.values.tolist()):
+            self.queue.put((node_id, timestamp, row, received))
+        self.count(received=len(readings))
+        return len(readings), 0
+
+    def serve_udp(self):
+        while self.running:
+            try:
+                datagram = self.udp.recv(65535)
+            except OSError:
+                break  # Socket closed by stop()
+            if datagram[:len(magic)] == magic:
+                self.ingest_packets(datagram)
+            else:
+                self.ingest_lines(datagram)
+
+    def run_batcher(self):
+        while self.running:
+            self.queue.ready.wait(self.batch_interval)
+            self.queue.ready.clear()
+            self.process_pending()
+        self.process_pending()
+
+    # Score everything currently queued, one batch_size slice at a time
+    def process_pending(self):
+        while len(self.queue):
+            items = self.queue.drain(self.batch_size)
+            if not items:
+                continue
+            try:
+                self.process_batch(items)
+            except Exception:
+                logger.exception(f"Failed to process a batch of {len(items)} readings")
+                self.count(failed_batches=1, failed=len(items))
+                readings_dropped.inc(len(items), ('batch_failed',))
+
+    def process_batch(self, items):
+        started = time.perf_counter()
+        node_ids = [item[0] for item in items]
+        timestamps = np.fromiter((item[1] for item in items), dtype=np.float64, count=len(items))
+        values = np.array([item[2] for item in items], dtype=np.float64)
+        flags = None
+        if self.detector is not None:
+            flags, values = self.detector.check_batch(node_ids, values)
+        scoring = time.perf_counter()
+        scored = score_batch(values, self.thresholds)
+        score_seconds.observe(time.perf_counter() - scoring, ('batch',))
+
+        total_score = scored['total_score'].tolist()
+        late = 0
+        for node_id, timestamp, score in zip(node_ids, timestamps.tolist(), total_score):
+            latest = self.latest.get(node_id)
+            if latest is None or timestamp >= latest[0]:
+                self.latest[node_id] = (timestamp, score)
+            else:
+                late += 1
+        if late:
+            readings_late.inc(late)
+        if time.time() >= self.next_expiry:
+            self.expire_latest()
+
+        if self.on_batch is not None:
+            self.on_batch({'node_ids': node_ids, 'timestamps': timestamps, 'values': values, 'flags': flags,
+                           'scored': scored, 'readings': ReadingBatch.from_arrays(node_ids, timestamps, values)})
+
+        done = time.time()
+        self.latencies.extend(done - item[3] for item in items)
+        self.count(scored=len(items), batches=1)
+        cycle_seconds.observe(time.perf_counter() - started, ('ingest',))
+
+    # Forget nodes whose newest reading is older than latest_max_age, so
+    # `latest` holds the live fleet rather than every node id ever seen
+    def expire_latest(self):
+        now = time.time()
+        cutoff = now - self.latest_max_age
+        self.latest = {node_id: latest for node_id, latest in self.latest.items() if latest[0] >= cutoff}
+        self.next_expiry = now + self.latest_max_age / 10
+
+    def start(self):
+        self.running = True
+        targets = [self.http.serve_forever, self.run_batcher]
+        if self.udp is not None:
+            targets.append(self.serve_udp)
+        for target in targets:
+            thread = threading.Thread(target=target, daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self):
+        self.running = False
+        self.http.shutdown()
+        self.http.server_close()
+        if self.udp is not None:
+            self.udp.close()
+        self.queue.ready.set()
+        for thread in self.threads:
+            thread.join(timeout=5)
+
+
+# Function to push readings for `node_ids` at `rate` Hz for `duration` seconds.
+# Runs in its own process during the load test so the fleet does not share the
+# server's interpreter. Each node sends its own reading; `per_request` readings
+# are sent per HTTP request or UDP datagram (1 = every probe pushes alone),
+# as NDJSON lines or, with `wire` 'binary', as one packet per probe.
+def simulate_fleet(node_ids, target, transport, rate, duration, per_request, sent, wire='json'):
+    import http.client
+
+    if transport == 'udp':
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        send = lambda body: sock.sendto(body, target)
+    else:
+        host, port = target
+        connection = http.client.HTTPConnection(host, port)
+
+        def send(body):
+            connection.request('POST', '/ingest', body,
+                               {'Content-Type': media_type if wire == 'binary' else 'application/x-ndjson'})
+            connection.getresponse().read()
+
+    period = 1.0 / rate
+    start = time.monotonic()
+    count = 0
+    tick = 0
+    while True:
+        tick_start = start + tick * period
+        if tick_start >= start + duration:
+            break
+        delay = tick_start - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        # Spread the fleet's pushes across the period instead of one burst
+        groups = [node_ids[i:i + per_request] for i in range(0, len(node_ids), per_request)]
+        for k, group in enumerate(groups):
+            delay = tick_start + period * k / len(groups) - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            now = time.time()
+            if wire == 'binary':
+                body = b''.join(encode_packet(node, [(tick, now, 21.5, 60.0, 25 + tick % 10)], clock=now)
+                                for node in group)
+            else:
+                body = ''.join(
+                    f'{{"node": "{node}", "t": {now:.3f}, "temperature": 21.5, "humidity": 60.0, "moisture": {25 + tick % 10}}}\n'
+                    for node in group
+                ).encode('utf-8')
+            send(body)
+            count += len(group)
+        tick += 1
+    with sent.get_lock():
+        sent.value += count
+
+
+# Function to build the detector for an --anomaly choice ('off' gives None)
+def anomaly_detector(mode, thresholds=ideal_thresholds):
+    return None if mode == 'off' else AnomalyDetector(thresholds, mode)
+
+
+def load_test(n_nodes=1000, rate=1.0, duration=10.0, transport='http', per_request=1, senders=4, anomaly='off',
+              wire='json'):
+    server = IngestServer(port=0, udp_port=0, detector=anomaly_detector(anomaly))
+    server.start()
+    target = server.udp_address if transport == 'udp' else server.http.server_address[:2]
+
+    # Binary packets carry numeric node ids
+    node_ids = list(range(n_nodes)) if wire == 'binary' else [f"probe-{i}" for i in range(n_nodes)]
+    sent = multiprocessing.Value('l', 0)
+    processes = [
+        multiprocessing.Process(
+            target=simulate_fleet,
+            args=(node_ids[i::senders], target, transport, rate, duration, per_request, sent, wire),
+        )
+        for i in range(senders)
+    ]
+    cpu_start = time.process_time()
+    wall_start = time.monotonic()
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    time.sleep(server.batch_interval * 2)  # let the batcher catch up
+    wall = time.monotonic() - wall_start
+    cpu = time.process_time() - cpu_start
+    server.stop()
+
+    latencies = sorted(server.latencies)
+    p50 = latencies[len(latencies) // 2] if latencies else float('nan')
+    p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] if latencies else float('nan')
+    stats = dict(server.stats)
+    print(f"{n_nodes} nodes at {rate:g} Hz for {duration:g}s over {transport}, "
+          f"{per_request} {wire} reading(s) per {'datagram' if transport == 'udp' else 'request'}, "
+          f"anomaly detection {anomaly}")
+    print(f"sent {sent.value}, received {stats['received']}, scored {stats['scored']} in "
+          f"{stats['batches']} batches, rejected {stats['rejected']}, dropped {server.queue.dropped}, "
+          f"failed {stats['failed']}, lost in transit {sent.value - stats['received'] - stats['rejected']}")
+    print(f"receipt-to-score latency: p50 {p50 * 1000:.1f} ms, p99 {p99 * 1000:.1f} ms")
+    print(f"server CPU {cpu / wall * 100:.1f}% of one core, "
+          f"{len(server.latest)} nodes with a current score")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Accept pushed ESP32 readings, or load-test the ingest path.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8090, help='HTTP port for POST /ingest')
+    parser.add_argument('--udp-port', type=int, help='also accept readings over UDP on this port')
+    parser.add_argument('--load-test', action='store_true', help='run a simulated fleet against a local server')
+    parser.add_argument('--nodes', type=int, default=1000)
+    parser.add_argument('--rate', type=float, default=1.0, help='readings per node per second')
+    parser.add_argument('--duration', type=float, default=10.0)
+    parser.add_argument('--transport', choices=('http', 'udp'), default='http')
+    parser.add_argument('--per-request', type=int, default=1, help='readings per request or datagram')
+    parser.add_argument('--wire', choices=('json', 'binary'), default='json',
+                        help='load test: push NDJSON lines or binary packets (see wire_format.py)')
+    parser.add_argument('--anomaly', choices=('quarantine', 'flag', 'off'), default='quarantine',
+                        help='check readings for sensor faults before scoring (see anomaly.py)')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    if args.load_test:
+        load_test(args.nodes, args.rate, args.duration, args.transport, args.per_request, anomaly=args.anomaly,
+                  wire=args.wire)
+        return
+
+    server = IngestServer(args.host, args.port, args.udp_port, detector=anomaly_detector(args.anomaly))
+    server.start()
+    logger.info(f"Accepting pushed readings on {server.http_url}/ingest"
+                + (f" and udp://{args.host}:{args.udp_port}" if args.udp_port else ""))
+    try:
+        while True:
+            time.sleep(10)
+            logger.info(f"{dict(server.stats)}, queue {len(server.queue)}, dropped {server.queue.dropped}")
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.stop()
+
+
+if __name__ == "__main__":
+    main()
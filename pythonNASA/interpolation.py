@@ -0,0 +1,395 @@
+import argparse
+import math
+import shutil
+import tempfile
+import time
+
+import numpy as np
+
+from soil_health import flatten_sensor_data, sensor_columns
+
+# Fleet-wide rasters of soil moisture (and temperature) between probes.
+#
+# Every probe is scored on its own; a FieldRaster spreads their readings over
+# a regular grid covering the field by inverse-distance weighting (IDW) of the
+# k nearest probes:
+#
+#   value(cell) = prior(cell) + sum(w_i * r_i) / (sum(w_i) + w_prior)
+#   w_i         = max(d_i, half a cell) ** -power
+#   r_i         = reading_i - prior(cell of probe i)
+#
+# Without a prior, prior = 0 and w_prior = 0: plain IDW, NaN where no probe
+# reading is within `max_distance`. With a SMAP prior (smap_prior), the
+# probes correct the satellite field: near a probe the raster follows the
+# probe, and further than about `prior_distance` metres it falls back to the
+# satellite value, which acts like one more probe at that distance.
+#
+# The k nearest probes of every cell and their weights are found once, with
+# a k-d tree over the probe positions (scipy.spatial.cKDTree), and kept. A
+# reading then only changes the cells that have that probe among their
+# neighbours: update() recomputes those cells from the kept tables, about
+# cells * k / probes of them, instead of the whole grid. Moving, adding or
+# removing probes (set_locations) rebuilds the tables.
+#
+# Positions are (lat, lon) like every other locations dict in this package
+# (threshold_model, forecast), projected to metres around the field centre;
+# fine for anything farm-sized. Rows run north to south.
+
+column_index = {name: i for i, (group, name) in enumerate(sensor_columns)}
+metres_per_degree = 111_320.0
+
+
+def _require_scipy():
+    try:
+        import scipy.sparse
+        import scipy.spatial
+    except ImportError:
+        raise ImportError("scipy is required for spatial interpolation: pip install scipy") from None
+    return scipy
+
+
+# A regular lat/lon grid over a field, cell centres on `lat` (north to south)
+# and `lon` (west to east)
+class FieldGrid:
+    def __init__(self, south, west, north, east, rows, cols):
+        if not (south < north and west < east and rows > 0 and cols > 0):
+            raise ValueError("field bounds must be south < north, west < east with at least one cell")
+        self.bounds = (south, west, north, east)
+        self.shape = (rows, cols)
+        self.cell_lat = (north - south) / rows
+        self.cell_lon = (east - west) / cols
+        self.lat = north - (np.arange(rows) + 0.5) * self.cell_lat
+        self.lon = west + (np.arange(cols) + 0.5) * self.cell_lon
+        self.lat0 = (south + north) / 2
+        self.lon0 = (west + east) / 2
+        self.lon_scale = math.cos(math.radians(self.lat0))
+        self.cell_size = min(self.cell_lat, self.cell_lon * self.lon_scale) * metres_per_degree
+
+    @property
+    def size(self):
+        return self.shape[0] * self.shape[1]
+
+    # Project lat/lon arrays to (n, 2) metres east and north of the field centre
+    def project(self, lat, lon):
+        x = (np.asarray(lon, dtype=np.float64) - self.lon0) * (self.lon_scale * metres_per_degree)
+        y = (np.asarray(lat, dtype=np.float64) - self.lat0) * metres_per_degree
+        return np.column_stack((x, y))
+
+    # Every cell centre in metres, row by row
+    def cell_xy(self):
+        x = (self.lon - self.lon0) * (self.lon_scale * metres_per_degree)
+        y = (self.lat - self.lat0) * metres_per_degree
+        return np.column_stack((np.tile(x, len(y)), np.repeat(y, len(x))))
+
+    # Flat index of the cell containing each point (clipped to the grid)
+    def cell_of(self, lat, lon):
+        south, west, north, east = self.bounds
+        rows = np.clip(((north - np.asarray(lat, dtype=np.float64)) / self.cell_lat).astype(np.int64),
+                       0, self.shape[0] - 1)
+        cols = np.clip(((np.asarray(lon, dtype=np.float64) - west) / self.cell_lon).astype(np.int64),
+                       0, self.shape[1] - 1)
+        return rows * self.shape[1] + cols
+
+
+# Function to build a soil-moisture prior for every cell of `grid` from a SMAP
+# product (satellite.TiledGrid): the mean over [start, end) of the satellite
+# cell under each raster cell, in percent. Both grids are separable, so only
+# one lookup per raster row and per raster column is needed. Cells whose
+# satellite cell has no data get the mean of the rest of the field.
+def smap_prior(smap, grid, start=None, end=None):
+    rows = np.array([smap.index.nearest(lat, grid.lon0)[0] for lat in grid.lat.tolist()])
+    cols = np.array([smap.index.nearest(grid.lat0, lon)[1] for lon in grid.lon.tolist()])
+    unique_rows, row_of = np.unique(rows, return_inverse=True)
+    unique_cols, col_of = np.unique(cols, return_inverse=True)
+    means = np.full((len(unique_rows), len(unique_cols)), np.nan)
+    for i, row in enumerate(unique_rows.tolist()):
+        for j, col in enumerate(unique_cols.tolist()):
+            times, values = smap.cell_series(row, col, start, end)
+            values = values[~np.isnan(values)]
+            if len(values):
+                means[i, j] = float(values.mean()) * 100.0  # m3/m3 -> %
+    if np.isnan(means).all():
+        raise ValueError("the SMAP product has no data over this field")
+    means[np.isnan(means)] = np.nanmean(means)
+    return means[row_of][:, col_of]
+
+
+class FieldRaster:
+    # `locations` maps node id -> (lat, lon). `variables` are sensor_columns
+    # names. `priors` maps a variable to a (rows, cols) array, e.g. from
+    # smap_prior. Neighbours further than `max_distance` metres are ignored.
+    def __init__(self, grid, locations, variables=('Soil_Moisture', 'Temperature'), k=8, power=2.0,
+                 max_distance=None, priors=None, prior_distance=200.0):
+        self.grid = grid
+        self.variables = list(variables)
+        self.columns = [column_index[variable] for variable in self.variables]
+        self.k = k
+        self.power = power
+        self.max_distance = max_distance
+        self.priors = np.zeros((len(self.variables), grid.size))
+        self.prior_weights = np.zeros(len(self.variables))
+        for variable, prior in (priors or {}).items():
+            prior = np.asarray(prior, dtype=np.float64)
+            if prior.shape != grid.shape:
+                raise ValueError(f"prior for {variable} has shape {prior.shape}, the grid is {grid.shape}")
+            j = self.variables.index(variable)
+            self.priors[j] = prior.ravel()
+            self.prior_weights[j] = prior_distance ** -power
+        self.node_ids = []
+        self.index = {}  # node id -> probe row
+        self.readings = np.empty((0, len(self.variables)))  # latest reading of every probe, NaN if none
+        self.rasters = np.full((len(self.variables), grid.size), np.nan, dtype=np.float32)
+        self.stats = {'updates': 0, 'cells_updated': 0, 'rebuilds': 0}
+        self.set_locations(locations)
+
+    # Place the probes and rebuild the neighbour tables. Readings of probes
+    # that are kept carry over.
+    def set_locations(self, locations):
+        scipy = _require_scipy()
+        old_index, old_readings = self.index, self.readings
+        self.located = dict(locations)
+        self.node_ids = list(locations)
+        self.index = {node_id: i for i, node_id in enumerate(self.node_ids)}
+        self.readings = np.full((len(self.node_ids), len(self.variables)), np.nan)
+        for node_id, i in self.index.items():
+            if node_id in old_index:
+                self.readings[i] = old_readings[old_index[node_id]]
+
+        n_probes = len(self.node_ids)
+        n_cells = self.grid.size
+        if n_probes == 0:
+            self.neighbours = np.zeros((n_cells, 0), dtype=np.int32)
+            self.weights = np.zeros((n_cells, 0), dtype=np.float32)
+            self.probe_cells = np.zeros(0, dtype=np.int64)
+            self.residuals = np.empty((0, len(self.variables)))
+            self.order = np.zeros(0, dtype=np.int32)
+            self.offsets = np.zeros(1, dtype=np.int64)
+            self.rebuild()
+            return
+
+        lat, lon = np.array([locations[node_id] for node_id in self.node_ids], dtype=np.float64).T
+        self.probe_cells = self.grid.cell_of(lat, lon)
+        self.residuals = self.readings - self.priors[:, self.probe_cells].T
+        k = min(self.k, n_probes)
+        tree = scipy.spatial.cKDTree(self.grid.project(lat, lon))
+        distances, neighbours = tree.query(
+            self.grid.cell_xy(), k=k, workers=-1,
+            distance_upper_bound=np.inf if self.max_distance is None else self.max_distance)
+        distances = distances.reshape(n_cells, k)
+        neighbours = neighbours.reshape(n_cells, k)
+        missing = neighbours == n_probes  # fewer than k probes within max_distance
+        with np.errstate(divide='ignore'):
+            weights = np.maximum(distances, self.grid.cell_size / 2) ** -self.power
+        weights[missing] = 0.0
+        neighbours[missing] = 0
+        self.neighbours = neighbours.astype(np.int32)
+        self.weights = weights.astype(np.float32)
+
+        # For each probe, the (cell, slot) entries that refer to it: the
+        # entries of probe p are order[offsets[p]:offsets[p + 1]]. Grouping
+        # them is a counting sort, which scipy's COO -> CSR conversion does
+        # several times faster than argsort.
+        flat = np.where(missing, n_probes, neighbours).ravel()
+        entries = scipy.sparse.coo_matrix(
+            (np.ones(len(flat), dtype=np.int8), (flat, np.arange(len(flat), dtype=np.int32))),
+            shape=(n_probes + 1, len(flat))).tocsr()
+        self.order = entries.indices
+        self.offsets = entries.indptr[:n_probes + 1]
+        self.rebuild()
+
+    def add_probe(self, node_id, lat, lon):
+        locations = self.locations()
+        locations[node_id] = (lat, lon)
+        self.set_locations(locations)
+
+    def remove_probe(self, node_id):
+        locations = self.locations()
+        del locations[node_id]
+        self.set_locations(locations)
+
+    # node id -> (lat, lon) of every probe
+    def locations(self):
+        return dict(self.located)
+
+    # Recompute every cell
+    def rebuild(self):
+        self.stats['rebuilds'] += 1
+        if not np.isfinite(self.residuals).any():
+            # Nothing reported yet: the prior, or nothing
+            for j in range(len(self.variables)):
+                self.rasters[j] = self.priors[j] if self.prior_weights[j] else np.nan
+            return
+        self._compute(slice(None))
+
+    # Recompute the cells in `cells` (an index array or slice) from the
+    # neighbour tables and the latest readings
+    def _compute(self, cells):
+        neighbours = self.neighbours[cells]
+        weights = self.weights[cells].astype(np.float64)
+        for j in range(len(self.variables)):
+            residuals = self.residuals[:, j][neighbours]
+            finite = np.isfinite(residuals)
+            w = np.where(finite, weights, 0.0)
+            total = w.sum(axis=1) + self.prior_weights[j]
+            with np.errstate(invalid='ignore', divide='ignore'):
+                value = (w * np.where(finite, residuals, 0.0)).sum(axis=1) / total
+            value = np.where(total > 0, value + self.priors[j][cells], np.nan)
+            self.rasters[j, cells] = value
+
+    # Take new readings: {node id: sensor_data} in any form flatten_sensor_data
+    # accepts. Only cells with a changed probe among their neighbours are
+    # recomputed. Returns the number of cells recomputed.
+    def update(self, readings):
+        changed = []
+        for node_id, sensor_data in readings.items():
+            i = self.index.get(node_id)
+            if i is None:
+                raise KeyError(f"No location for probe {node_id!r}; add it with add_probe first")
+            values = flatten_sensor_data(sensor_data)
+            new = np.array([np.nan if values[column] is None else values[column] for column in self.columns],
+                           dtype=np.float64)
+            old = self.readings[i]
+            if np.array_equal(new, old, equal_nan=True):
+                continue
+            self.readings[i] = new
+            self.residuals[i] = new - self.priors[:, self.probe_cells[i]]
+            changed.append(i)
+        self.stats['updates'] += len(readings)
+        if not changed:
+            return 0
+
+        entries = sum(int(self.offsets[i + 1] - self.offsets[i]) for i in changed)
+        if entries * 4 > self.neighbours.size:
+            # Most of the grid moves; one pass over everything is cheaper
+            self.rebuild()
+            self.stats['cells_updated'] += self.grid.size
+            return self.grid.size
+        k = self.neighbours.shape[1]
+        positions = [self.order[self.offsets[i]:self.offsets[i + 1]] for i in changed]
+        cells = positions[0] // k if len(positions) == 1 else np.unique(np.concatenate(positions) // k)
+        self._compute(cells)
+        self.stats['cells_updated'] += len(cells)
+        return len(cells)
+
+    # The (rows, cols) raster of one variable
+    def raster(self, variable='Soil_Moisture'):
+        return self.rasters[self.variables.index(variable)].reshape(self.grid.shape)
+
+    # Interpolated value of one variable at a point
+    def value_at(self, lat, lon, variable='Soil_Moisture'):
+        return float(self.rasters[self.variables.index(variable), int(self.grid.cell_of(lat, lon))])
+
+
+# Function to make a smooth synthetic moisture field (percent) over `grid`
+# with a few wet and dry patches, for benchmarks and checks
+def synthetic_moisture(grid, lat, lon, seed=0):
+    rng = np.random.default_rng(seed)
+    xy = grid.project(lat, lon)
+    south, west, north, east = grid.bounds
+    extent = (north - south) * metres_per_degree
+    field = np.full(len(xy), 30.0)
+    for _ in range(6):
+        centre = rng.uniform(-extent / 2, extent / 2, 2)
+        width = rng.uniform(0.1, 0.3) * extent
+        field += rng.uniform(-12, 12) * np.exp(-((xy - centre) ** 2).sum(axis=1) / (2 * width ** 2))
+    return field
+
+
+# Time building and updating rasters over a `rows` x `cols` grid for each
+# probe count, check incremental updates against a full rebuild, and measure
+# what a SMAP prior does for a sparse fleet
+def benchmark(probe_counts=(100, 1_000, 10_000, 100_000), rows=1000, cols=1000, k=8, n_updates=200):
+    from satellite import TiledGrid
+
+    # About 2 km x 2 km at 52N: cells of 2 m
+    grid = FieldGrid(52.0, 0.0, 52.018, 0.029, rows, cols)
+    cell_lat = np.repeat(grid.lat, cols)
+    cell_lon = np.tile(grid.lon, rows)
+    truth = synthetic_moisture(grid, cell_lat, cell_lon)
+    rng = np.random.default_rng(1)
+    print(f"{rows}x{cols} grid ({grid.size:,} cells of {grid.cell_size:.1f} m), k={k}")
+    print(f"{'probes':>8} {'tables s':>9} {'first fill s':>13} {'update ms':>10} {'cells/update':>13} "
+          f"{'full fill ms':>13} {'rmse %':>7}")
+    for n_probes in probe_counts:
+        south, west, north, east = grid.bounds
+        lat = rng.uniform(south, north, n_probes)
+        lon = rng.uniform(west, east, n_probes)
+        node_ids = [f"probe-{i}" for i in range(n_probes)]
+        moisture = synthetic_moisture(grid, lat, lon)
+        readings = {node_id: (None, None, None, None, 20.0, value)
+                    for node_id, value in zip(node_ids, moisture.tolist())}
+
+        start = time.perf_counter()
+        raster = FieldRaster(grid, dict(zip(node_ids, zip(lat.tolist(), lon.tolist()))), k=k)
+        tables = time.perf_counter() - start
+        start = time.perf_counter()
+        raster.update(readings)
+        first = time.perf_counter() - start
+
+        # One probe reporting at a time, as readings arrive
+        cells = 0
+        start = time.perf_counter()
+        for step in range(n_updates):
+            node_id = node_ids[int(rng.integers(n_probes))]
+            cells += raster.update({node_id: (None, None, None, None, 20.0, float(rng.uniform(10, 50)))})
+        update = (time.perf_counter() - start) / n_updates
+
+        incremental = raster.rasters.copy()
+        start = time.perf_counter()
+        raster.rebuild()
+        full = time.perf_counter() - start
+        if not np.allclose(incremental, raster.rasters, equal_nan=True, atol=1e-4):
+            raise AssertionError(f"{n_probes} probes: incremental raster differs from a full rebuild")
+        raster.update(readings)
+        rmse = float(np.sqrt(np.mean((raster.rasters[0].astype(np.float64) - truth) ** 2)))
+        print(f"{n_probes:>8,} {tables:>9.2f} {first:>13.2f} {update * 1000:>10.2f} {cells / n_updates:>13,.0f} "
+              f"{full * 1000:>13.0f} {rmse:>7.2f}")
+        del raster
+
+    # A sparse fleet on a field whose moisture follows the satellite pattern,
+    # with and without the SMAP prior
+    root = tempfile.mkdtemp(prefix='aquiferst-interpolation-')
+    try:
+        small = FieldGrid(52.0, 0.0, 52.36, 0.58, 200, 200)  # ~40 km, several SMAP cells
+        smap_lat = np.linspace(52.5, 51.8, 24)
+        smap_lon = np.linspace(-0.2, 0.8, 28)
+        smap = TiledGrid.create(f"{root}/smap", 'smap', smap_lat, smap_lon, tile=8, block_len=8)
+        satellite_field = 0.2 + 0.15 * np.sin(smap_lat[:, None] * 9) * np.cos(smap_lon[None, :] * 7)
+        for day in range(5):
+            smap.append(day * 86400.0, satellite_field + rng.normal(0, 0.01, satellite_field.shape))
+        start = time.perf_counter()
+        prior = smap_prior(smap, small)
+        prior_seconds = time.perf_counter() - start
+
+        cell_lat = np.repeat(small.lat, small.shape[1])
+        cell_lon = np.tile(small.lon, small.shape[0])
+        small_truth = prior.ravel() + synthetic_moisture(small, cell_lat, cell_lon, seed=2) - 30.0
+        south, west, north, east = small.bounds
+        lat = rng.uniform(south, north, 25)
+        lon = rng.uniform(west, east, 25)
+        cells = small.cell_of(lat, lon)
+        locations = {f"probe-{i}": point for i, point in enumerate(zip(lat.tolist(), lon.tolist()))}
+        readings = {f"probe-{i}": (None, None, None, None, 20.0, float(small_truth[cell]))
+                    for i, cell in enumerate(cells.tolist())}
+        for label, priors in (('IDW only', None), ('IDW + SMAP prior', {'Soil_Moisture': prior})):
+            raster = FieldRaster(small, locations, priors=priors, prior_distance=3000.0)
+            raster.update(readings)
+            rmse = float(np.sqrt(np.mean((raster.rasters[0] - small_truth) ** 2)))
+            print(f"25 probes over {small.shape[0]}x{small.shape[1]} cells, {label:>16}: rmse {rmse:.2f} %")
+        print(f"SMAP prior for {small.size:,} cells built in {prior_seconds * 1000:.1f} ms")
+    finally:
+        shutil.rmtree(root)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark interpolating probe readings over a field.')
+    parser.add_argument('--probes', type=int, nargs='+', default=[100, 1_000, 10_000, 100_000])
+    parser.add_argument('--rows', type=int, default=1000)
+    parser.add_argument('--cols', type=int, default=1000)
+    parser.add_argument('-k', type=int, default=8, help='neighbours per cell')
+    args = parser.parse_args()
+    benchmark(args.probes, args.rows, args.cols, args.k)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,273 @@
+import argparse
+import heapq
+import math
+import time
+from collections import namedtuple
+
+import numpy as np
+
+from soil_health import (
+    calculate_nutrient_needed,
+    calculate_water_needed,
+    flatten_sensor_data,
+    ideal_thresholds,
+    sensor_columns,
+    soil_bulk_density,
+)
+
+# Zone-level irrigation and fertiliser plans for the dual-reservoir rig.
+#
+# calculate_water_needed and calculate_nutrient_needed size a dose per node;
+# served node by node, a field of probes means one valve run per probe. The
+# rig mixes a water reservoir with a fertiliser stock reservoir at a set
+# ratio and feeds zone valves (one valve waters every node of its zone), so
+# a plan is made per zone:
+#
+#   1. Deficits per node, in one pass over all nodes: litres of water to
+#      bring moisture up to the bottom of its band, grams of N, P and K to
+#      bring each nutrient up to its band. Soil volume and bulk density can
+#      be given per node (default 1 m^3 and soil_health.soil_bulk_density).
+#   2. Per zone, the largest deficit of its nodes. A zone run puts the same
+#      litres on each of its nodes, so it must cover the thirstiest node,
+#      and at a stock ratio that carries every nutrient shortfall:
+#        volume = max(water deficit, nutrient deficit / (max_ratio * grams per litre of stock))
+#        ratio  = max(nutrient deficit / (volume * grams per litre of stock))
+#      which is the least water that meets every deficit of the zone.
+#   3. Ratios are rounded up to the mixer's step, so zones share settings:
+#      the mixer runs one ratio at a time, and every zone at that ratio is
+#      watered in one mix.
+#   4. Reservoirs: zones are served most urgent first, by how far their
+#      worst node is below the bottom of a band, relative to it (moisture
+#      or any nutrient). A zone that does not fit in what is left of
+#      either reservoir is deferred to the next cycle.
+#   5. Timing: the pump feeds up to pump_lpm / valve_lpm valves at once.
+#      Within a mix, runs go longest first onto whichever valve slot frees
+#      up first (LPT), and mixes follow each other.
+#
+# Everything but the per-zone loops in 4 and 5 is array arithmetic, so a plan
+# for thousands of nodes takes milliseconds and can be redone every cycle.
+
+nutrients = ['Nitrogen', 'Phosphorus', 'Potassium']
+nutrient_columns = [i for i, (group, name) in enumerate(sensor_columns) if name in nutrients]
+moisture_column = [name for group, name in sensor_columns].index('Soil_Moisture')
+
+# The rig's limits. `stock_grams_per_litre` is the N, P, K content of the
+# fertiliser stock; `max_ratio` the largest share of stock the mixer can dose.
+Rig = namedtuple('Rig', 'water_litres stock_litres stock_grams_per_litre pump_lpm valve_lpm max_ratio ratio_step')
+default_rig = Rig(water_litres=50_000.0, stock_litres=2_000.0, stock_grams_per_litre=(100.0, 40.0, 60.0),
+                  pump_lpm=600.0, valve_lpm=120.0, max_ratio=0.05, ratio_step=0.0025)
+
+
+# Function to compute per-node deficits. `values` is (nodes, 6) in
+# sensor_columns order (NaN where missing, which counts as no deficit);
+# `bands` is (6, 2) or per node (nodes, 6, 2). Returns (water litres per
+# node, (nodes, 3) grams of N, P, K per node).
+def node_deficits(values, bands, soil_volume_m3=1.0, bulk_density=soil_bulk_density):
+    values = np.asarray(values, dtype=np.float64)
+    bands = np.asarray(bands, dtype=np.float64)
+    minimum = np.broadcast_to(bands[..., 0], values.shape)
+    soil_volume_m3 = np.asarray(soil_volume_m3, dtype=np.float64)
+    soil_mass_kg = np.asarray(bulk_density, dtype=np.float64) * soil_volume_m3
+    with np.errstate(invalid='ignore'):
+        moisture = values[:, moisture_column]
+        water = np.where(moisture < minimum[:, moisture_column],
+                         calculate_water_needed(moisture, minimum[:, moisture_column], soil_volume_m3), 0.0)
+        npk = values[:, nutrient_columns]
+        npk_min = minimum[:, nutrient_columns]
+        grams = np.where(npk < npk_min,
+                         calculate_nutrient_needed(npk, npk_min, np.reshape(soil_mass_kg, (-1, 1))), 0.0)
+    return water, grams
+
+
+# Function to measure how far below its band each node is: the largest of
+# (minimum - value) / minimum over moisture and the nutrients, 0 when none is
+# below its band
+def relative_shortfall(values, bands):
+    values = np.asarray(values, dtype=np.float64)
+    minimum = np.broadcast_to(np.asarray(bands, dtype=np.float64)[..., 0], values.shape)
+    columns = nutrient_columns + [moisture_column]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        shortfall = (minimum[:, columns] - values[:, columns]) / minimum[:, columns]
+    return np.nan_to_num(shortfall, nan=0.0).max(axis=1, initial=0.0)
+
+
+# Function to group located nodes into square zones of `zone_metres`, for
+# fields whose valves have not been mapped yet. `locations` maps node id ->
+# (lat, lon); returns node id -> zone id.
+def zones_from_locations(locations, zone_metres=50.0):
+    if not locations:
+        return {}
+    node_ids = list(locations)
+    lat, lon = np.array([locations[node_id] for node_id in node_ids], dtype=np.float64).T
+    lat0 = float(lat.mean())
+    metres_per_degree = 111_320.0
+    rows = np.floor((lat - lat0) * metres_per_degree / zone_metres).astype(np.int64)
+    cols = np.floor(lon * metres_per_degree * np.cos(np.radians(lat0)) / zone_metres).astype(np.int64)
+    return {node_id: f"zone_{row}_{col}" for node_id, row, col in zip(node_ids, rows.tolist(), cols.tolist())}
+
+
+# Function to plan one cycle. `node_ids` and `values` as for node_deficits;
+# `zones` maps node id -> zone (a node without one is its own zone). Returns
+#   'runs'     - valve runs sorted by start: {'zone', 'nodes', 'start' and
+#                'seconds' from the start of the plan, 'litres' per node,
+#                'water_litres' and 'stock_litres' in total, 'ratio'}
+#   'mixes'    - the mixer ratios used, in run order
+#   'deferred' - zones with a deficit that did not fit in the reservoirs
+#   'water_litres', 'stock_litres' - reservoir use of the whole plan
+#   'seconds'  - time from the first run's start to the last run's end
+def plan_irrigation(node_ids, values, zones=None, thresholds=ideal_thresholds, rig=default_rig,
+                    soil_volume_m3=1.0, bulk_density=soil_bulk_density, bands=None):
+    if bands is None:
+        bands = flatten_sensor_data(thresholds)
+    water, grams = node_deficits(values, bands, soil_volume_m3, bulk_density)
+
+    # Zone maxima: sort nodes by zone, reduce each run of equal codes
+    zones = zones or {}
+    zone_codes = {}
+    codes = np.fromiter((zone_codes.setdefault(zones.get(node_id, node_id), len(zone_codes)) for node_id in node_ids),
+                        dtype=np.int64, count=len(node_ids))
+    first_label = list(zone_codes)
+    order = np.argsort(codes, kind='stable')
+    starts = np.flatnonzero(np.r_[True, np.diff(codes[order]) != 0]) if len(order) else np.zeros(0, dtype=np.int64)
+    zone_water = np.maximum.reduceat(water[order], starts) if len(order) else np.zeros(0)
+    zone_grams = np.maximum.reduceat(grams[order], starts, axis=0) if len(order) else np.zeros((0, 3))
+    shortfall = relative_shortfall(values, bands)
+    zone_shortfall = np.maximum.reduceat(shortfall[order], starts) if len(order) else np.zeros(0)
+    zone_sizes = np.diff(np.r_[starts, len(order)])
+
+    # Least volume per node that carries every nutrient at no more than the
+    # mixer's ratio, then the ratio that carries them in that volume
+    stock = np.asarray(rig.stock_grams_per_litre, dtype=np.float64)
+    volume = np.maximum(zone_water, (zone_grams / (rig.max_ratio * stock)).max(axis=1, initial=0.0))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        ratio = np.where(volume > 0, (zone_grams / stock).max(axis=1, initial=0.0) / volume, 0.0)
+    steps = np.ceil(np.round(ratio / rig.ratio_step, 9))
+    ratio = np.minimum(steps * rig.ratio_step, rig.max_ratio)
+    total = volume * zone_sizes
+    stock_litres = total * ratio
+    water_litres = total - stock_litres
+
+    # Most urgent first
+    needed = np.flatnonzero(volume > 0)
+    urgency = np.argsort(-zone_shortfall[needed], kind='stable')
+    water_used = stock_used = 0.0
+    served, deferred = [], []
+    for z in needed[urgency].tolist():
+        if water_used + water_litres[z] <= rig.water_litres and stock_used + stock_litres[z] <= rig.stock_litres:
+            water_used += water_litres[z]
+            stock_used += stock_litres[z]
+            served.append(z)
+        else:
+            deferred.append(first_label[z])
+
+    # One mix per ratio; within a mix, longest run first onto the valve slot
+    # that frees up first
+    slots = max(1, int(rig.pump_lpm // rig.valve_lpm))
+    flow = min(rig.valve_lpm, rig.pump_lpm) / 60.0  # litres per second
+    by_ratio = {}
+    for z in served:
+        by_ratio.setdefault(float(ratio[z]), []).append(z)
+    node_order = np.array(node_ids, dtype=object)[order]
+    runs, mixes = [], []
+    clock = 0.0
+    for mix_ratio in sorted(by_ratio):
+        mixes.append(mix_ratio)
+        free = [(clock, slot) for slot in range(slots)]
+        for z in sorted(by_ratio[mix_ratio], key=lambda z: -total[z]):
+            start, slot = heapq.heappop(free)
+            seconds = float(total[z]) / flow
+            runs.append({
+                'zone': first_label[z],
+                'nodes': node_order[starts[z]:starts[z] + zone_sizes[z]].tolist(),
+                'start': round(start, 1),
+                'seconds': round(seconds, 1),
+                'litres': math.ceil(float(volume[z]) * 100) / 100,  # up, so the dose stays enough
+                'water_litres': round(float(water_litres[z]), 2),
+                'stock_litres': round(float(stock_litres[z]), 3),
+                'ratio': mix_ratio,
+            })
+            heapq.heappush(free, (start + seconds, slot))
+        clock = max(end for end, slot in free)
+    runs.sort(key=lambda run: (run['start'], str(run['zone'])))
+    return {
+        'runs': runs,
+        'mixes': mixes,
+        'deferred': deferred,
+        'water_litres': round(float(water_used), 2),
+        'stock_litres': round(float(stock_used), 3),
+        'seconds': round(clock, 1),
+    }
+
+
+# Function to check a plan against the deficits it was made for: every node
+# of a served zone gets at least its water and nutrients, and nothing exceeds
+# the reservoirs. Raises AssertionError.
+def check_plan(plan, node_ids, values, rig=default_rig, thresholds=ideal_thresholds):
+    water, grams = node_deficits(values, flatten_sensor_data(thresholds))
+    row = {node_id: i for i, node_id in enumerate(node_ids)}
+    stock = np.asarray(rig.stock_grams_per_litre, dtype=np.float64)
+    for run in plan['runs']:
+        rows = [row[node_id] for node_id in run['nodes']]
+        delivered = run['litres'] * run['ratio'] * stock
+        if (water[rows] > run['litres'] + 0.01).any() or (grams[rows] > delivered + 0.01).any():
+            raise AssertionError(f"run for {run['zone']} does not meet its deficits")
+        if run['ratio'] > rig.max_ratio + 1e-12:
+            raise AssertionError(f"run for {run['zone']} exceeds the mixer's ratio")
+    if plan['water_litres'] > rig.water_litres + 0.01 or plan['stock_litres'] > rig.stock_litres + 0.001:
+        raise AssertionError("plan exceeds the reservoirs")
+
+
+# Function to generate readings for `n_nodes` in zones of `zone_size`: each
+# zone has its own conditions around the ideal bands, and its nodes scatter
+# a little around them
+def synthetic_zone_readings(n_nodes, zone_size, seed=0):
+    rng = np.random.default_rng(seed)
+    bands = np.array(flatten_sensor_data(ideal_thresholds), dtype=np.float64)
+    centre = bands.mean(axis=1)
+    width = bands[:, 1] - bands[:, 0]
+    n_zones = -(-n_nodes // zone_size)
+    zone_values = rng.normal(centre, 0.6 * width, (n_zones, len(centre)))
+    values = np.repeat(zone_values, zone_size, axis=0)[:n_nodes] + rng.normal(0, 0.1 * width, (n_nodes, len(centre)))
+    return np.maximum(values, 0.0)
+
+
+def benchmark(node_counts=(1_000, 10_000, 100_000), zone_size=50, cycles=5):
+    print(f"zones of {zone_size} nodes, {default_rig.pump_lpm:.0f} L/min pump, "
+          f"{default_rig.valve_lpm:.0f} L/min valves, ratio step {default_rig.ratio_step}; "
+          f"reservoirs hold 90% of what the field needs")
+    print(f"{'nodes':>8} {'plan ms':>8} {'runs':>6} {'mixes':>6} {'deferred':>9} {'hours':>6} "
+          f"{'per-node runs':>14} {'per-node hours':>15}")
+    for n_nodes in node_counts:
+        values = synthetic_zone_readings(n_nodes, zone_size, seed=n_nodes)
+        node_ids = [f"probe-{i}" for i in range(n_nodes)]
+        zones = {node_id: f"zone-{i // zone_size}" for i, node_id in enumerate(node_ids)}
+        unlimited = plan_irrigation(node_ids, values, zones,
+                                    rig=default_rig._replace(water_litres=np.inf, stock_litres=np.inf))
+        rig = default_rig._replace(water_litres=0.9 * unlimited['water_litres'],
+                                   stock_litres=0.9 * unlimited['stock_litres'])
+
+        seconds = []
+        for _ in range(cycles):
+            start = time.perf_counter()
+            plan = plan_irrigation(node_ids, values, zones, rig=rig)
+            seconds.append(time.perf_counter() - start)
+        check_plan(plan, node_ids, values, rig)
+
+        # Serving every node on its own, one valve at a time
+        water, grams = node_deficits(values, flatten_sensor_data(ideal_thresholds))
+        per_node = int(((water > 0) | (grams > 0).any(axis=1)).sum())
+        per_node_hours = water.sum() / (rig.valve_lpm / 60.0) / 3600
+        print(f"{n_nodes:>8,} {min(seconds) * 1000:>8.1f} {len(plan['runs']):>6,} {len(plan['mixes']):>6} "
+              f"{len(plan['deferred']):>9,} {plan['seconds'] / 3600:>6.1f} {per_node:>14,} {per_node_hours:>15.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark zone-level irrigation and fertiliser planning.')
+    parser.add_argument('--nodes', type=int, nargs='+', default=[1_000, 10_000, 100_000])
+    parser.add_argument('--zone-size', type=int, default=50)
+    args = parser.parse_args()
+    benchmark(args.nodes, args.zone_size)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,327 @@
+import argparse
+import math
+import threading
+import time
+from bisect import bisect_left
+
+# Counters, gauges and histograms for the sensor pipeline, exposed in the
+# Prometheus text format on /metrics (app.py, app.js via the scoring worker,
+# and the ingest server).
+#
+# Recording takes no lock. Each thread that records into a metric gets its own
+# shard, a dict of label values -> count (or bucket counts), which only that
+# thread ever writes; scraping sums the shards. A thread's first record
+# registers its shard under a lock, once. Shards of threads that have exited
+# are folded into one retired shard at scrape time, so per-connection server
+# threads do not pile up.
+#
+# Label values are passed as a tuple in the order the metric declared its
+# label names, e.g. fetch_seconds.observe(0.012, ('probe-17',)).
+
+# Default histogram buckets, in seconds
+latency_buckets = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+# Base for metrics whose samples are recorded into per-thread shards
+class ShardedMetric:
+    kind = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.shards = []    # (thread, shard) of every thread that has recorded
+        self.retired = {}   # samples of exited threads
+
+    # Register the calling thread's shard; called once per thread
+    def _new_shard(self):
+        shard = self.local.shard = {}
+        with self.lock:
+            self.shards.append((threading.current_thread(), shard))
+        return shard
+
+    # Return label values -> merged sample over every shard
+    def collect(self):
+        with self.lock:
+            live = []
+            for thread, shard in self.shards:
+                if thread.is_alive():
+                    live.append((thread, shard))
+                else:
+                    for labels, sample in shard.items():
+                        self.retired[labels] = self._merge(self.retired.get(labels), sample)
+            self.shards = live
+            merged = dict(self.retired)
+            for thread, shard in live:
+                for labels, sample in list(shard.items()):
+                    merged[labels] = self._merge(merged.get(labels), sample)
+        return merged
+
+
+class Counter(ShardedMetric):
+    kind = 'counter'
+
+    def inc(self, amount=1, labels=()):
+        try:
+            shard = self.local.shard
+        except AttributeError:
+            shard = self._new_shard()
+        shard[labels] = shard.get(labels, 0) + amount
+
+    @staticmethod
+    def _merge(total, sample):
+        return sample if total is None else total + sample
+
+    def render(self):
+        values = self.collect()
+        if not self.label_names and not values:
+            values[()] = 0  # an unlabelled counter exists from the start
+        return [(self.name, labels, value) for labels, value in sorted(values.items())]
+
+
+class Histogram(ShardedMetric):
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=latency_buckets):
+        super().__init__(name, help, labels)
+        self.bounds = tuple(buckets)
+
+    # Record one value; each sample is [count per bucket ..., count above the
+    # last bucket, sum]
+    def observe(self, value, labels=()):
+        try:
+            shard = self.local.shard
+        except AttributeError:
+            shard = self._new_shard()
+        sample = shard.get(labels)
+        if sample is None:
+            sample = shard[labels] = [0] * (len(self.bounds) + 2)
+        sample[bisect_left(self.bounds, value)] += 1
+        sample[-1] += value
+
+    @staticmethod
+    def _merge(total, sample):
+        return list(sample) if total is None else [a + b for a, b in zip(total, sample)]
+
+    def render(self):
+        lines = []
+        for labels, sample in sorted(self.collect().items()):
+            cumulative = 0
+            for bound, count in zip(self.bounds + (math.inf,), sample):
+                cumulative += count
+                lines.append((f"{self.name}_bucket", labels + (format_value(bound),), cumulative))
+            lines.append((f"{self.name}_sum", labels, sample[-1]))
+            lines.append((f"{self.name}_count", labels, cumulative))
+        return lines
+
+
+# A value that is set rather than accumulated. Either set() it, or track() a
+# callable that is read at scrape time (cheapest for values such as queue
+# depth that already exist somewhere).
+class Gauge:
+    kind = 'gauge'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self.values = {}
+        self.callbacks = {}
+
+    def set(self, value, labels=()):
+        self.values[labels] = value
+
+    def track(self, fn, labels=()):
+        self.callbacks[labels] = fn
+
+    def render(self):
+        values = dict(self.values)
+        for labels, fn in list(self.callbacks.items()):
+            values[labels] = fn()
+        return [(self.name, labels, value) for labels, value in sorted(values.items())]
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = {}
+
+    def _add(self, metric):
+        if metric.name in self.metrics:
+            raise ValueError(f"Metric {metric.name!r} is already registered")
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help, labels=()):
+        return self._add(Counter(name, help, labels))
+
+    def histogram(self, name, help, labels=(), buckets=latency_buckets):
+        return self._add(Histogram(name, help, labels, buckets))
+
+    def gauge(self, name, help, labels=()):
+        return self._add(Gauge(name, help, labels))
+
+    # Return every metric in the Prometheus text exposition format
+    def render(self):
+        out = []
+        for metric in self.metrics.values():
+            out.append(f"# HELP {metric.name} {metric.help}")
+            out.append(f"# TYPE {metric.name} {metric.kind}")
+            names = metric.label_names + (('le',) if metric.kind == 'histogram' else ())
+            for sample_name, labels, value in metric.render():
+                if labels:
+                    pairs = ','.join(f'{name}="{escape_label(value)}"' for name, value in zip(names, labels))
+                    out.append(f"{sample_name}{{{pairs}}} {format_value(value)}")
+                else:
+                    out.append(f"{sample_name} {format_value(value)}")
+        return '\n'.join(out) + '\n'
+
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer() and abs(value) < 1e15:
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+# Content type of registry.render() output
+content_type = 'text/plain; version=0.0.4; charset=utf-8'
+
+# The pipeline's metrics, shared by every module in the process
+registry = Registry()
+fetch_seconds = registry.histogram(
+    'aquiferst_fetch_seconds', 'Time to read every sensor endpoint of one ESP32 node', ('node',))
+fetch_failures = registry.counter(
+    'aquiferst_fetch_failures_total', 'ESP32 node fetches that ended in an error', ('node',))
+parse_seconds = registry.histogram(
+    'aquiferst_parse_seconds', 'Time to parse one sensor page')
+score_seconds = registry.histogram(
+    'aquiferst_score_seconds', 'Time to score one reading (incremental) or one batch (batch)', ('path',))
+cycle_seconds = registry.histogram(
+    'aquiferst_cycle_seconds', 'Duration of one pipeline cycle', ('loop',))
+readings_dropped = registry.counter(
+    'aquiferst_readings_dropped_total', 'Readings lost or discarded, by reason', ('reason',))
+readings_late = registry.counter(
+    'aquiferst_readings_late_total', 'Readings older than the newest already scored for their node')
+stale_values = registry.counter(
+    'aquiferst_stale_values_total', 'Sensor values served from the last good reading', ('node',))
+hedged_requests = registry.counter(
+    'aquiferst_hedged_requests_total', 'Requests sent a second time because the first was slow')
+breaker_skips = registry.counter(
+    'aquiferst_breaker_skips_total', 'Node fetches skipped because the node circuit breaker was open', ('node',))
+anomalies = registry.counter(
+    'aquiferst_anomalies_total', 'Sensor values flagged by the anomaly detector, by check', ('check',))
+queue_depth = registry.gauge(
+    'aquiferst_queue_depth', 'Readings waiting to be scored', ('queue',))
+
+
+# Compare the pipeline's hot loops with and without the metric calls they make
+def benchmark(n_calls=1_000_000, n_pages=1_000, n_readings=200_000):
+    from batch_scoring import score_batch, synthetic_readings
+    from incremental import IncrementalScorer
+    from sensor_page import parse_sensor_values, synthetic_page
+    from soil_health import unflatten_sensor_data
+
+    scratch = Registry()
+    counter = scratch.counter('c', 'counter')
+    labelled = scratch.counter('l', 'labelled counter', ('node',))
+    histogram = scratch.histogram('h', 'histogram')
+    labelled_histogram = scratch.histogram('lh', 'labelled histogram', ('node',))
+    for label, call in (
+        ('counter.inc()', lambda: counter.inc()),
+        ('counter.inc(labels)', lambda: labelled.inc(1, ('probe-17',))),
+        ('histogram.observe()', lambda: histogram.observe(0.004)),
+        ('histogram.observe(labels)', lambda: labelled_histogram.observe(0.004, ('probe-17',))),
+    ):
+        start = time.perf_counter()
+        for _ in range(n_calls):
+            call()
+        per_call = (time.perf_counter() - start) / n_calls
+        start = time.perf_counter()
+        for _ in range(n_calls):
+            (lambda: None)()
+        empty = (time.perf_counter() - start) / n_calls
+        print(f"{label:>26}: {(per_call - empty) * 1e9:6.0f} ns")
+
+    # Page loop, as app.py and the scoring worker run it: parse, score, and
+    # record parse time, score time and cycle time
+    pages = [synthetic_page(filler=20, values=(553 + i % 7, 4 + i % 3, 25, 60, 35, 10)) for i in range(n_pages)]
+    hist_parse = scratch.histogram('parse', 'parse')
+    hist_score = scratch.histogram('score', 'score', ('path',))
+    hist_cycle = scratch.histogram('cycle', 'cycle', ('loop',))
+
+    def page_loop(instrumented):
+        scorer = IncrementalScorer()
+        start = time.perf_counter()
+        for i, html in enumerate(pages):
+            began = time.perf_counter()
+            sensor_data = unflatten_sensor_data(parse_sensor_values(html))
+            parsed = time.perf_counter()
+            scorer.assess(i % 100, sensor_data)
+            if instrumented:
+                done = time.perf_counter()
+                hist_parse.observe(parsed - began)
+                hist_score.observe(done - parsed, ('incremental',))
+                hist_cycle.observe(done - began, ('page',))
+        return time.perf_counter() - start
+
+    # Batch loop, as the ingest server runs it: score batches of 5000 and
+    # record batch time, cycle time, drops and late readings
+    values = synthetic_readings(n_readings)
+    drops = scratch.counter('dropped', 'dropped', ('reason',))
+
+    def batch_loop(instrumented):
+        start = time.perf_counter()
+        for offset in range(0, n_readings, 5000):
+            began = time.perf_counter()
+            score_batch(values[offset:offset + 5000])
+            if instrumented:
+                done = time.perf_counter()
+                hist_score.observe(done - began, ('batch',))
+                hist_cycle.observe(done - began, ('ingest',))
+                drops.inc(0, ('queue_full',))
+        return time.perf_counter() - start
+
+    for label, loop in (('page loop', page_loop), ('ingest batch loop', batch_loop)):
+        # Interleaved pairs, so drift on a busy machine hits both sides; the
+        # median of the pairwise ratios is far steadier than either total
+        runs = [(loop(False), loop(True)) for _ in range(31)]
+        ratios = sorted(instrumented / bare for bare, instrumented in runs)
+        bare = sorted(run[0] for run in runs)[len(runs) // 2]
+        print(f"{label:>26}: {bare * 1000:8.1f} ms bare (median), "
+              f"overhead {(ratios[len(ratios) // 2] - 1) * 100:+.1f}% "
+              f"(middle half of pairs {(ratios[len(ratios) // 4] - 1) * 100:+.1f}% "
+              f"to {(ratios[3 * len(ratios) // 4] - 1) * 100:+.1f}%)")
+
+    # Scraping while 4 threads record
+    def record():
+        for _ in range(n_calls // 4):
+            labelled_histogram.observe(0.004, ('probe-17',))
+    threads = [threading.Thread(target=record) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    start = time.perf_counter()
+    text = scratch.render()
+    print(f"{'render':>26}: {(time.perf_counter() - start) * 1000:.2f} ms for {len(text)} bytes")
+    recorded = sum(labelled_histogram.collect()[('probe-17',)][:-1])
+    if recorded != 2 * n_calls:
+        raise AssertionError(f"lost samples: {recorded} recorded, {2 * n_calls} expected")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the cost of pipeline metrics.')
+    parser.add_argument('--calls', type=int, default=1_000_000)
+    args = parser.parse_args()
+    benchmark(args.calls)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,294 @@
+import argparse
+import time
+
+import numpy as np
+
+from soil_health import (
+    assess_soil_health,
+    flatten_sensor_data,
+    flatten_thresholds,
+    ideal_thresholds,
+    sensor_columns,
+    unflatten_sensor_data,
+)
+
+# Compact reading records with the fixed soil_health.sensor_columns schema.
+#
+# Reading holds one reading in __slots__: no per-instance dict and no nested
+# 'NPK_levels' dict. It iterates over its six values in sensor_columns order,
+# so everything built on flatten_sensor_data (assess_soil_health,
+# IncrementalScorer, SensorStore, Rollups, ThresholdModel) takes it as it is.
+# For code that still indexes the nested dict format, reading['Humidity'] and
+# reading['NPK_levels']['Nitrogen'] work too, and to_sensor_data() /
+# Reading.from_sensor_data() convert both ways.
+#
+# ReadingBatch holds many readings as a struct of arrays: one float64 array per
+# sensor column (stored as one (6, capacity) block), one of timestamps, and a
+# list of node ids. Single appends are staged in a short list and written to
+# the block `flush_rows` at a time (or when the arrays are read), since
+# writing one row into six numpy columns costs far more than the whole
+# vectorised copy per row; the block grows by doubling. `values` is an (n, 6)
+# view of the block with each column contiguous, which is the layout
+# batch_scoring.score_batch reads fastest, so scoring a batch never copies it.
+# Missing values are NaN in a batch and None in a Reading.
+
+# Staged single appends are written to the arrays this many at a time
+flush_rows = 4096
+
+n_columns = len(sensor_columns)
+field_names = tuple(name.lower() for group, name in sensor_columns)
+column_index = {name: i for i, (group, name) in enumerate(sensor_columns)}
+group_columns = {}
+for _i, (_group, _name) in enumerate(sensor_columns):
+    if _group:
+        group_columns.setdefault(_group, []).append((_name, _i))
+
+
+class Reading:
+    __slots__ = ('node_id', 'timestamp') + field_names
+
+    def __init__(self, nitrogen=None, phosphorus=None, potassium=None, humidity=None, temperature=None,
+                 soil_moisture=None, node_id=None, timestamp=None):
+        self.nitrogen = nitrogen
+        self.phosphorus = phosphorus
+        self.potassium = potassium
+        self.humidity = humidity
+        self.temperature = temperature
+        self.soil_moisture = soil_moisture
+        self.node_id = node_id
+        self.timestamp = timestamp
+
+    # Build a Reading from six values in sensor_columns order
+    @classmethod
+    def from_values(cls, values, node_id=None, timestamp=None):
+        return cls(*values, node_id=node_id, timestamp=timestamp)
+
+    # Build a Reading from the nested sensor_data dict format
+    @classmethod
+    def from_sensor_data(cls, sensor_data, node_id=None, timestamp=None):
+        return cls(*flatten_sensor_data(sensor_data), node_id=node_id, timestamp=timestamp)
+
+    def to_sensor_data(self):
+        return unflatten_sensor_data(self.values())
+
+    def values(self):
+        return (self.nitrogen, self.phosphorus, self.potassium, self.humidity, self.temperature, self.soil_moisture)
+
+    def __iter__(self):
+        return iter(self.values())
+
+    def __len__(self):
+        return n_columns
+
+    # Sequence access by column index, or nested-dict style access by column
+    # name or group name (a dict of that group's columns)
+    def __getitem__(self, key):
+        if isinstance(key, (int, slice)):
+            return self.values()[key]
+        if key in column_index:
+            return getattr(self, field_names[column_index[key]])
+        if key in group_columns:
+            return {name: getattr(self, field_names[i]) for name, i in group_columns[key]}
+        raise KeyError(key)
+
+    def __eq__(self, other):
+        if not isinstance(other, Reading):
+            return NotImplemented
+        return (self.node_id, self.timestamp, self.values()) == (other.node_id, other.timestamp, other.values())
+
+    def __repr__(self):
+        fields = ', '.join(f"{name}={getattr(self, name)!r}" for name in field_names)
+        return f"Reading({fields}, node_id={self.node_id!r}, timestamp={self.timestamp!r})"
+
+
+# Function to accept a reading in any supported form: a Reading, a nested
+# sensor_data dict, or six values in sensor_columns order
+def as_reading(reading, node_id=None, timestamp=None):
+    if isinstance(reading, Reading):
+        return reading
+    if isinstance(reading, dict):
+        return Reading.from_sensor_data(reading, node_id, timestamp)
+    return Reading.from_values(reading, node_id, timestamp)
+
+
+class ReadingBatch:
+    def __init__(self, capacity=1024):
+        self.capacity = max(1, capacity)
+        self.columns = np.full((n_columns, self.capacity), np.nan, dtype=np.float64)
+        self.times = np.zeros(self.capacity, dtype=np.float64)
+        self.node_ids = []
+        self.size = 0       # rows written to the arrays
+        self.pending = []   # staged rows: (timestamp, 6 values)
+
+    # Wrap existing arrays without copying: `values` is (n, 6), `timestamps`
+    # (n,), `node_ids` has n entries. The batch is full; appending copies it.
+    @classmethod
+    def from_arrays(cls, node_ids, timestamps, values):
+        batch = cls.__new__(cls)
+        values = np.asarray(values, dtype=np.float64).reshape(-1, n_columns)
+        batch.columns = values.T
+        batch.times = np.asarray(timestamps, dtype=np.float64)
+        batch.node_ids = list(node_ids)
+        batch.capacity = batch.size = len(batch.node_ids)
+        batch.pending = []
+        return batch
+
+    # Pack readings in any form as_reading accepts; a reading's own node id
+    # and timestamp win over those passed in
+    @classmethod
+    def from_readings(cls, readings, node_ids=None, timestamps=None):
+        readings = list(readings)
+        batch = cls(len(readings))
+        for i, reading in enumerate(readings):
+            reading = as_reading(reading)
+            node_id = reading.node_id if reading.node_id is not None else (node_ids[i] if node_ids else None)
+            timestamp = reading.timestamp if reading.timestamp is not None else (
+                timestamps[i] if timestamps is not None else float('nan'))
+            batch.append(node_id, timestamp, reading)
+        return batch
+
+    def _grow(self, needed):
+        capacity = self.capacity
+        while capacity < needed:
+            capacity *= 2
+        columns = np.full((n_columns, capacity), np.nan, dtype=np.float64)
+        columns[:, :self.size] = self.columns[:, :self.size]
+        times = np.zeros(capacity, dtype=np.float64)
+        times[:self.size] = self.times[:self.size]
+        self.columns, self.times, self.capacity = columns, times, capacity
+
+    # Write the staged rows to the arrays
+    def flush(self):
+        if not self.pending:
+            return
+        rows = np.array(self.pending, dtype=np.float64)  # None -> NaN
+        self.pending = []
+        start, end = self.size, self.size + len(rows)
+        if end > self.capacity:
+            self._grow(end)
+        self.times[start:end] = rows[:, 0]
+        self.columns[:, start:end] = rows[:, 1:].T
+        self.size = end
+
+    # Append one reading (any form as_reading accepts); None becomes NaN
+    def append(self, node_id, timestamp, reading):
+        values = reading.values() if isinstance(reading, Reading) else flatten_sensor_data(reading)
+        self.pending.append((timestamp, *values))
+        self.node_ids.append(node_id)
+        if len(self.pending) >= flush_rows:
+            self.flush()
+
+    # Append many readings at once from arrays: `values` is (n, 6)
+    def extend(self, node_ids, timestamps, values):
+        self.flush()
+        values = np.asarray(values, dtype=np.float64).reshape(-1, n_columns)
+        start, end = self.size, self.size + len(values)
+        if end > self.capacity:
+            self._grow(end)
+        self.columns[:, start:end] = values.T
+        self.times[start:end] = timestamps
+        self.node_ids.extend(node_ids)
+        self.size = end
+
+    def __len__(self):
+        return len(self.node_ids)
+
+    # (n, 6) view in sensor_columns order, column-contiguous
+    @property
+    def values(self):
+        self.flush()
+        return self.columns[:, :self.size].T
+
+    @property
+    def timestamps(self):
+        self.flush()
+        return self.times[:self.size]
+
+    def column(self, name):
+        self.flush()
+        return self.columns[column_index[name], :self.size]
+
+    # Unpack row `i` as a Reading
+    def reading(self, i):
+        self.flush()
+        values = [None if value != value else value for value in self.columns[:, i].tolist()]
+        return Reading.from_values(values, self.node_ids[i], float(self.times[i]))
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self.reading(i)
+
+    def __array__(self, dtype=None, copy=None):
+        values = self.values
+        return values if dtype is None else values.astype(dtype, copy=False)
+
+    # Bytes held by the arrays for the readings in the batch
+    @property
+    def nbytes(self):
+        return len(self) * (n_columns + 1) * 8
+
+
+def benchmark(n_readings=200_000):
+    import tracemalloc
+    from batch_scoring import score_batch, synthetic_readings
+
+    values = synthetic_readings(n_readings)
+    rows = values.tolist()
+    node_ids = [f"probe-{i % 1000}" for i in range(n_readings)]
+    timestamps = np.arange(n_readings, dtype=np.float64)
+
+    def build_dicts():
+        return [unflatten_sensor_data(row) for row in rows]
+
+    def build_readings():
+        return [Reading.from_values(row, node_id, t) for row, node_id, t in zip(rows, node_ids, timestamps.tolist())]
+
+    def build_batch():
+        batch = ReadingBatch()
+        for row, node_id, t in zip(rows, node_ids, timestamps.tolist()):
+            batch.append(node_id, t, row)
+        return batch
+
+    # The node id strings are shared by every layout and not counted
+    print(f"{n_readings} readings")
+    print(f"{'layout':>28} {'bytes/reading':>14} {'build s':>9}")
+    built = {}
+    for label, build in (('nested dicts', build_dicts), ('Reading (__slots__)', build_readings),
+                         ('ReadingBatch', build_batch)):
+        start = time.perf_counter()
+        build()
+        seconds = time.perf_counter() - start
+        tracemalloc.start()
+        built[label] = build()
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print(f"{label:>28} {current / n_readings:>14.0f} {seconds:>9.3f}")
+
+    dicts, readings, batch = built['nested dicts'], built['Reading (__slots__)'], built['ReadingBatch']
+    scored = score_batch(batch)
+    ideal_bands = flatten_thresholds(ideal_thresholds)
+    print(f"{'scoring':>28} {'readings/s':>14} {'s':>9}")
+    for label, score in (
+        ('assess_soil_health(dict)', lambda: [assess_soil_health(d, ideal_thresholds) for d in dicts]),
+        ('assess_soil_health(Reading)', lambda: [assess_soil_health(r, ideal_bands) for r in readings]),
+        ('score_batch(ReadingBatch)', lambda: score_batch(batch)),
+        ('score_batch(dicts)', lambda: score_batch(np.array([flatten_sensor_data(d) for d in dicts]))),
+    ):
+        start = time.perf_counter()
+        result = score()
+        seconds = time.perf_counter() - start
+        print(f"{label:>28} {n_readings / seconds:>14,.0f} {seconds:>9.3f}")
+        totals = [total for total, suggestions in result] if isinstance(result, list) else result['total_score']
+        if not np.array_equal(np.asarray(totals), scored['total_score']):
+            raise AssertionError(f"{label} disagrees with score_batch")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark compact reading records against nested dicts.')
+    parser.add_argument('--readings', type=int, default=200_000)
+    args = parser.parse_args()
+    benchmark(args.readings)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,195 @@
+import argparse
+import gzip
+import json
+import time
+from collections import namedtuple
+from functools import lru_cache
+
+# Structured recommendations.
+#
+# Scoring emits a Recommendation record per out-of-range variable instead of
+# a sentence, so consumers (app.js, the dashboard, irrigation planning) can
+# read the variable, direction and amount directly rather than parsing text:
+#
+#   kind      - which advice this is, and which sentence renders it:
+#               'fertilizer' (add grams of a nutrient), 'water' (add litres),
+#               'low' / 'high' (move a variable towards its band)
+#   variable  - sensor column name, e.g. 'Nitrogen' or 'Soil_Moisture'
+#   direction - 'increase' or 'decrease'
+#   amount    - how much to add, in `unit`; None for 'low' / 'high'
+#   unit      - 'g' or 'L'; None when there is no amount
+#   current   - the reading
+#   limit     - the edge of the ideal band the reading is outside of
+#
+# The sentence the old string lists carried is rendered only when asked for
+# (`.text`), from one template per kind, and memoised on the values it
+# prints: an unchanged reading renders once however many cycles repeat it.
+# Results sent to app.js and the dashboard carry only the records (as_dict),
+# with numbers rounded to the `display_digits` decimals shown; static/app.js
+# renders the same sentences when it displays them.
+
+# Sentence templates, as f-strings (several times faster than str.format)
+templates = {
+    'fertilizer': lambda variable, amount, current, limit:
+        f"Add {amount:.2f} grams of {variable} fertilizer to reach the ideal level.",
+    'water': lambda variable, amount, current, limit:
+        f"Add {amount:.2f} liters of water to increase soil moisture.",
+    'nutrient_high': lambda variable, amount, current, limit:
+        f"Decrease {variable} level: current {current}, ideal maximum {limit}.",
+    'low': lambda variable, amount, current, limit:
+        f"Increase {variable}: current {current}, ideal minimum {limit}.",
+    'high': lambda variable, amount, current, limit:
+        f"Decrease {variable}: current {current}, ideal maximum {limit}.",
+}
+
+render_cache_size = 65536
+display_digits = 2
+
+
+class Recommendation(namedtuple('Recommendation', 'kind variable direction amount unit current limit')):
+    __slots__ = ()
+
+    @property
+    def text(self):
+        kind, variable, direction, amount, unit, current, limit = self
+        if current == 0:
+            # 0.0 and -0.0 are the same cache key but print differently
+            return templates[kind](variable, amount, current, limit)
+        return render(kind, variable, amount, current, limit)
+
+    # JSON-ready dict without the fields that do not apply, numbers rounded
+    # to the decimals the dashboard shows
+    def as_dict(self):
+        return {key: round(value, display_digits) if isinstance(value, float) else value
+                for key, value in zip(self._fields, self) if value is not None}
+
+
+# typed, so that 30 and 30.0 (which print differently) are cached apart
+@lru_cache(maxsize=render_cache_size, typed=True)
+def render(kind, variable, amount, current, limit):
+    return templates[kind](variable, amount, current, limit)
+
+
+# Functions to build each kind of record. They are on the scoring hot path,
+# so they build the tuple directly rather than through the namedtuple's
+# keyword-handling __new__.
+_new = tuple.__new__
+
+
+def fertilizer(variable, grams, current, limit):
+    return _new(Recommendation, ('fertilizer', variable, 'increase', grams, 'g', current, limit))
+
+
+def water(litres, current, limit):
+    return _new(Recommendation, ('water', 'Soil_Moisture', 'increase', litres, 'L', current, limit))
+
+
+def too_low(variable, current, limit):
+    return _new(Recommendation, ('low', variable, 'increase', None, None, current, limit))
+
+
+def too_high(variable, current, limit, nutrient=False):
+    return _new(Recommendation, ('nutrient_high' if nutrient else 'high', variable, 'decrease', None, None, current,
+                                 limit))
+
+
+# Compare structured records with the string suggestions they replace
+def benchmark(n_readings=100_000, cycles=3):
+    import recommendations  # this module as soil_health imports it, not __main__
+    from batch_scoring import synthetic_readings
+    from soil_health import (
+        assess_soil_health,
+        calculate_nutrient_needed,
+        calculate_water_needed,
+        compute_score,
+        flatten_thresholds,
+        ideal_thresholds,
+        sensor_columns,
+        soil_bulk_density,
+    )
+
+    # assess_variable and the flat path of assess_soil_health as they were,
+    # building an f-string for every out-of-range variable
+    def old_assess_variable(group, variable, value, ideal_min, ideal_max, soil_volume_m3=1.0):
+        if value is None:
+            return 0.0, None
+        score = compute_score(value, ideal_min, ideal_max)
+        suggestion = None
+        if score < 1.0:
+            if group:
+                if value < ideal_min:
+                    soil_mass_kg = soil_bulk_density * soil_volume_m3
+                    amount_needed = calculate_nutrient_needed(value, ideal_min, soil_mass_kg)
+                    suggestion = f"Add {amount_needed:.2f} grams of {variable} fertilizer to reach the ideal level."
+                elif value > ideal_max:
+                    suggestion = f"Decrease {variable} level: current {value}, ideal maximum {ideal_max}."
+            elif value < ideal_min and variable == 'Soil_Moisture':
+                water_needed = calculate_water_needed(value, ideal_min, soil_volume_m3)
+                suggestion = f"Add {water_needed:.2f} liters of water to increase soil moisture."
+            elif value < ideal_min:
+                suggestion = f"Increase {variable}: current {value}, ideal minimum {ideal_min}."
+            elif value > ideal_max:
+                suggestion = f"Decrease {variable}: current {value}, ideal maximum {ideal_max}."
+        return score, suggestion
+
+    ideal_bands = flatten_thresholds(ideal_thresholds)
+
+    def old_assess(row):
+        scores = []
+        suggestions = []
+        for (group, name), value, (ideal_min, ideal_max) in zip(sensor_columns, row, ideal_bands):
+            score, suggestion = old_assess_variable(group, name, value, ideal_min, ideal_max)
+            scores.append(score)
+            if suggestion:
+                suggestions.append(suggestion)
+        return sum(scores) / len(scores), suggestions
+
+    # Readings as a fleet reports them, to one decimal: most out-of-range
+    # values repeat from cycle to cycle and across nodes
+    rows = [[round(value, 1) for value in row] for row in synthetic_readings(n_readings).tolist()]
+    recommendations.render.cache_clear()
+
+    # Each cycle scores every reading and drops the result, as the worker
+    # does; holding a whole cycle of records would mostly time the garbage
+    # collector walking them
+    old = lambda row: old_assess(row)[1]
+    structured = lambda row: assess_soil_health(row, ideal_bands, structured=True)[1]
+    text = lambda row: assess_soil_health(row, ideal_bands)[1]
+    print(f"{n_readings} readings, {cycles} cycles")
+    for label, assess in (('strings (old)', old), ('records', structured), ('records + text', text)):
+        seconds = []
+        for _ in range(cycles):
+            start = time.perf_counter()
+            for row in rows:
+                assess(row)
+            seconds.append(time.perf_counter() - start)
+        print(f"{label:>16}: first cycle {seconds[0] * 1e6 / n_readings:5.2f} us/reading, "
+              f"later cycles {min(seconds[1:]) * 1e6 / n_readings:5.2f} us/reading")
+    info = recommendations.render.cache_info()
+    print(f"{'render cache':>16}: {info.hits} hits, {info.misses} misses, {info.currsize} entries")
+
+    strings = [old(row) for row in rows]
+    if [text(row) for row in rows] != strings:
+        raise AssertionError("rendered records differ from the old strings")
+    records = [structured(row) for row in rows]
+    for label, payload in (
+        ('strings (old)', strings),
+        ('text + dicts', [[[record.text for record in node],
+                           [{key: value for key, value in zip(record._fields, record) if value is not None}
+                            for record in node]] for node in records]),
+        ('record dicts', [[record.as_dict() for record in node] for node in records]),
+    ):
+        body = json.dumps(payload, separators=(',', ':')).encode('utf-8')
+        print(f"{label:>16}: {len(body) / n_readings:6.1f} bytes/node JSON, "
+              f"{len(gzip.compress(body, 6)) / n_readings:5.1f} gzipped")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark structured recommendations against string suggestions.')
+    parser.add_argument('--readings', type=int, default=100_000)
+    args = parser.parse_args()
+    benchmark(args.readings)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,191 @@
+import argparse
+import random
+import time
+from concurrent.futures import FIRST_COMPLETED, wait
+
+# Building blocks that keep unreachable or misbehaving probes from costing
+# cycle time or producing false advice. ESP32Collector uses all three:
+#
+# CircuitBreaker - one per node. After `failure_threshold` cycles in a row in
+#   which a node could not be reached, the breaker opens and the node is not
+#   contacted at all until its backoff expires; the backoff doubles (with
+#   jitter) every time the node fails again, up to `max_backoff`. When it
+#   expires, one cycle probes the node ("half open"): success closes the
+#   breaker, failure re-opens it with the next backoff.
+#
+# hedged_call - runs a request and, if it has not answered after
+#   `hedge_after` seconds, sends the same request again and takes whichever
+#   answers first. This cuts the tail latency of a probe that drops or delays
+#   an occasional request, for the price of one extra request on the slow ones.
+#
+# LastGoodValues - the newest value every sensor produced. A sensor that could
+#   not be read (unreachable, open breaker, garbage text) is served from here
+#   with its age, for up to `max_age` seconds, instead of as a missing value.
+#   Callers must report such values as stale and must not record them as new
+#   readings.
+
+
+class CircuitBreaker:
+    def __init__(self, failure_threshold=3, base_backoff=10.0, max_backoff=600.0, jitter=0.2):
+        self.failure_threshold = failure_threshold
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+        self.failures = 0     # consecutive failed cycles
+        self.opened = 0       # consecutive times the breaker opened
+        self.retry_at = None  # monotonic time the open breaker lets a probe through
+
+    @property
+    def state(self):
+        if self.retry_at is None:
+            return 'closed'
+        return 'half_open' if time.monotonic() >= self.retry_at else 'open'
+
+    # Return True if the node may be contacted now
+    def allow(self, now=None):
+        return self.retry_at is None or (time.monotonic() if now is None else now) >= self.retry_at
+
+    # Seconds until an open breaker lets the next probe through (0 when closed)
+    def retry_in(self, now=None):
+        if self.retry_at is None:
+            return 0.0
+        return max(0.0, self.retry_at - (time.monotonic() if now is None else now))
+
+    def record_success(self):
+        self.failures = 0
+        self.opened = 0
+        self.retry_at = None
+
+    def record_failure(self, now=None):
+        now = time.monotonic() if now is None else now
+        self.failures += 1
+        if self.retry_at is not None or self.failures >= self.failure_threshold:
+            backoff = min(self.max_backoff, self.base_backoff * 2 ** self.opened)
+            self.retry_at = now + backoff * random.uniform(1 - self.jitter, 1 + self.jitter)
+            self.opened += 1
+
+
+# Function to run `call` on `executor`, sending it a second time if the first
+# attempt has not finished after `hedge_after` seconds. Returns
+# (result, hedged); raises the last attempt's exception if both fail, or
+# TimeoutError if neither finishes within `timeout`. `call` must be
+# idempotent, e.g. a GET.
+def hedged_call(executor, call, hedge_after, timeout):
+    deadline = time.monotonic() + timeout
+    attempts = [executor.submit(call)]
+    hedged = False
+    error = None
+    if hedge_after is not None and hedge_after < timeout:
+        done, _ = wait(attempts, timeout=hedge_after)
+        if not done:
+            attempts.append(executor.submit(call))
+            hedged = True
+    while attempts:
+        done, pending = wait(attempts, timeout=max(0.0, deadline - time.monotonic()), return_when=FIRST_COMPLETED)
+        if not done:
+            break
+        for attempt in done:
+            if attempt.exception() is None:
+                for other in pending:
+                    other.cancel()
+                return attempt.result(), hedged
+            error = attempt.exception()
+        attempts = list(pending)
+    if error is not None:
+        raise error
+    raise TimeoutError(f"no answer within {timeout}s")
+
+
+class LastGoodValues:
+    def __init__(self, max_age=3600.0):
+        self.max_age = max_age
+        self.values = {}  # (node id, sensor) -> (value, wall-clock time read)
+
+    # Record the fresh values in `raw` ({sensor: float or None}) and return
+    # (filled, stale): `filled` has every sensor that could not be read
+    # replaced by its last good value when one is recent enough, and `stale`
+    # maps those sensors to the age of the value served, in seconds.
+    def fill(self, node_id, raw, now=None):
+        now = time.time() if now is None else now
+        filled = dict(raw)
+        stale = {}
+        for sensor, value in raw.items():
+            if value is not None:
+                self.values[(node_id, sensor)] = (value, now)
+                continue
+            last = self.values.get((node_id, sensor))
+            if last is not None and now - last[1] <= self.max_age:
+                filled[sensor] = last[0]
+                stale[sensor] = now - last[1]
+        return filled, stale
+
+
+# Compare a plain collector with the resilient one on a fleet with dead,
+# garbage-serving and occasionally slow probes, all on a local fake server
+def benchmark(n_nodes=40, n_dead=8, n_garbage=4, slow_rate=0.05, cycles=12, node_deadline=1.0):
+    import contextlib
+    import io
+    from esp32_collector import ESP32Collector
+    from fake_esp32 import FakeESP32Server, FakeFleet
+    from soil_health import assess_soil_health, ideal_thresholds
+
+    dead = [str(i) for i in range(n_dead)]
+    garbage = [str(i) for i in range(n_dead, n_dead + n_garbage)]
+    fleet = FakeFleet(dead_nodes=dead, dead_latency=30.0, garbage_nodes=garbage,
+                      slow_rate=slow_rate, slow_latency=0.5)
+    server = FakeESP32Server(fleet)
+    server.start()
+    nodes = {str(i): server.node_url(i) for i in range(n_nodes)}
+    healthy = set(nodes) - set(dead) - set(garbage)
+
+    configurations = (
+        ('plain', dict(breaker_threshold=None, hedge_after=None, max_stale=0.0)),
+        ('resilient', dict(breaker_threshold=2, hedge_after=0.1, max_stale=3600.0)),
+    )
+    try:
+        for label, options in configurations:
+            # The default moisture (30%) is in range, so any water
+            # suggestion is a false irrigation order. Missing moisture used
+            # to be scored as 0%, which always ordered water.
+            false_orders = 0
+            missing_moisture = 0
+            healthy_errors = 0
+            durations = []
+            with ESP32Collector(nodes, max_in_flight=n_nodes, node_deadline=node_deadline,
+                                connect_timeout=0.2, **options) as collector:
+                # Every probe answers once, so the resilient collector has a
+                # last good value for each before trouble starts
+                fleet.dead_nodes, fleet.garbage_nodes = set(), set()
+                collector.collect()
+                fleet.dead_nodes, fleet.garbage_nodes = set(dead), set(garbage)
+                for _ in range(cycles):
+                    with contextlib.redirect_stdout(io.StringIO()):  # parse warnings for garbage
+                        batch = collector.collect()
+                    durations.append(batch['duration'])
+                    for node_id, sensor_data in batch['readings'].items():
+                        total_score, suggestions = assess_soil_health(sensor_data, ideal_thresholds)
+                        false_orders += any('liters of water' in s for s in suggestions)
+                        missing_moisture += sensor_data['Soil_Moisture'] is None
+                    healthy_errors += sum(node in batch['errors'] for node in healthy)
+            durations.sort()
+            print(f"{label:>10}: cycle median {durations[len(durations) // 2] * 1000:7.1f} ms, "
+                  f"max {durations[-1] * 1000:7.1f} ms; healthy nodes timing out {healthy_errors}")
+            print(f"{'':>10}  false irrigation orders {false_orders} (would have been {missing_moisture} "
+                  f"with 0 for missing); last cycle: {len(batch['stale'])} nodes served stale, "
+                  f"{len(batch['skipped'])} skipped by open breakers")
+    finally:
+        server.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the resilient fetch layer against a faulty fake fleet.')
+    parser.add_argument('--nodes', type=int, default=40)
+    parser.add_argument('--dead', type=int, default=8)
+    parser.add_argument('--garbage', type=int, default=4)
+    parser.add_argument('--cycles', type=int, default=12)
+    args = parser.parse_args()
+    benchmark(args.nodes, args.dead, args.garbage, cycles=args.cycles)
+
+
+if __name__ == "__main__":
+    main()
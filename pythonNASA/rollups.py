@@ -0,0 +1,376 @@
+import argparse
+import time
+
+import numpy as np
+
+from batch_scoring import score_batch, synthetic_readings
+from soil_health import compute_score, flatten_sensor_data, ideal_thresholds, sensor_columns
+
+# Incremental downsampling of sensor history for long-range dashboards.
+#
+# Every reading is folded into one bucket per resolution (1 minute, 1 hour,
+# 1 day) as it arrives. A bucket keeps, per sensor column, the count, min, max,
+# sum and last value, plus the sum of compute_score totals, so a week of data
+# at hourly resolution is 168 buckets regardless of how often probes report.
+# Each resolution keeps the buckets of its last `keep` periods, counted back
+# from the node's newest bucket; older ones are overwritten and nothing ever
+# rescans raw history.
+#
+# The buckets of one node at one resolution live in NumPy ring arrays (about
+# 210 bytes per bucket: min, max and last are float32) that grow by doubling
+# until they span the retention, so a node with a week of history does not
+# pay for twenty years of daily buckets.
+
+# (resolution in seconds, buckets kept per node)
+resolutions = [
+    (60, 7 * 24 * 60),         # 1 minute, one week
+    (3600, 2 * 366 * 24),      # 1 hour, two years
+    (86400, 20 * 366),         # 1 day, twenty years
+]
+n_columns = len(sensor_columns)
+column_names = [name for group, name in sensor_columns]
+
+
+# The buckets of one node at one resolution. Bucket number n (start
+# n * resolution) lives in slot n % capacity; a slot whose number is not n
+# is empty or holds a bucket that has left the retention.
+class BucketSeries:
+    __slots__ = ('resolution', 'keep', 'capacity', 'newest', 'oldest', 'pending', 'numbers', 'counts', 'sums',
+                 'mins', 'maxs', 'lasts', 'last_times', 'score_sums', 'score_counts')
+    arrays = ('numbers', 'counts', 'sums', 'mins', 'maxs', 'lasts', 'last_times', 'score_sums', 'score_counts')
+
+    def __init__(self, resolution, keep, capacity=8):
+        self.resolution = resolution
+        self.keep = keep
+        self.newest = None  # newest and oldest bucket numbers retained
+        self.oldest = None
+        self.pending = None  # [number, per-column lists..., score sum, score count] of merge_one's bucket
+        self._allocate(min(capacity, keep))
+
+    def _allocate(self, capacity):
+        self.capacity = capacity
+        self.numbers = np.full(capacity, -1, dtype=np.int64)
+        self.counts = np.zeros((capacity, n_columns), dtype=np.uint32)
+        self.sums = np.zeros((capacity, n_columns), dtype=np.float64)
+        self.mins = np.full((capacity, n_columns), np.inf, dtype=np.float32)
+        self.maxs = np.full((capacity, n_columns), -np.inf, dtype=np.float32)
+        self.lasts = np.full((capacity, n_columns), np.nan, dtype=np.float32)
+        self.last_times = np.full((capacity, n_columns), -np.inf, dtype=np.float64)
+        self.score_sums = np.zeros(capacity, dtype=np.float64)
+        self.score_counts = np.zeros(capacity, dtype=np.uint32)
+
+    # Move the retained buckets into arrays of `capacity` slots
+    def _resize(self, capacity):
+        held = self.held()
+        old = {name: getattr(self, name)[held] for name in self.arrays}
+        self._allocate(capacity)
+        slots = old['numbers'] % capacity
+        for name in self.arrays:
+            getattr(self, name)[slots] = old[name]
+
+    # Mask of the slots holding a retained bucket
+    def held(self):
+        self.flush()
+        if self.newest is None:
+            return np.zeros(self.capacity, dtype=bool)
+        return self.numbers > self.newest - self.keep
+
+    # Start (in seconds) of the oldest bucket this series can still hold, or
+    # None before it holds anything
+    def retained_from(self):
+        self.flush()
+        return None if self.newest is None else float((self.newest - self.keep + 1) * self.resolution)
+
+    def nbytes(self):
+        return sum(getattr(self, name).nbytes for name in self.arrays)
+
+    # Fold in the aggregates of runs of readings, one per bucket: `numbers`
+    # are ascending and unique, the rest are per-bucket arrays (see
+    # Rollups.add_batch). `last_times` is when each column's `lasts` value was
+    # read, so late readings never overwrite a newer last value. Returns the
+    # mask of buckets that were kept; the others are older than the retention.
+    def merge(self, numbers, counts, sums, mins, maxs, lasts, last_times, score_sums, score_counts):
+        self.flush()
+        newest = int(numbers[-1]) if self.newest is None else max(self.newest, int(numbers[-1]))
+        kept = numbers > newest - self.keep
+        if not kept[0]:
+            if not kept.any():
+                return kept
+            numbers, counts, sums, mins, maxs, lasts, last_times, score_sums, score_counts = (
+                array[kept] for array in (numbers, counts, sums, mins, maxs, lasts, last_times, score_sums,
+                                          score_counts))
+        self._extend(int(numbers[0]), newest)
+        slots = numbers % self.capacity
+        # Slots that are empty or hold a bucket past the retention start afresh
+        fresh = slots[self.numbers[slots] != numbers]
+        if len(fresh):
+            self.numbers[fresh] = numbers[self.numbers[slots] != numbers]
+            self.counts[fresh] = 0
+            self.sums[fresh] = 0.0
+            self.mins[fresh] = np.inf
+            self.maxs[fresh] = -np.inf
+            self.lasts[fresh] = np.nan
+            self.last_times[fresh] = -np.inf
+            self.score_sums[fresh] = 0.0
+            self.score_counts[fresh] = 0
+
+        self.counts[slots] += counts.astype(np.uint32)
+        self.sums[slots] += sums
+        self.mins[slots] = np.fmin(self.mins[slots], mins)
+        self.maxs[slots] = np.fmax(self.maxs[slots], maxs)
+        newer = (counts > 0) & (last_times >= self.last_times[slots])
+        self.lasts[slots] = np.where(newer, lasts, self.lasts[slots])
+        self.last_times[slots] = np.where(newer, last_times, self.last_times[slots])
+        self.score_sums[slots] += score_sums
+        self.score_counts[slots] += score_counts.astype(np.uint32)
+        return kept
+
+    # Fold in one reading: `row` is its six values (NaN when missing) and
+    # `score` its total (NaN when missing). The bucket being filled is kept in
+    # plain lists and written to the arrays (flush) when a reading for another
+    # bucket arrives or the series is read, so a live reading costs a few list
+    # updates rather than a dozen NumPy calls. Returns whether it was kept.
+    def merge_one(self, number, row, timestamp, score):
+        pending = self.pending
+        if pending is None or pending[0] != number:
+            newest = max(number, -1 if self.newest is None else self.newest, -1 if pending is None else pending[0])
+            if number <= newest - self.keep:
+                return False
+            self.flush()
+            pending = self.pending = [number, [0] * n_columns, [0.0] * n_columns, [np.inf] * n_columns,
+                                      [-np.inf] * n_columns, [np.nan] * n_columns, [-np.inf] * n_columns, 0.0, 0]
+        number, counts, sums, mins, maxs, lasts, last_times = pending[:7]
+        for i, value in enumerate(row):
+            if value != value:  # NaN: missing
+                continue
+            counts[i] += 1
+            sums[i] += value
+            if value < mins[i]:
+                mins[i] = value
+            if value > maxs[i]:
+                maxs[i] = value
+            if timestamp >= last_times[i]:
+                lasts[i] = value
+                last_times[i] = timestamp
+        if score == score:
+            pending[7] += score
+            pending[8] += 1
+        return True
+
+    # Write the bucket merge_one is filling to the arrays
+    def flush(self):
+        pending, self.pending = self.pending, None
+        if pending is not None:
+            self.merge(np.array([pending[0]], dtype=np.int64), *(np.array([field]) for field in pending[1:]))
+
+    # Record that buckets `first`..`newest` are being written, growing the
+    # arrays when the retained span no longer fits
+    def _extend(self, first, newest):
+        oldest = first if self.oldest is None else min(self.oldest, first)
+        self.newest, self.oldest = newest, max(oldest, newest - self.keep + 1)
+        span = self.newest - self.oldest + 1
+        if span > self.capacity and self.capacity < self.keep:
+            capacity = self.capacity
+            while capacity < span:
+                capacity *= 2
+            self._resize(min(capacity, self.keep))
+
+
+# Function to turn float32 statistics into lists of Python floats rounded
+# to float32's seven significant digits (so 21.3 stays 21.3), None where the
+# column had no readings
+def _reported(values, present):
+    values = values.astype(np.float64)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        digits = 6 - np.floor(np.log10(np.abs(values)))
+    scale = 10.0 ** np.where(np.isfinite(digits), digits, 0.0)
+    values = (np.round(values * scale) / scale).tolist()
+    return [[v if p else None for v, p in zip(row, row_present)] for row, row_present in zip(values, present)]
+
+
+class Rollups:
+    def __init__(self, thresholds=ideal_thresholds, resolutions=resolutions):
+        self.thresholds = thresholds
+        self.bands = flatten_sensor_data(thresholds)
+        self.resolutions = resolutions
+        self.series = {}  # node id -> [BucketSeries per resolution]
+        self.late_dropped = 0  # readings older than the retained window
+
+    def node_ids(self):
+        return sorted(self.series)
+
+    def _node_series(self, node_id):
+        node_series = self.series.get(node_id)
+        if node_series is None:
+            node_series = self.series[node_id] = [BucketSeries(resolution, keep)
+                                                  for resolution, keep in self.resolutions]
+        return node_series
+
+    # Fold one reading into every resolution. `reading` is a sensor_data dict or
+    # a sequence in sensor_columns order; `score` defaults to the compute_score
+    # total for the reading.
+    def add(self, node_id, timestamp, reading, score=None):
+        if isinstance(reading, dict):
+            reading = flatten_sensor_data(reading)
+        row = [float('nan') if value is None else float(value) for value in reading]
+        if score is None:
+            score = sum(compute_score(value, *band) for value, band in zip(row, self.bands)) / n_columns
+        timestamp = float(timestamp)
+        for series in self._node_series(str(node_id)):
+            if not series.merge_one(int(timestamp // series.resolution), row, timestamp, score):
+                self.late_dropped += 1
+
+    # Fold many readings of one node at once: timestamps in seconds and an
+    # (n, 6) values array. Rows are grouped per bucket with NumPy and all
+    # touched buckets are updated in one step.
+    def add_batch(self, node_id, timestamps, values, scores=None):
+        timestamps = np.asarray(timestamps, dtype=np.float64)
+        values = np.asarray(values, dtype=np.float64).reshape(-1, n_columns)
+        if not len(timestamps):
+            return
+        if scores is None:
+            scores = score_batch(values, self.thresholds)['total_score']
+        scores = np.asarray(scores, dtype=np.float64)
+
+        order = np.argsort(timestamps, kind='stable')
+        timestamps, values, scores = timestamps[order], values[order], scores[order]
+        present = ~np.isnan(values)
+        filled = np.where(present, values, 0.0)
+        score_present = ~np.isnan(scores)
+        # Last non-missing value per column up to each row, and when it was read
+        last_index = np.maximum.accumulate(np.where(present, np.arange(len(values))[:, None], -1), axis=0)
+        last_index = np.maximum(last_index, 0)
+        last_values = values[last_index, np.arange(n_columns)]
+        last_times = timestamps[last_index]
+
+        for series in self._node_series(str(node_id)):
+            numbers = np.floor(timestamps / series.resolution).astype(np.int64)
+            edges = np.flatnonzero(np.diff(numbers)) + 1
+            firsts = np.concatenate(([0], edges))
+            lasts = np.concatenate((edges, [len(numbers)])) - 1
+
+            kept = series.merge(
+                numbers[firsts],
+                np.add.reduceat(present, firsts, axis=0),
+                np.add.reduceat(filled, firsts, axis=0),
+                np.fmin.reduceat(values, firsts, axis=0),
+                np.fmax.reduceat(values, firsts, axis=0),
+                last_values[lasts],
+                last_times[lasts],
+                np.add.reduceat(np.where(score_present, scores, 0.0), firsts),
+                np.add.reduceat(score_present, firsts),
+            )
+            if not kept.all():
+                self.late_dropped += int((lasts - firsts + 1)[~kept].sum())
+
+    # Function to pick the finest resolution whose bucket count over the window
+    # stays within `max_points` and whose retention still covers `start` (for
+    # `node_id`, or any node), falling back to the coarsest one that covers it
+    def pick_resolution(self, start, end, max_points, node_id=None):
+        span = max(end - start, 0)
+        node_series = self.series.get(str(node_id)) if node_id is not None else None
+        covering = []
+        for index, (resolution, keep) in enumerate(self.resolutions):
+            if node_series is not None:
+                retained_from = node_series[index].retained_from()
+            else:
+                retained_from = max((node[index].retained_from() for node in self.series.values()
+                                     if node[index].retained_from() is not None), default=None)
+            if retained_from is None or start >= retained_from:
+                covering.append(resolution)
+        for resolution in covering:
+            if span / resolution <= max_points:
+                return resolution
+        return covering[-1] if covering else self.resolutions[-1][0]
+
+    # Return the buckets of one node in [start, end) at the chosen resolution,
+    # column-wise so it serialises compactly:
+    #   {'resolution': 3600, 'columns': [...], 't': [...], 'count': [...],
+    #    'min': [[...6], ...], 'max': ..., 'mean': ..., 'last': ..., 'score': [...]}
+    # Missing statistics (no readings for a column) are None.
+    def query(self, node_id, start, end, max_points=500, resolution=None):
+        if resolution is None:
+            resolution = self.pick_resolution(start, end, max_points, node_id)
+        index = [r for r, keep in self.resolutions].index(resolution)
+        node_series = self.series.get(str(node_id))
+
+        result = {'resolution': resolution, 'columns': column_names, 't': [], 'count': [],
+                  'min': [], 'max': [], 'mean': [], 'last': [], 'score': []}
+        if node_series is None:
+            return result
+        series = node_series[index]
+        held = series.held()
+        starts = series.numbers * float(resolution)
+        slots = np.flatnonzero(held & (starts >= start) & (starts < end))
+        slots = slots[np.argsort(series.numbers[slots])]
+        counts = series.counts[slots]
+        present = (counts > 0).tolist()
+        with np.errstate(divide='ignore', invalid='ignore'):
+            means = series.sums[slots] / counts
+            scores = series.score_sums[slots] / series.score_counts[slots]
+        result['t'] = starts[slots].tolist()
+        result['count'] = counts.max(axis=1).tolist() if len(slots) else []
+        result['min'] = _reported(series.mins[slots], present)
+        result['max'] = _reported(series.maxs[slots], present)
+        result['mean'] = [[v if p else None for v, p in zip(row, row_present)]
+                          for row, row_present in zip(means.tolist(), present)]
+        result['last'] = _reported(series.lasts[slots], present)
+        result['score'] = [None if score != score else score for score in scores.tolist()]
+        return result
+
+    # Function to report the bytes held by every node's bucket arrays
+    def nbytes(self):
+        return sum(series.nbytes() for node_series in self.series.values() for series in node_series)
+
+    # Build rollups for `node_ids` from a SensorStore, e.g. when a worker starts.
+    # This is the only place history is read; afterwards use add()/add_batch().
+    def warm_from_store(self, store, node_ids=None, since=None):
+        for node_id in node_ids if node_ids is not None else store.nodes():
+            for timestamps, values in store.iter_chunks(node_id, since):
+                self.add_batch(node_id, timestamps, values)
+
+
+def benchmark(n_nodes=100, days=7, interval=10):
+    rows_per_node = days * 86400 // interval
+    start_time = 1_700_000_000
+    timestamps = start_time + np.arange(rows_per_node, dtype=np.float64) * interval
+    rollups = Rollups()
+
+    values = synthetic_readings(rows_per_node)
+    start = time.perf_counter()
+    for node in range(n_nodes):
+        rollups.add_batch(f"probe-{node}", timestamps, values)
+    batch_seconds = time.perf_counter() - start
+    total = n_nodes * rows_per_node
+    print(f"batch: {total} readings into 3 resolutions in {batch_seconds:.2f}s "
+          f"({total / batch_seconds:,.0f} readings/s)")
+
+    live = Rollups()
+    sample = values[:20_000].tolist()
+    start = time.perf_counter()
+    for i, row in enumerate(sample):
+        live.add('live', start_time + i * interval, row)
+    live_seconds = time.perf_counter() - start
+    print(f"live: {len(sample)} single readings in {live_seconds:.2f}s "
+          f"({live_seconds / len(sample) * 1e6:.1f} us/reading)")
+
+    for label, span, points in (('1 day', 86400, 500), ('1 week', 7 * 86400, 500), ('1 week', 7 * 86400, 100)):
+        start = time.perf_counter()
+        result = rollups.query('probe-3', start_time, start_time + span, points)
+        elapsed = (time.perf_counter() - start) * 1000
+        print(f"query {label:>6}, <= {points} points: resolution {result['resolution']}s, "
+              f"{len(result['t'])} points in {elapsed:.2f} ms")
+    print(f"memory: {rollups.nbytes() / n_nodes / 1e6:.2f} MB per node for {days} days of history")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark incremental rollups.')
+    parser.add_argument('--nodes', type=int, default=100)
+    parser.add_argument('--days', type=int, default=7)
+    parser.add_argument('--interval', type=int, default=10, help='seconds between readings')
+    args = parser.parse_args()
+    benchmark(args.nodes, args.days, args.interval)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,413 @@
+import argparse
+import bisect
+import calendar
+import json
+import os
+import re
+import shutil
+import tempfile
+import time
+import warnings
+
+import numpy as np
+
+# NASA SMAP soil moisture and IMERG precipitation, converted once into tiled,
+# memory-mapped time series so probes can look up "their" satellite cell
+# without decoding granules.
+#
+# Supported granules (HDF5, read with h5py):
+#   smap   SMAP L3 radiometer daily soil moisture (SPL3SMP), e.g.
+#          SMAP_L3_SM_P_20230101_R18290_001.h5
+#          Soil_Moisture_Retrieval_Data_AM/{soil_moisture, latitude, longitude}
+#          2-D EASE-Grid 2.0 lat/lon arrays, volumetric m^3/m^3, fill -9999
+#   imerg  GPM IMERG precipitation (3B-HHR or 3B-DAY), e.g.
+#          3B-HHR.MS.MRG.3IMERG.20230101-S000000-E002959.0000.V07B.HDF5
+#          Grid/{precipitation, lat, lon, time}; precipitation is (time, lon, lat),
+#          mm/hr, fill -9999.9
+#
+# Layout of a converted product:
+#   <root>/meta.json        product, tile size, block length, time of every slot
+#   <root>/lat.npy, lon.npy 1-D cell-centre axes of the grid
+#   <root>/block-NNNN.npy   float32 (tiles_lat, tiles_lon, tile, tile, block_len)
+# Each granule fills one time slot. Within a block the slots of one cell are
+# contiguous, so a cell's series is one short read per block, and tiles keep
+# neighbouring cells in the same pages. Missing values are NaN.
+
+products = {
+    'smap': {
+        'group': 'Soil_Moisture_Retrieval_Data_AM',
+        'variable': 'soil_moisture',
+        'fill': -9999.0,
+        'units': 'm3/m3',
+    },
+    'imerg': {
+        'group': 'Grid',
+        'variable': 'precipitation',
+        'fill': -9999.9,
+        'units': 'mm/hr',
+    },
+}
+smap_date_pattern = re.compile(r'_(\d{8})_')
+imerg_start_pattern = re.compile(r'\.(\d{8}-S\d{6})-')
+
+
+def _require_h5py():
+    try:
+        import h5py
+    except ImportError:
+        raise ImportError("h5py is required to read SMAP/IMERG granules: pip install h5py") from None
+    return h5py
+
+
+# Function to fill NaN entries of a 1-D coordinate axis by linear interpolation
+def _fill_axis(axis):
+    axis = np.asarray(axis, dtype=np.float64)
+    missing = np.isnan(axis)
+    if missing.all():
+        raise ValueError("coordinate axis has no valid values")
+    if missing.any():
+        index = np.arange(len(axis))
+        axis[missing] = np.interp(index[missing], index[~missing], axis[~missing])
+    return axis
+
+
+# Function to tell whether two coordinate axes are the same grid lines. SMAP
+# axes are averaged from each granule's land cells, so they agree only to
+# within rounding.
+def _same_axis(axis, stored):
+    return len(axis) == len(stored) and np.allclose(axis, stored, rtol=0.0, atol=1e-4)
+
+
+# Function to read one SMAP L3 granule into (time, lat axis, lon axis, grid).
+# EASE-Grid 2.0 is separable, so the 2-D lat/lon arrays reduce to one latitude
+# per row and one longitude per column.
+def read_smap_granule(path):
+    h5py = _require_h5py()
+    spec = products['smap']
+    timestamp = granule_time(path, 'smap')
+
+    with h5py.File(path, 'r') as f:
+        group = f[spec['group']]
+        grid = group[spec['variable']][...].astype(np.float32)
+        lat = group['latitude'][...].astype(np.float64)
+        lon = group['longitude'][...].astype(np.float64)
+
+    grid[grid == spec['fill']] = np.nan
+    lat[lat == spec['fill']] = np.nan
+    lon[lon == spec['fill']] = np.nan
+    # Rows or columns that are all ocean have no coordinates; they are filled in
+    # from their neighbours
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        lat_axis = _fill_axis(np.nanmean(lat, axis=1))
+        lon_axis = _fill_axis(np.nanmean(lon, axis=0))
+    return timestamp, lat_axis, lon_axis, grid
+
+
+# Function to read one IMERG granule into (time, lat axis, lon axis, grid).
+# IMERG stores precipitation lon-major; the grid is returned as (lat, lon).
+def read_imerg_granule(path):
+    h5py = _require_h5py()
+    spec = products['imerg']
+    with h5py.File(path, 'r') as f:
+        group = f[spec['group']]
+        precipitation = group[spec['variable']][0]
+        lat_axis = group['lat'][...].astype(np.float64)
+        lon_axis = group['lon'][...].astype(np.float64)
+        timestamp = float(group['time'][0])
+
+    grid = np.ascontiguousarray(precipitation.T, dtype=np.float32)
+    grid[grid <= spec['fill'] + 0.05] = np.nan
+    return timestamp, lat_axis, lon_axis, grid
+
+
+granule_readers = {'smap': read_smap_granule, 'imerg': read_imerg_granule}
+
+
+# Function to tell a granule's time without decoding it: from the date or
+# start time in its file name, else (IMERG) from its time variable
+def granule_time(path, product):
+    name = os.path.basename(path)
+    if product == 'smap':
+        match = smap_date_pattern.search(name)
+        if not match:
+            raise ValueError(f"Cannot find the date in SMAP file name {path!r}")
+        return calendar.timegm(time.strptime(match.group(1), '%Y%m%d'))
+    match = imerg_start_pattern.search(name)
+    if match:
+        return calendar.timegm(time.strptime(match.group(1), '%Y%m%d-S%H%M%S'))
+    with _require_h5py().File(path, 'r') as f:
+        return float(f[products[product]['group']]['time'][0])
+
+
+# Nearest-cell lookup on a separable (1-D lat x 1-D lon) grid. Two binary
+# searches over plain lists: a few microseconds per probe, no grid decoding.
+class GridIndex:
+    def __init__(self, lat_axis, lon_axis):
+        lat_axis = np.asarray(lat_axis, dtype=np.float64)
+        lon_axis = np.asarray(lon_axis, dtype=np.float64)
+        # SMAP rows run north to south; search an ascending copy
+        self.lat_descending = len(lat_axis) > 1 and lat_axis[0] > lat_axis[-1]
+        self.lat = (lat_axis[::-1] if self.lat_descending else lat_axis).tolist()
+        self.lon = np.sort(lon_axis).tolist()
+        self.lon_order = np.argsort(lon_axis).tolist()
+        spacing = (self.lon[-1] - self.lon[0]) / max(len(self.lon) - 1, 1)
+        self.lon_global = self.lon[-1] - self.lon[0] + spacing >= 359.0
+        self.n_lat = len(self.lat)
+
+    @staticmethod
+    def _nearest(axis, value):
+        i = bisect.bisect_left(axis, value)
+        if i <= 0:
+            return 0
+        if i >= len(axis):
+            return len(axis) - 1
+        return i if axis[i] - value < value - axis[i - 1] else i - 1
+
+    # Return the (row, col) of the cell nearest to a probe
+    def nearest(self, lat, lon):
+        row = self._nearest(self.lat, lat)
+        if self.lat_descending:
+            row = self.n_lat - 1 - row
+
+        lon = (lon + 180.0) % 360.0 - 180.0
+        col = self._nearest(self.lon, lon)
+        if self.lon_global:
+            # Across the antimeridian the first and last columns are neighbours
+            first, last = self.lon[0], self.lon[-1]
+            if col == 0 and (lon + 360.0 - last) < (first - lon):
+                col = len(self.lon) - 1
+            elif col == len(self.lon) - 1 and (first + 360.0 - lon) < (lon - last):
+                col = 0
+        return row, self.lon_order[col]
+
+
+class TiledGrid:
+    def __init__(self, root):
+        self.root = root
+        with open(os.path.join(root, 'meta.json'), 'r', encoding='utf-8') as f:
+            self.meta = json.load(f)
+        self.lat = np.load(os.path.join(root, 'lat.npy'))
+        self.lon = np.load(os.path.join(root, 'lon.npy'))
+        self.tile = self.meta['tile']
+        self.block_len = self.meta['block_len']
+        self.tiles_lat = -(-len(self.lat) // self.tile)
+        self.tiles_lon = -(-len(self.lon) // self.tile)
+        self.index = GridIndex(self.lat, self.lon)
+        self.blocks = {}
+        self._sort_times()
+
+    # Create an empty product at `root` for a grid with the given 1-D axes
+    @classmethod
+    def create(cls, root, product, lat_axis, lon_axis, tile=32, block_len=64):
+        os.makedirs(root, exist_ok=True)
+        np.save(os.path.join(root, 'lat.npy'), np.asarray(lat_axis, dtype=np.float64))
+        np.save(os.path.join(root, 'lon.npy'), np.asarray(lon_axis, dtype=np.float64))
+        meta = {'product': product, 'units': products[product]['units'],
+                'tile': tile, 'block_len': block_len, 'times': []}
+        with open(os.path.join(root, 'meta.json'), 'w', encoding='utf-8') as f:
+            json.dump(meta, f)
+        return cls(root)
+
+    @property
+    def times(self):
+        return self.meta['times']
+
+    def _sort_times(self):
+        times = np.asarray(self.times, dtype=np.float64)
+        self.order = np.argsort(times, kind='stable')
+        self.sorted_times = times[self.order]
+
+    def _block(self, number, create=False):
+        block = self.blocks.get(number)
+        if block is None:
+            path = os.path.join(self.root, f'block-{number:04d}.npy')
+            if create and not os.path.exists(path):
+                shape = (self.tiles_lat, self.tiles_lon, self.tile, self.tile, self.block_len)
+                block = np.lib.format.open_memmap(path, mode='w+', dtype=np.float32, shape=shape)
+                block[...] = np.nan
+            else:
+                block = np.load(path, mmap_mode='r+' if create else 'r')
+            self.blocks[number] = block
+        return block
+
+    # Add one time step; `grid` is (lat, lon) float32 with NaN where missing
+    def append(self, timestamp, grid):
+        grid = np.asarray(grid, dtype=np.float32)
+        if grid.shape != (len(self.lat), len(self.lon)):
+            raise ValueError(f"grid shape {grid.shape} does not match axes {(len(self.lat), len(self.lon))}")
+        slot = len(self.times)
+        block = self._block(slot // self.block_len, create=True)
+
+        padded = np.full((self.tiles_lat * self.tile, self.tiles_lon * self.tile), np.nan, dtype=np.float32)
+        padded[:grid.shape[0], :grid.shape[1]] = grid
+        tiled = padded.reshape(self.tiles_lat, self.tile, self.tiles_lon, self.tile).transpose(0, 2, 1, 3)
+        block[..., slot % self.block_len] = tiled
+        block.flush()
+
+        self.times.append(float(timestamp))
+        with open(os.path.join(self.root, 'meta.json'), 'w', encoding='utf-8') as f:
+            json.dump(self.meta, f)
+        self._sort_times()
+
+    # Return (times, values) of cell (row, col), sorted by time, within [start, end)
+    def cell_series(self, row, col, start=None, end=None):
+        tile_row, in_row = divmod(row, self.tile)
+        tile_col, in_col = divmod(col, self.tile)
+        n_slots = len(self.times)
+        slots = np.empty(n_slots, dtype=np.float32)
+        for number in range(-(-n_slots // self.block_len)):
+            first = number * self.block_len
+            count = min(self.block_len, n_slots - first)
+            slots[first:first + count] = self._block(number)[tile_row, tile_col, in_row, in_col, :count]
+
+        lo = 0 if start is None else np.searchsorted(self.sorted_times, start, 'left')
+        hi = len(self.sorted_times) if end is None else np.searchsorted(self.sorted_times, end, 'left')
+        return self.sorted_times[lo:hi], slots[self.order[lo:hi]]
+
+    # Return (times, values) of the cell nearest to a probe
+    def series(self, lat, lon, start=None, end=None):
+        return self.cell_series(*self.index.nearest(lat, lon), start, end)
+
+
+# Function to convert granule files into a tiled product at `root`, adding to
+# it if it already exists. Granules are added in time order, one decoded at a
+# time; a granule on a different grid than the product's is rejected.
+def convert_granules(paths, root, product, tile=32, block_len=64):
+    read = granule_readers[product]
+    grid = TiledGrid(root) if os.path.exists(os.path.join(root, 'meta.json')) else None
+    for path in sorted(paths, key=lambda path: granule_time(path, product)):
+        timestamp, lat_axis, lon_axis, values = read(path)
+        if grid is None:
+            grid = TiledGrid.create(root, product, lat_axis, lon_axis, tile, block_len)
+        elif not (_same_axis(lat_axis, grid.lat) and _same_axis(lon_axis, grid.lon)):
+            raise ValueError(f"{path!r} is not on the grid of the product at {root!r}")
+        grid.append(timestamp, values)
+    return grid
+
+
+# Function to write a small SMAP-like granule for offline checks and demos
+def write_synthetic_smap(directory, date, n_rows=40, n_cols=96, seed=0):
+    h5py = _require_h5py()
+    rng = np.random.default_rng(seed)
+    lat_axis = np.linspace(85.0, -85.0, n_rows)
+    lon_axis = np.linspace(-180.0, 180.0, n_cols, endpoint=False) + 180.0 / n_cols
+    lat = np.repeat(lat_axis[:, None], n_cols, axis=1)
+    lon = np.repeat(lon_axis[None, :], n_rows, axis=0)
+    moisture = rng.uniform(0.02, 0.5, size=(n_rows, n_cols))
+    ocean = rng.random((n_rows, n_cols)) < 0.3
+    for array in (lat, lon, moisture):
+        array[ocean] = -9999.0
+
+    path = os.path.join(directory, f'SMAP_L3_SM_P_{date}_R18290_001.h5')
+    with h5py.File(path, 'w') as f:
+        group = f.create_group(products['smap']['group'])
+        group['soil_moisture'] = moisture.astype(np.float32)
+        group['latitude'] = lat.astype(np.float32)
+        group['longitude'] = lon.astype(np.float32)
+    return path
+
+
+# Function to write a small IMERG-like granule for offline checks and demos
+def write_synthetic_imerg(directory, timestamp, n_lat=36, n_lon=72, seed=0):
+    h5py = _require_h5py()
+    rng = np.random.default_rng(seed)
+    stamp = time.strftime('%Y%m%d-S%H%M%S', time.gmtime(timestamp))
+    precipitation = rng.exponential(0.5, size=(1, n_lon, n_lat)) * (rng.random((1, n_lon, n_lat)) < 0.2)
+    precipitation[0, rng.random((n_lon, n_lat)) < 0.05] = -9999.9
+
+    path = os.path.join(directory, f'3B-HHR.MS.MRG.3IMERG.{stamp}-E000000.0000.V07B.HDF5')
+    with h5py.File(path, 'w') as f:
+        group = f.create_group('Grid')
+        group['precipitation'] = precipitation.astype(np.float32)
+        group['lat'] = np.linspace(-90.0, 90.0, n_lat, endpoint=False) + 90.0 / n_lat
+        group['lon'] = np.linspace(-180.0, 180.0, n_lon, endpoint=False) + 180.0 / n_lon
+        group['time'] = np.array([timestamp], dtype=np.int64)
+    return path
+
+
+# Convert synthetic granules, check every cell against a full decode and time
+# probe lookups
+def self_check(n_days=100):
+    root = tempfile.mkdtemp(prefix='aquiferst-satellite-')
+    try:
+        start = calendar.timegm((2023, 1, 1, 0, 0, 0))
+        granules = {'smap': [], 'imerg': []}
+        for day in range(n_days):
+            date = time.strftime('%Y%m%d', time.gmtime(start + day * 86400))
+            granules['smap'].append(write_synthetic_smap(root, date, seed=day))
+            granules['imerg'].append(write_synthetic_imerg(root, start + day * 86400, seed=day))
+
+        for product, paths in granules.items():
+            convert_start = time.perf_counter()
+            grid = convert_granules(paths, os.path.join(root, product), product, tile=16, block_len=32)
+            convert_seconds = time.perf_counter() - convert_start
+
+            decoded = [granule_readers[product](path) for path in paths]
+            expected = np.stack([granule[3] for granule in decoded])
+            for row in range(expected.shape[1]):
+                for col in range(expected.shape[2]):
+                    times, values = grid.cell_series(row, col)
+                    if not np.array_equal(values, expected[:, row, col], equal_nan=True):
+                        raise AssertionError(f"{product} cell {(row, col)} differs from the granules")
+
+            rng = np.random.default_rng(1)
+            probes = list(zip(rng.uniform(-80, 80, 1000).tolist(), rng.uniform(-180, 180, 1000).tolist()))
+            for lat, lon in probes[:100]:
+                row, col = grid.index.nearest(lat, lon)
+                brute_row = int(np.argmin(np.abs(grid.lat - lat)))
+                brute_col = int(np.argmin(np.minimum(np.abs(grid.lon - lon), 360 - np.abs(grid.lon - lon))))
+                if (row, col) != (brute_row, brute_col):
+                    raise AssertionError(f"{product} nearest cell of {(lat, lon)} is {(brute_row, brute_col)}, got {(row, col)}")
+
+            lookup_start = time.perf_counter()
+            for lat, lon in probes:
+                grid.index.nearest(lat, lon)
+            index_us = (time.perf_counter() - lookup_start) / len(probes) * 1e6
+            lookup_start = time.perf_counter()
+            for lat, lon in probes:
+                grid.series(lat, lon)
+            series_us = (time.perf_counter() - lookup_start) / len(probes) * 1e6
+            decode_start = time.perf_counter()
+            granule_readers[product](paths[0])
+            decode_ms = (time.perf_counter() - decode_start) * 1000
+
+            print(f"{product}: {n_days} granules of {expected.shape[1]}x{expected.shape[2]} converted in "
+                  f"{convert_seconds:.2f}s; nearest cell {index_us:.1f} us, "
+                  f"{n_days}-step series {series_us:.1f} us (decoding one granule: {decode_ms:.2f} ms)")
+        print("all cells match the granules")
+    finally:
+        shutil.rmtree(root)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Convert SMAP/IMERG granules to tiled time series and look up probes.')
+    subparsers = parser.add_subparsers(dest='command')
+    convert = subparsers.add_parser('convert', help='convert granules into a tiled product directory')
+    convert.add_argument('product', choices=sorted(products))
+    convert.add_argument('root', help='output directory (added to if it exists)')
+    convert.add_argument('granules', nargs='+')
+    convert.add_argument('--tile', type=int, default=32)
+    convert.add_argument('--block-len', type=int, default=64)
+    lookup = subparsers.add_parser('lookup', help='print the series of the cell nearest to a probe')
+    lookup.add_argument('root')
+    lookup.add_argument('lat', type=float)
+    lookup.add_argument('lon', type=float)
+    subparsers.add_parser('check', help='round-trip and time synthetic granules offline')
+    args = parser.parse_args()
+
+    if args.command == 'convert':
+        grid = convert_granules(args.granules, args.root, args.product, args.tile, args.block_len)
+        print(f"{args.root}: {len(grid.times)} time steps of {len(grid.lat)}x{len(grid.lon)}")
+    elif args.command == 'lookup':
+        grid = TiledGrid(args.root)
+        row, col = grid.index.nearest(args.lat, args.lon)
+        print(f"cell {(row, col)} at ({grid.lat[row]:.3f}, {grid.lon[col]:.3f}), {grid.meta['units']}")
+        for timestamp, value in zip(*grid.cell_series(row, col)):
+            print(f"{time.strftime('%Y-%m-%d %H:%M', time.gmtime(timestamp))}  {value:.4f}")
+    else:
+        self_check()
+
+
+if __name__ == "__main__":
+    main()
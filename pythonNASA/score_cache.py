@@ -0,0 +1,108 @@
+import gzip
+import hashlib
+import json
+import threading
+import time
+
+# Precomputed API responses for the latest score of every node.
+#
+# Scoring code calls update() when a node has a new result; HTTP handlers only
+# ever read. Each node keeps its result plus, built on first request after a
+# change, the response body as JSON, its gzip encoding and an ETag (a hash
+# of the body, so it stays valid across restarts), so a
+# request costs a dict lookup whether the client gets 200 or 304. The bulk
+# body for every node is cached the same way and rebuilt at most once per
+# change of any node.
+
+# Responses smaller than this are not worth compressing
+gzip_min_bytes = 512
+
+
+# One cached response body in both encodings
+class CachedBody:
+    __slots__ = ('etag', 'body', 'gzipped')
+
+    def __init__(self, payload):
+        self.body = json.dumps(payload, separators=(',', ':')).encode('utf-8')
+        self.etag = f'"{hashlib.blake2b(self.body, digest_size=12).hexdigest()}"'
+        self.gzipped = gzip.compress(self.body, 6) if len(self.body) >= gzip_min_bytes else None
+
+
+class ScoreCache:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = {}    # node id -> {'score', 'recommendations', 'lastUpdated'}
+        self.bodies = {}     # node id -> CachedBody of its current entry
+        self.version = 0     # bumped on every change of any node
+        self.bulk = None     # CachedBody of every node, for self.version
+        self.listeners = []  # callables notified with (node_id, entry) on change
+
+    # Record a node's latest result. `records` are
+    # recommendations.Recommendation records, stored as their dicts; the
+    # text is rendered by whoever displays them. Returns False and leaves
+    # the entry as it is, lastUpdated included, when score and records are
+    # unchanged: lastUpdated is when the result last changed, and always
+    # matches the cached bodies and their ETags.
+    def update(self, node_id, score, records, timestamp=None):
+        node_id = str(node_id)
+        recommendations = [record.as_dict() for record in records]
+        timestamp = time.time() if timestamp is None else timestamp
+        with self.lock:
+            entry = self.entries.get(node_id)
+            if entry is not None and entry['score'] == score and entry['recommendations'] == recommendations:
+                return False
+            entry = {'score': score, 'recommendations': recommendations, 'lastUpdated': iso_time(timestamp)}
+            self.entries[node_id] = entry
+            self.version += 1
+            self.bodies.pop(node_id, None)
+            self.bulk = None
+        for listener in self.listeners:
+            listener(node_id, entry)
+        return True
+
+    # Record the results of many nodes at once, e.g. from an IngestServer
+    # batch: `results` holds a (score, records) pair per node
+    def update_many(self, node_ids, results, timestamps=None):
+        timestamps = timestamps if timestamps is not None else [None] * len(node_ids)
+        changed = 0
+        for node_id, (score, records), timestamp in zip(node_ids, results, timestamps):
+            changed += self.update(node_id, score, records, timestamp)
+        return changed
+
+    # Return the CachedBody for one node, or None if it has no result yet
+    def node_body(self, node_id):
+        node_id = str(node_id)
+        body = self.bodies.get(node_id)
+        if body is not None:
+            return body
+        with self.lock:
+            entry = self.entries.get(node_id)
+            if entry is None:
+                return None
+            body = self.bodies[node_id] = CachedBody(entry)
+        return body
+
+    # Return the CachedBody of every node, column-wise to keep it compact:
+    #   {"version": 12, "nodes": [...], "score": [...], "recommendations": [[...], ...],
+    #    "lastUpdated": [...]}
+    def bulk_body(self):
+        body = self.bulk
+        if body is not None:
+            return body
+        with self.lock:
+            node_ids = sorted(self.entries)
+            entries = [self.entries[node_id] for node_id in node_ids]
+            payload = {
+                'version': self.version,
+                'nodes': node_ids,
+                'score': [entry['score'] for entry in entries],
+                'recommendations': [entry['recommendations'] for entry in entries],
+                'lastUpdated': [entry['lastUpdated'] for entry in entries],
+            }
+            body = self.bulk = CachedBody(payload)
+        return body
+
+
+# Function to format a Unix timestamp the way app.js reports lastUpdated
+def iso_time(timestamp):
+    return time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(timestamp)) + f'.{int(timestamp % 1 * 1000):03d}Z'
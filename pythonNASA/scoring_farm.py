@@ -0,0 +1,239 @@
+import argparse
+import multiprocessing
+import os
+import time
+import zlib
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from batch_scoring import score_batch, synthetic_readings
+from soil_health import ideal_thresholds, sensor_columns
+
+# Sharded multi-process scoring for fleets too large for one interpreter.
+#
+# Nodes are assigned to one of N worker processes by crc32(node_id) % N, so a
+# node is always scored by the same worker. The parent owns three shared
+# memory blocks sized for `capacity` rows: the cycle's readings (n, 6), a row
+# order that groups rows by shard, and the results (n, 11). Per cycle the
+# parent copies the readings in once, sends each worker a tiny
+# ('score', start, end) message over a pipe, and the worker gathers its rows
+# order[start:end], scores them and writes their results in place; shards own
+# disjoint rows, so no locking is needed. Readings never get pickled and the
+# only serial work left in the parent is one copy in and one copy out.
+#
+# Output columns: the 6 per-variable scores, total score, litres of water,
+# grams of N, P and K (see batch_scoring.score_batch).
+
+n_columns = len(sensor_columns)
+n_outputs = n_columns + 1 + 1 + 3
+
+
+# Function to pick the shard of a node; stable across runs and processes
+def shard_for(node_id, n_shards):
+    return zlib.crc32(str(node_id).encode('utf-8')) % n_shards
+
+
+# The three shared arrays of a farm, attached by name in every process
+class SharedBlocks:
+    def __init__(self, capacity, names=None):
+        self.capacity = capacity
+        sizes = (capacity * n_columns * 8, capacity * 8, capacity * n_outputs * 8)
+        if names is None:
+            self.blocks = [shared_memory.SharedMemory(create=True, size=size) for size in sizes]
+        else:
+            self.blocks = [shared_memory.SharedMemory(name=name) for name in names]
+        self.values = np.ndarray((capacity, n_columns), dtype=np.float64, buffer=self.blocks[0].buf)
+        self.order = np.ndarray((capacity,), dtype=np.int64, buffer=self.blocks[1].buf)
+        self.results = np.ndarray((capacity, n_outputs), dtype=np.float64, buffer=self.blocks[2].buf)
+
+    @property
+    def names(self):
+        return [block.name for block in self.blocks]
+
+    def close(self, unlink=False):
+        del self.values, self.order, self.results
+        for block in self.blocks:
+            block.close()
+            if unlink:
+                block.unlink()
+
+
+def _worker_main(connection, names, capacity, thresholds):
+    shared = SharedBlocks(capacity, names)
+    try:
+        while True:
+            message = connection.recv()
+            if message[0] == 'stop':
+                break
+            if message[0] == 'attach':
+                # The parent grew the blocks for a larger cycle
+                shared.close()
+                shared = SharedBlocks(message[2], message[1])
+                connection.send(('attached',))
+                continue
+            start, end = message[1], message[2]
+            if end > start:
+                rows = shared.order[start:end]
+                scored = score_batch(shared.values[rows], thresholds)
+                out = np.empty((end - start, n_outputs), dtype=np.float64)
+                out[:, :n_columns] = scored['scores']
+                out[:, n_columns] = scored['total_score']
+                out[:, n_columns + 1] = scored['water_needed']
+                out[:, n_columns + 2:] = scored['nutrient_needed']
+                shared.results[rows] = out
+            connection.send(('done',))
+    finally:
+        shared.close()
+
+
+class ScoringFarm:
+    def __init__(self, n_workers=os.cpu_count() or 1, capacity=1 << 16, thresholds=ideal_thresholds):
+        self.n_workers = n_workers
+        self.shards = {}  # node id -> shard, so crc32 runs once per node
+        self.shared = SharedBlocks(capacity)
+        self.workers = []
+        context = multiprocessing.get_context('spawn')
+        for _ in range(n_workers):
+            parent, child = context.Pipe()
+            process = context.Process(
+                target=_worker_main,
+                args=(child, self.shared.names, capacity, thresholds),
+                daemon=True,
+            )
+            process.start()
+            self.workers.append((process, parent))
+
+    def _grow(self, n_rows):
+        capacity = self.shared.capacity
+        while capacity < n_rows:
+            capacity *= 2
+        shared = SharedBlocks(capacity)
+        for process, connection in self.workers:
+            connection.send(('attach', shared.names, capacity))
+        for process, connection in self.workers:
+            connection.recv()
+        self.shared.close(unlink=True)
+        self.shared = shared
+
+    # Group the rows of a cycle by shard. The plan only depends on the node id
+    # of every row, so a fleet that reports in a fixed order can compute it
+    # once and pass it to every score() call.
+    def plan(self, node_ids):
+        shards = self.shards
+        n_workers = self.n_workers
+        shard_ids = np.empty(len(node_ids), dtype=np.int64)
+        for i, node_id in enumerate(node_ids):
+            shard = shards.get(node_id)
+            if shard is None:
+                shard = shards[node_id] = shard_for(node_id, n_workers)
+            shard_ids[i] = shard
+        order = np.argsort(shard_ids, kind='stable')
+        bounds = np.searchsorted(shard_ids[order], np.arange(n_workers + 1))
+        return order, bounds
+
+    # Score one cycle of readings: `node_ids` has one id per row of the (n, 6)
+    # `values` array. Returns a score_batch-style dict in the same row order.
+    def score(self, node_ids, values, plan=None):
+        values = np.asarray(values, dtype=np.float64).reshape(-1, n_columns)
+        n_rows = len(values)
+        order, bounds = plan if plan is not None else self.plan(node_ids)
+        if n_rows > self.shared.capacity:
+            self._grow(n_rows)
+
+        shared = self.shared
+        shared.values[:n_rows] = values
+        shared.order[:n_rows] = order
+        for shard, (process, connection) in enumerate(self.workers):
+            connection.send(('score', int(bounds[shard]), int(bounds[shard + 1])))
+        for process, connection in self.workers:
+            connection.recv()
+
+        results = shared.results[:n_rows].copy()
+        return {
+            'scores': results[:, :n_columns],
+            'total_score': results[:, n_columns],
+            'water_needed': results[:, n_columns + 1],
+            'nutrient_needed': results[:, n_columns + 2:],
+        }
+
+    def close(self):
+        for process, connection in self.workers:
+            try:
+                connection.send(('stop',))
+            except (BrokenPipeError, OSError):
+                pass
+        for process, connection in self.workers:
+            process.join(timeout=5)
+        self.workers = []
+        self.shared.close(unlink=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def benchmark(n_nodes=100_000, readings_per_cycle=1_000_000, cycles=20, worker_counts=(1, 2, 4, 8)):
+    node_ids = [f"probe-{i}" for i in range(n_nodes)]
+    rows = np.arange(readings_per_cycle) % n_nodes
+    cycle_ids = [node_ids[i] for i in rows.tolist()]
+    values = synthetic_readings(readings_per_cycle)
+    expected = score_batch(values)
+
+    start = time.perf_counter()
+    score_batch(values)
+    single = time.perf_counter() - start
+    print(f"{readings_per_cycle} readings/cycle over {n_nodes} nodes, {os.cpu_count()} CPU(s) available")
+    print(f"{'in-process':>12}: {readings_per_cycle / single:>12,.0f} readings/s, cycle {single * 1000:.1f} ms")
+
+    means = {}
+    for n_workers in worker_counts:
+        with ScoringFarm(n_workers) as farm:
+            plan = farm.plan(cycle_ids)
+            result = farm.score(cycle_ids, values, plan)  # warm-up, grows the shared blocks
+            for key in expected:
+                if not np.array_equal(result[key], expected[key]):
+                    raise AssertionError(f"{key} differs from score_batch with {n_workers} workers")
+            latencies = []
+            for _ in range(cycles):
+                start = time.perf_counter()
+                farm.score(cycle_ids, values, plan)
+                latencies.append(time.perf_counter() - start)
+        latencies.sort()
+        mean = means[n_workers] = sum(latencies) / len(latencies)
+        p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+        print(f"{n_workers:>4} workers: {readings_per_cycle / mean:>12,.0f} readings/s, "
+              f"cycle mean {mean * 1000:.1f} ms, p99 {p99 * 1000:.1f} ms")
+
+    # Work the parent cannot hand to workers: copying readings in and results
+    # out. With fewer cores than workers the numbers above cannot scale; this
+    # bounds the speed-up when there are enough cores.
+    shared = SharedBlocks(readings_per_cycle)
+    start = time.perf_counter()
+    for _ in range(cycles):
+        shared.values[:] = values
+        shared.order[:] = plan[0]
+        shared.results.copy()
+    serial = (time.perf_counter() - start) / cycles
+    shared.close(unlink=True)
+    work = means.get(1, single)
+    for n_workers in worker_counts:
+        bound = 1 / (serial / work + (1 - serial / work) / n_workers)
+        print(f"{n_workers:>4} workers on {n_workers} cores: at most {bound:.1f}x "
+              f"(parent serial copies {serial * 1000:.1f} ms/cycle)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the multi-process scoring farm.')
+    parser.add_argument('--nodes', type=int, default=100_000)
+    parser.add_argument('--readings', type=int, default=1_000_000, help='readings per cycle')
+    parser.add_argument('--cycles', type=int, default=20)
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8])
+    args = parser.parse_args()
+    benchmark(args.nodes, args.readings, args.cycles, args.workers)
+
+
+if __name__ == "__main__":
+    main()
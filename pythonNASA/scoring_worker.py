@@ -0,0 +1,365 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+from anomaly import AnomalyDetector
+from esp32_collector import ESP32Collector
+from forecast import MoistureForecaster, moisture_history, rain_history, watering_schedule
+from incremental import FileChangeDetector, IncrementalScorer
+from metrics import cycle_seconds, parse_seconds, registry, score_seconds
+from rollups import Rollups
+from satellite import TiledGrid
+from sensor_page import parse_sensor_page
+from sensor_store import SensorStore
+from soil_health import (assess_soil_health, esp32_ip, flatten_sensor_data, format_esp32_readings, ideal_thresholds,
+                         sensor_columns, unflatten_sensor_data)
+from threshold_model import ThresholdModel
+
+# Long-lived scoring process for app.js.
+#
+# Instead of exec'ing `python soil_health.py` every cycle and scraping the score
+# out of its printed output, app.js starts this worker once and talks to it over
+# stdin/stdout with newline-delimited JSON, one object per line:
+#
+#   request:  {"id": 7, "method": "assess", "params": {"esp32_ip": "http://..."}}
+#   response: {"id": 7, "result": {"score": 0.83, "recommendations": [...], ...}}
+#         or: {"id": 7, "error": "description"}
+#
+# Methods:
+#   ping   - returns "pong"; used to check the worker is alive
+#   assess - fetch from an ESP32 (params.esp32_ip, default soil_health.esp32_ip)
+#            and score it; returns score, recommendations (records: kind,
+#            variable, direction, amount, unit, current, limit, rendered as
+#            text by whoever displays them), sensor_data, errors,
+#            changed (false when the result is the same as last cycle's),
+#            stale ({sensor: age in seconds} for values that could not be
+#            read and were taken from the last good reading) and anomalies
+#            ({sensor: [checks]} for values the AnomalyDetector flagged)
+#   assess_file - the same for a local sensor page (params.path, default
+#            please.html next to this file); an unchanged file is not re-read
+#   score  - score params.sensor_data (the assess_soil_health dict format)
+#   stats  - counters of skipped cycles and variables (see IncrementalScorer)
+#   forecast - predicted soil moisture of every node for the next
+#            params.hours (default 72) from its last 14 days of hourly
+#            rollups and IMERG rainfall, and the consolidated watering
+#            schedule
+#   thresholds - the bands currently used for params.node_id (default: the
+#            default ESP32), fitted per node from its history
+#   history - downsampled trend for params.node_id (default: the default ESP32)
+#             over [params.start, params.end) in seconds, with at most
+#             params.points buckets; see Rollups.query for the result format
+#   metrics - the worker's pipeline metrics (fetch, parse, score and cycle
+#             timings, drops) as Prometheus text; app.js serves it on /metrics
+#
+# If SENSOR_STORE is set in the environment, every reading fetched by `assess`
+# is appended to the sensor history store at that path, keyed by ESP32 address,
+# and the trend rollups are rebuilt from it when the worker starts.
+#
+# `assess` scores each ESP32 against its own threshold bands. A ThresholdModel
+# learns them from every reading (and the store, if any, at start-up) and
+# refits in the background every THRESHOLD_REFIT_SECONDS (default 300); until
+# a node has enough history its bands stay close to ideal_thresholds.
+#
+# Forecasts learn how much each node's moisture rises per mm of rain from the
+# IMERG product converted at IMERG_GRID (see satellite.py convert), at the
+# node positions in the JSON file NODE_LOCATIONS ({node id: [lat, lon]}).
+# Without them, or for nodes without a position, the forecast is fitted
+# without rain.
+#
+# Readings are checked for sensor faults before they are scored or recorded,
+# as in app.py: ANOMALY_MODE=quarantine (the default) leaves flagged values
+# out of the score and the history, flag only reports them, off skips the
+# check.
+
+default_page_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'please.html')
+
+
+# Function to build the common part of a scoring result from the score and its
+# recommendation records
+def scored(total_score, records):
+    return {
+        'score': total_score,
+        'recommendations': [record.as_dict() for record in records],
+    }
+
+
+# Function to copy `sensor_data` with the sensors named in `found` (as from
+# AnomalyDetector.check) set to None
+def without_sensors(sensor_data, found):
+    return unflatten_sensor_data([None if name in found else value
+                                  for (group, name), value in zip(sensor_columns, flatten_sensor_data(sensor_data))])
+
+
+# Handles requests for one worker process, keeping a pooled collector per ESP32
+class ScoringWorker:
+    def __init__(self, default_esp32_ip=esp32_ip, thresholds=ideal_thresholds, store=None, detector=None,
+                 imerg=None, locations=None):
+        self.default_esp32_ip = default_esp32_ip
+        self.thresholds = thresholds
+        self.store = store
+        self.detector = detector
+        self.imerg = imerg
+        self.locations = locations or {}
+        self.collectors = {}
+        self.file_detectors = {}
+        self.scorer = IncrementalScorer(thresholds)
+        self.threshold_model = ThresholdModel(thresholds)
+        self.rollups = Rollups(thresholds)
+        if store is not None:
+            self.rollups.warm_from_store(store)
+            self.threshold_model.observe_store(store)
+            self.threshold_model.refit()
+
+    def collector_for(self, esp32_ip):
+        collector = self.collectors.get(esp32_ip)
+        if collector is None:
+            collector = ESP32Collector({esp32_ip: esp32_ip}, max_in_flight=1)
+            self.collectors[esp32_ip] = collector
+        return collector
+
+    def score(self, sensor_data):
+        total_score, records = assess_soil_health(sensor_data, self.thresholds, structured=True)
+        return dict(scored(total_score, records), sensor_data=sensor_data)
+
+    # Score a reading of a long-lived source through the incremental scorer,
+    # re-scoring only what changed since its last reading
+    def score_node(self, node_id, sensor_data, bands=None):
+        started = time.perf_counter()
+        total_score, records = self.scorer.assess(node_id, sensor_data, bands, structured=True)
+        score_seconds.observe(time.perf_counter() - started, ('incremental',))
+        changed = node_id in self.scorer.pop_dirty()
+        return dict(scored(total_score, records), sensor_data=sensor_data, changed=changed)
+
+    def assess(self, esp32_ip):
+        started = time.perf_counter()
+        batch = self.collector_for(esp32_ip).collect()
+        sensor_data = batch['readings'][esp32_ip]
+        bands = self.threshold_model.table.bands(esp32_ip)
+        # Only what was actually read this cycle is checked and goes into the
+        # history; values kept from the last good reading were checked then
+        fresh = None if esp32_ip in batch['errors'] else format_esp32_readings(batch['raw'][esp32_ip])
+        found = {}
+        if esp32_ip in batch['unchanged'] and self.scorer.result(esp32_ip) and self.scorer.nodes[esp32_ip].bands == bands:
+            self.scorer.skip_cycle()
+            result = dict(scored(*self.scorer.result(esp32_ip, structured=True)), sensor_data=sensor_data,
+                          changed=False)
+        else:
+            if fresh is not None and self.detector is not None:
+                found, fresh = self.detector.check(esp32_ip, fresh)
+                if found and self.detector.mode == 'quarantine':
+                    sensor_data = without_sensors(sensor_data, found)
+            result = self.score_node(esp32_ip, sensor_data, bands)
+        if fresh is not None:
+            self.threshold_model.observe(esp32_ip, fresh)
+            self.rollups.add(esp32_ip, batch['started'], fresh, result['score'])
+            if self.store is not None:
+                self.store.append(esp32_ip, batch['started'], fresh)
+        result['errors'] = list(batch['errors'].values())
+        result['stale'] = batch['stale'].get(esp32_ip, {})
+        result['anomalies'] = found
+        cycle_seconds.observe(time.perf_counter() - started, ('worker',))
+        return result
+
+    def assess_file(self, path):
+        detector = self.file_detectors.get(path)
+        if detector is None:
+            detector = self.file_detectors[path] = FileChangeDetector(path)
+        changed, html = detector.check()
+        if not changed and self.scorer.result(path):
+            self.scorer.skip_cycle()
+            return dict(scored(*self.scorer.result(path, structured=True)), changed=False, anomalies={})
+        started = time.perf_counter()
+        sensor_data = parse_sensor_page(html)
+        parse_seconds.observe(time.perf_counter() - started)
+        found = {}
+        if self.detector is not None:
+            found, sensor_data = self.detector.check(path, sensor_data)
+        result = self.score_node(path, sensor_data)
+        del result['sensor_data']
+        result['anomalies'] = found
+        return result
+
+    def forecast(self, hours):
+        node_ids = self.rollups.node_ids()
+        end = time.time() // 3600 * 3600
+        if not node_ids:
+            return {'start': end, 'forecast': {}, 'schedule': []}
+        history = moisture_history(self.rollups, node_ids, end - 14 * 86400, end)
+        rain = None
+        if self.imerg is not None:
+            rain = rain_history(self.imerg, node_ids, self.locations, end - 14 * 86400, end)
+        forecaster = MoistureForecaster()
+        forecaster.fit(node_ids, history, rain, end_time=end)
+        predicted = forecaster.predict(hours)
+        table = self.threshold_model.table
+        moisture_min = [table.thresholds(node_id)['Soil_Moisture'][0] for node_id in node_ids]
+        return {
+            'start': end,
+            'forecast': {node_id: row for node_id, row in zip(node_ids, predicted.round(2).tolist())},
+            'schedule': watering_schedule(node_ids, predicted, end, moisture_min),
+        }
+
+    def stats(self):
+        stats = dict(self.scorer.stats)
+        stats['file_checks'] = sum(d.checks for d in self.file_detectors.values())
+        stats['file_reads'] = sum(d.reads for d in self.file_detectors.values())
+        return stats
+
+    def handle(self, request):
+        method = request.get('method')
+        params = request.get('params') or {}
+        if method == 'ping':
+            return 'pong'
+        if method == 'score':
+            return self.score(params['sensor_data'])
+        if method == 'assess':
+            return self.assess(params.get('esp32_ip') or self.default_esp32_ip)
+        if method == 'assess_file':
+            return self.assess_file(params.get('path') or default_page_path)
+        if method == 'stats':
+            return self.stats()
+        if method == 'metrics':
+            return registry.render()
+        if method == 'forecast':
+            return self.forecast(int(params.get('hours') or 72))
+        if method == 'thresholds':
+            table = self.threshold_model.table
+            return {'version': table.version,
+                    'thresholds': table.thresholds(params.get('node_id') or self.default_esp32_ip)}
+        if method == 'history':
+            end = params.get('end') or time.time()
+            start = params.get('start') or end - 7 * 86400
+            node_id = params.get('node_id') or self.default_esp32_ip
+            return self.rollups.query(node_id, float(start), float(end), int(params.get('points') or 500))
+        raise ValueError(f"Unknown method: {method!r}")
+
+    def close(self):
+        self.threshold_model.stop()
+        for collector in self.collectors.values():
+            collector.close()
+        if self.store is not None:
+            self.store.close()
+
+
+# Function to serve requests from `requests_in` until EOF, writing responses to `responses_out`
+def serve(requests_in, responses_out):
+    store_path = os.environ.get('SENSOR_STORE')
+    anomaly_mode = os.environ.get('ANOMALY_MODE', 'quarantine')
+    imerg_path = os.environ.get('IMERG_GRID')
+    locations_path = os.environ.get('NODE_LOCATIONS')
+    locations = {}
+    if locations_path:
+        with open(locations_path, 'r', encoding='utf-8') as f:
+            locations = {node_id: tuple(position) for node_id, position in json.load(f).items()}
+    worker = ScoringWorker(store=SensorStore(store_path) if store_path else None,
+                           detector=None if anomaly_mode == 'off' else AnomalyDetector(ideal_thresholds, anomaly_mode),
+                           imerg=TiledGrid(imerg_path) if imerg_path else None, locations=locations)
+    worker.threshold_model.start(float(os.environ.get('THRESHOLD_REFIT_SECONDS', 300)))
+    try:
+        for line in requests_in:
+            line = line.strip()
+            if not line:
+                continue
+            request_id = None
+            try:
+                request = json.loads(line)
+                request_id = request.get('id')
+                response = {'id': request_id, 'result': worker.handle(request)}
+            except Exception as e:
+                response = {'id': request_id, 'error': f"{type(e).__name__}: {e}"}
+            responses_out.write(json.dumps(response) + '\n')
+            responses_out.flush()
+    finally:
+        worker.close()
+
+
+# Function to read user+system CPU seconds of a running child process (Linux only)
+def process_cpu_seconds(pid):
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+    except OSError:
+        return float('nan')
+    return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+
+# Compare the old exec-per-cycle approach with a persistent worker, against a
+# local fake ESP32 so the numbers measure process and protocol overhead only.
+def benchmark(cycles):
+    import resource
+    from fake_esp32 import FakeESP32Server
+
+    server = FakeESP32Server()
+    server.start()
+    here = os.path.dirname(os.path.abspath(__file__))
+    env = dict(os.environ, ESP32_IP=server.base_url)
+
+    # Old approach: what app.js did, one shell + interpreter per cycle
+    command = f'"{sys.executable}" -u "{os.path.join(here, "soil_health.py")}"'
+    cpu_before = resource.getrusage(resource.RUSAGE_CHILDREN)
+    latencies = []
+    for _ in range(cycles):
+        start = time.perf_counter()
+        subprocess.run(command, shell=True, env=env, capture_output=True, check=True)
+        latencies.append(time.perf_counter() - start)
+    cpu_after = resource.getrusage(resource.RUSAGE_CHILDREN)
+    exec_cpu = (cpu_after.ru_utime - cpu_before.ru_utime) + (cpu_after.ru_stime - cpu_before.ru_stime)
+    report('exec per cycle', latencies, exec_cpu / cycles)
+
+    # New approach: one worker, one JSON request per cycle
+    worker = subprocess.Popen(
+        [sys.executable, '-u', os.path.join(here, 'scoring_worker.py')],
+        env=env, stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True,
+    )
+    try:
+        worker.stdin.write(json.dumps({'id': 0, 'method': 'assess'}) + '\n')
+        worker.stdin.flush()
+        worker.stdout.readline()  # warm-up: imports and first connection
+        cpu_before = process_cpu_seconds(worker.pid)
+        latencies = []
+        for i in range(1, cycles + 1):
+            start = time.perf_counter()
+            worker.stdin.write(json.dumps({'id': i, 'method': 'assess'}) + '\n')
+            worker.stdin.flush()
+            response = json.loads(worker.stdout.readline())
+            latencies.append(time.perf_counter() - start)
+            if 'error' in response:
+                raise RuntimeError(response['error'])
+        worker_cpu = process_cpu_seconds(worker.pid) - cpu_before
+        report('persistent worker', latencies, worker_cpu / cycles)
+    finally:
+        worker.stdin.close()
+        worker.wait()
+        server.stop()
+
+
+def report(label, latencies, cpu_per_cycle):
+    latencies = sorted(latencies)
+    median = latencies[len(latencies) // 2]
+    p95 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+    print(f"{label:>18}: median {median * 1000:8.2f} ms, p95 {p95 * 1000:8.2f} ms, "
+          f"CPU {cpu_per_cycle * 1000:8.2f} ms/cycle")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Long-lived soil health scoring worker (JSON lines on stdio).')
+    parser.add_argument('--bench', type=int, metavar='CYCLES',
+                        help='compare exec-per-cycle with the persistent worker and exit')
+    args = parser.parse_args()
+
+    if args.bench:
+        benchmark(args.bench)
+        return
+
+    # stdout carries the protocol; anything else the scoring code prints
+    # (debug output, parse warnings) is sent to stderr instead.
+    protocol_out = sys.stdout
+    sys.stdout = sys.stderr
+    serve(sys.stdin, protocol_out)
+
+
+if __name__ == "__main__":
+    main()
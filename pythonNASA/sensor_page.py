@@ -0,0 +1,220 @@
+import argparse
+import logging
+import re
+import time
+
+from soil_health import sensor_columns, unflatten_sensor_data
+
+logger = logging.getLogger(__name__)
+
+# Names as written on the sensor page (lower-case, single-spaced) -> column index
+# in soil_health.sensor_columns. "Soil Moisture" is written with a space.
+page_names = {
+    name.replace('_', ' ').lower(): i for i, (group, name) in enumerate(sensor_columns)
+}
+
+# One `Name = value` pair in element text, e.g. `<p>Nitrogen = 553</p>`.
+# The pair must start right after a tag and the value must end at a tag (or the
+# end of the page), which is what get_text() on a <p> used to give us. Inline
+# tags around the name, the '=' or the value are skipped, as get_text() did.
+#
+# Matching tags and pairs in one pattern backtracks quadratically over long
+# runs of tags (a page of empty table rows), so the page is first collapsed
+# in one linear pass: every run of tags and the whitespace after them becomes
+# a single `tag_mark`. The pair pattern is then atomic, so each stretch of
+# text between marks is scanned once.
+_tags = r'(?:<[^>]*>\s*)*'
+tag_mark = '\x00'
+tag_run_pattern = re.compile(r'(?:<[^<>]*>\s*)+')
+pair_pattern = re.compile(
+    r'[>' + tag_mark + r']\s*+' +
+    r'((?>[A-Za-z]+(?:[ _]+[A-Za-z]+)*))\s*+' + tag_mark + '?' +
+    r'=\s*+' + tag_mark + '?' +
+    r'((?>[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?))\s*+(?=[<' + tag_mark + r']|$)'
+)
+_spaces = re.compile(r'[\s_]+')
+
+# Pages scraped over HTTP (the Python1.py layout) put each reading in its own
+# element, found by id: <span id="nitrogen">553</span>. Ids are the column
+# names in lower case.
+element_ids = {name.lower(): i for i, (group, name) in enumerate(sensor_columns)}
+element_pattern = re.compile(
+    r'<[A-Za-z][^>]*?\bid\s*=\s*["\']?(' + '|'.join(element_ids) + r')(?![\w-])[^>]*>\s*' + _tags + r'([^<]*)'
+)
+
+
+# Function to pull every known `Name = value` pair out of a sensor page in one scan.
+# Returns a list of floats in sensor_columns order, None where a sensor is missing.
+# The first occurrence of a name wins, and the scan stops as soon as every sensor
+# has been seen.
+def parse_sensor_values(html):
+    values = [None] * len(sensor_columns)
+    remaining = len(values)
+    text = tag_run_pattern.sub(tag_mark, html.replace(tag_mark, ''))
+    for match in pair_pattern.finditer(text):
+        column = page_names.get(_spaces.sub(' ', match.group(1)).lower())
+        if column is None or values[column] is not None:
+            continue
+        values[column] = float(match.group(2))
+        remaining -= 1
+        if not remaining:
+            break
+    return values
+
+
+# Function to pull the readings out of a page that keeps them in elements by
+# id (see element_ids). Returns a list in sensor_columns order, None where an
+# element is missing or does not hold a number; the first element wins.
+def parse_element_values(html):
+    values = [None] * len(sensor_columns)
+    seen = set()
+    for match in element_pattern.finditer(html):
+        column = element_ids[match.group(1)]
+        if column in seen:
+            continue
+        seen.add(column)
+        try:
+            values[column] = float(match.group(2))
+        except ValueError:
+            pass
+        if len(seen) == len(values):
+            break
+    return values
+
+
+# Function to parse a sensor page into the nested sensor_data dict used by assess_soil_health
+def parse_sensor_page(html):
+    values = parse_sensor_values(html)
+    for (group, name), value in zip(sensor_columns, values):
+        if value is None:
+            logger.warning(f"Sensor '{name}' not found in the HTML.")
+    return unflatten_sensor_data(values)
+
+
+# Function to read a local sensor page, e.g. please.html; missing sensors are None
+def fetch_sensor_data(file_path):
+    with open(file_path, 'r', encoding='utf-8') as f:
+        return parse_sensor_page(f.read())
+
+
+# The BeautifulSoup path the PyResult scripts used, kept as the benchmark baseline
+def soup_sensor_values(html):
+    from bs4 import BeautifulSoup
+
+    soup = BeautifulSoup(html, 'html.parser')
+    values = []
+    for group, name in sensor_columns:
+        sensor_name = name.replace('_', ' ')
+        value = None
+        for p in soup.find_all('p'):
+            text = p.get_text(strip=True)
+            if sensor_name in text:
+                parts = text.split('=')
+                if len(parts) == 2:
+                    try:
+                        value = float(parts[1].strip())
+                    except ValueError:
+                        pass
+                    break
+        values.append(value)
+    return values
+
+
+# Function to build a synthetic sensor page with `filler` unrelated paragraphs
+# ahead of the readings. `malformed` drops closing tags and sprinkles broken markup.
+def synthetic_page(filler=0, malformed=False, values=(553, 4, 25, 60, 35, 10)):
+    close = '' if malformed else '</p>'
+    lines = ['<!DOCTYPE html><html><head><title>Soil and Environment Data</title></head><body>']
+    for i in range(filler):
+        if malformed and i % 7 == 0:
+            lines.append(f'<div class="row"><p>Reading {i} <b>pending <i>calibration</b>')
+        else:
+            lines.append(f'<p>Log entry {i}: probe heartbeat ok{close}')
+    for (group, name), value in zip(sensor_columns, values):
+        lines.append(f'<p>{name.replace("_", " ")} = {value}{close}')
+    lines.append('</div></body></html>' if not malformed else '</body>')
+    return '\n'.join(lines)
+
+
+# Function to build a page with no readings at all: `rows` empty table rows
+# and text followed by a long run of tags, the worst case for skipping tags
+def no_reading_page(rows=4_000):
+    return ('<html><body><table>' + '<tr><td></td><td></td></tr>' * rows + '</table><p>Probe offline'
+            + '<b>' * rows + '</body></html>')
+
+
+# Function to build a page in the element-id layout Python1.py scrapes
+def synthetic_element_page(filler=0, values=(553, 4, 25, 60, 35, 10)):
+    lines = ['<!DOCTYPE html><html><head><title>Sensor readings</title></head><body><table>']
+    for i in range(filler):
+        lines.append(f'<tr><td id="log-{i}">probe heartbeat ok</td></tr>')
+    for (group, name), value in zip(sensor_columns, values):
+        lines.append(f'<tr><th>{name.replace("_", " ")}</th><td id="{name.lower()}">{value}</td></tr>')
+    lines.append('</table></body></html>')
+    return '\n'.join(lines)
+
+
+def benchmark(repeat=20):
+    try:
+        import bs4  # noqa: F401
+    except ImportError:
+        bs4 = None
+        print("BeautifulSoup is not installed; timing the streaming parser only")
+
+    print(f"{'page':>24} {'bytes':>9} {'stream ms':>10} {'soup ms':>10} {'speedup':>8} {'found':>6} {'soup found':>10}")
+    for filler in (0, 1_000, 10_000):
+        for malformed in (False, True):
+            html = synthetic_page(filler, malformed)
+            start = time.perf_counter()
+            for _ in range(repeat):
+                values = parse_sensor_values(html)
+            stream_ms = (time.perf_counter() - start) / repeat * 1000
+            found = sum(value is not None for value in values)
+
+            label = f"{filler} filler{' malformed' if malformed else ''}"
+            # The old path is quadratic on malformed pages (every unclosed <p>
+            # contains the rest of the document), so big ones are skipped.
+            if bs4 is None or (malformed and filler > 1_000):
+                print(f"{label:>24} {len(html):>9} {stream_ms:>10.3f} {'-':>10} {'-':>8} {found:>6} {'-':>10}")
+                continue
+
+            soup_repeat = max(1, repeat // 10) if filler else repeat
+            start = time.perf_counter()
+            for _ in range(soup_repeat):
+                expected = soup_sensor_values(html)
+            soup_ms = (time.perf_counter() - start) / soup_repeat * 1000
+            soup_found = sum(value is not None for value in expected)
+
+            # html.parser nests unclosed <p> tags, so on malformed pages the
+            # old path sees several '=' in one paragraph and gives up.
+            if not malformed and values != expected:
+                raise AssertionError(f"parsers disagree on {label}: {values} != {expected}")
+            print(f"{label:>24} {len(html):>9} {stream_ms:>10.3f} {soup_ms:>10.3f} "
+                  f"{soup_ms / stream_ms:>7.0f}x {found:>6} {soup_found:>10}")
+
+    # Large pages with nothing to find: every tag run is skipped once
+    for rows in (1_000, 4_000, 16_000):
+        html = no_reading_page(rows)
+        start = time.perf_counter()
+        for _ in range(repeat):
+            values = parse_sensor_values(html)
+        stream_ms = (time.perf_counter() - start) / repeat * 1000
+        found = sum(value is not None for value in values)
+        print(f"{f'{rows} empty rows':>24} {len(html):>9} {stream_ms:>10.3f} {'-':>10} {'-':>8} {found:>6} {'-':>10}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Parse a sensor page, or benchmark the parser.')
+    parser.add_argument('file_path', nargs='?', help='sensor page to parse, e.g. please.html')
+    parser.add_argument('--bench', action='store_true', help='compare against the BeautifulSoup path')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    if args.bench or not args.file_path:
+        benchmark()
+    else:
+        print(fetch_sensor_data(args.file_path))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,506 @@
+import argparse
+import asyncio
+import json
+import os
+import shutil
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from esp32_collector import ESP32Collector
+from incremental import FileChangeDetector, IncrementalScorer
+from metrics import cycle_seconds, fetch_failures, fetch_seconds, parse_seconds, score_seconds, stale_values
+from readings import ReadingBatch
+from resilient_fetch import LastGoodValues
+from sensor_page import parse_element_values, parse_sensor_page
+from soil_health import esp32_sensors, format_esp32_readings, ideal_thresholds, sensor_columns, unflatten_sensor_data
+from wire_format import WireFormatError, decode_batch
+
+# One interface over every way of reading sensors.
+#
+# A source owns a set of nodes (node id -> where to read it) and reads them in
+# batches: read_many(node_ids=None) reads every node, or only `node_ids`, and
+# returns one batch in the format ESP32Collector.collect() has always used:
+#
+#   'started'   - wall-clock time the read began
+#   'duration'  - seconds it took
+#   'readings'  - node id -> sensor data in the assess_soil_health format
+#   'errors'    - node id -> description of what went wrong
+#   'unchanged' - ids of nodes whose readings are known not to have changed
+#   'packed'    - 'readings' as a ReadingBatch stamped with 'started'
+#
+# (ESP32Source adds the collector's 'raw', 'stale' and 'skipped', and
+# ESP32ReadingsSource 'raw', 'stale' and 'samples'.) The page sources leave a
+# node they could not read out of 'readings'; the ESP32 sources keep the
+# collector's behaviour of filling unread sensors with their last good value
+# while it is at most `max_stale` seconds old, or None.
+# aread_many() is the same from asyncio: it runs read_many on a thread, so
+# every source keeps its pooled connections and thread pool.
+#
+# Plug-ins, by registry name:
+#   file  - local sensor pages (please.html, `Name = value` paragraphs); a
+#           page whose file has not changed is not re-read
+#   page  - sensor pages over HTTP in the Python1.py layout (readings in
+#           elements by id); pooled keep-alive session, requests in
+#           parallel, ETag / If-None-Match
+#   esp32 - ESP32 probes, one endpoint per sensor, through ESP32Collector
+#   readings - ESP32 probes running GroundSensorCode_v3, one GET /readings
+#           per node for every sample buffered since the last one seen, in
+#           the binary format of wire_format.py; the newest sample is the
+#           node's reading and all of them are in the batch's 'samples'
+#
+# SourcePipeline reads every source of a cycle at once and scores what it
+# read with one IncrementalScorer, skipping nodes reported unchanged. Node
+# ids must be unique across the sources of one pipeline.
+
+source_types = {}
+
+
+# Decorator to register a source class under a name for open_sources()
+def register_source(name):
+    def register(cls):
+        cls.name = name
+        source_types[name] = cls
+        return cls
+    return register
+
+
+class SensorSource:
+    name = None
+
+    def __init__(self, nodes):
+        self.nodes = dict(nodes)
+
+    # Read every node, or only `node_ids`, and return one batch
+    def read_many(self, node_ids=None):
+        raise NotImplementedError
+
+    async def aread_many(self, node_ids=None):
+        return await asyncio.to_thread(self.read_many, node_ids)
+
+    # Read one node; returns its sensor data, or raises OSError
+    def read(self, node_id):
+        batch = self.read_many([node_id])
+        if node_id not in batch['readings']:
+            raise OSError(batch['errors'].get(node_id, f"no reading for {node_id}"))
+        return batch['readings'][node_id]
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _selected(self, node_ids):
+        return list(self.nodes) if node_ids is None else list(node_ids)
+
+
+# Function to start an empty batch
+def new_batch():
+    return {'started': time.time(), 'duration': 0.0, 'readings': {}, 'errors': {}, 'unchanged': set()}
+
+
+# Function to pack a batch's readings and record how long it took
+def finish_batch(batch, start):
+    packed = batch['packed'] = ReadingBatch(len(batch['readings']))
+    for node_id, sensor_data in batch['readings'].items():
+        packed.append(node_id, batch['started'], sensor_data)
+    batch['duration'] = time.monotonic() - start
+    return batch
+
+
+@register_source('file')
+class PageFileSource(SensorSource):
+    # `nodes` maps node id -> path of a sensor page
+    def __init__(self, nodes):
+        super().__init__(nodes)
+        self.detectors = {node_id: FileChangeDetector(path) for node_id, path in self.nodes.items()}
+        self.last = {}  # node id -> last sensor data parsed
+
+    def read_many(self, node_ids=None):
+        start = time.monotonic()
+        batch = new_batch()
+        for node_id in self._selected(node_ids):
+            detector = self.detectors[node_id]
+            try:
+                changed, html = detector.check()
+            except OSError as e:
+                batch['errors'][node_id] = str(e)
+                continue
+            if not changed and node_id in self.last:
+                batch['readings'][node_id] = self.last[node_id]
+                batch['unchanged'].add(node_id)
+                continue
+            parse_start = time.perf_counter()
+            sensor_data = self.last[node_id] = parse_sensor_page(html)
+            parse_seconds.observe(time.perf_counter() - parse_start)
+            batch['readings'][node_id] = sensor_data
+        return finish_batch(batch, start)
+
+
+@register_source('page')
+class PageUrlSource(SensorSource):
+    # `nodes` maps node id -> URL of a sensor page. Up to `max_in_flight`
+    # pages are fetched at once over one pooled session.
+    def __init__(self, nodes, max_in_flight=16, timeout=5.0):
+        super().__init__(nodes)
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=max(len(self.nodes), 1), pool_maxsize=max_in_flight, max_retries=0)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.executor = ThreadPoolExecutor(max_workers=max_in_flight, thread_name_prefix='page-source')
+        self.etags = {}  # node id -> (etag, sensor data)
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        self.session.close()
+
+    # Fetch and parse one page. Returns (node_id, sensor_data, error, unchanged).
+    def fetch(self, node_id):
+        started = time.monotonic()
+        cached = self.etags.get(node_id)
+        try:
+            response = self.session.get(self.nodes[node_id], timeout=self.timeout,
+                                        headers={'If-None-Match': cached[0]} if cached else None)
+            if response.status_code == 304 and cached:
+                return node_id, cached[1], None, True
+            response.raise_for_status()
+        except requests.exceptions.RequestException as e:
+            fetch_failures.inc(1, (node_id,))
+            return node_id, None, str(e), False
+        finally:
+            fetch_seconds.observe(time.monotonic() - started, (node_id,))
+        parse_start = time.perf_counter()
+        sensor_data = unflatten_sensor_data(parse_element_values(response.text))
+        parse_seconds.observe(time.perf_counter() - parse_start)
+        etag = response.headers.get('ETag')
+        if etag:
+            self.etags[node_id] = (etag, sensor_data)
+        return node_id, sensor_data, None, False
+
+    def read_many(self, node_ids=None):
+        start = time.monotonic()
+        batch = new_batch()
+        for node_id, sensor_data, error, unchanged in self.executor.map(self.fetch, self._selected(node_ids)):
+            if error:
+                batch['errors'][node_id] = error
+                continue
+            batch['readings'][node_id] = sensor_data
+            if unchanged:
+                batch['unchanged'].add(node_id)
+        return finish_batch(batch, start)
+
+
+@register_source('esp32')
+class ESP32Source(SensorSource):
+    # `nodes` maps node id -> ESP32 base URL; options go to ESP32Collector
+    def __init__(self, nodes, **options):
+        super().__init__(nodes)
+        self.collector = ESP32Collector(self.nodes, **options)
+
+    def close(self):
+        self.collector.close()
+
+    def read_many(self, node_ids=None):
+        return self.collector.collect(node_ids)
+
+
+@register_source('readings')
+class ESP32ReadingsSource(SensorSource):
+    # `nodes` maps node id -> ESP32 base URL. Up to `max_in_flight` nodes are
+    # read at once over one pooled session. A node with no new samples keeps
+    # its last good values for `max_stale` seconds, as in ESP32Collector.
+    def __init__(self, nodes, max_in_flight=16, timeout=5.0, max_stale=3600.0):
+        super().__init__(nodes)
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=max(len(self.nodes), 1), pool_maxsize=max_in_flight, max_retries=0)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.executor = ThreadPoolExecutor(max_workers=max_in_flight, thread_name_prefix='readings-source')
+        self.last_seq = {}  # node id -> newest sequence number read
+        self.last = {}  # node id -> sensor data of the last batch
+        self.last_good = LastGoodValues(max_stale)
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        self.session.close()
+
+    # Fetch and decode one node's new samples. Returns (node_id, samples as
+    # a ReadingBatch or None, error).
+    def fetch(self, node_id):
+        started = time.monotonic()
+        since = self.last_seq.get(node_id)
+        try:
+            response = self.session.get(f"{self.nodes[node_id]}/readings", timeout=self.timeout,
+                                        params={'since': since} if since is not None else None)
+            response.raise_for_status()
+        except requests.exceptions.RequestException as e:
+            fetch_failures.inc(1, (node_id,))
+            return node_id, None, str(e)
+        finally:
+            fetch_seconds.observe(time.monotonic() - started, (node_id,))
+        parse_start = time.perf_counter()
+        try:
+            samples, seqs = decode_batch(response.content)
+        except WireFormatError as e:
+            return node_id, None, str(e)
+        finally:
+            parse_seconds.observe(time.perf_counter() - parse_start)
+        if len(samples):
+            self.last_seq[node_id] = int(seqs[-1])
+            samples.node_ids = [node_id] * len(samples)
+        return node_id, samples, None
+
+    def read_many(self, node_ids=None):
+        start = time.monotonic()
+        batch = new_batch()
+        batch.update(raw={}, stale={}, samples={})
+        for node_id, samples, error in self.executor.map(self.fetch, self._selected(node_ids)):
+            fresh = samples is not None and len(samples) > 0
+            if error:
+                batch['errors'][node_id] = error
+            if not fresh and node_id not in self.last:
+                batch['errors'].setdefault(node_id, 'no samples buffered yet')
+                continue
+            if fresh:
+                newest = samples.reading(len(samples) - 1)
+                raw = {'temperature': newest.temperature, 'humidity': newest.humidity,
+                       'moisture': newest.soil_moisture}
+                batch['samples'][node_id] = samples
+            else:
+                raw = {sensor: None for sensor in esp32_sensors}
+            batch['raw'][node_id] = raw
+            filled, stale = self.last_good.fill(node_id, raw)
+            sensor_data = format_esp32_readings(filled)
+            if stale:
+                batch['stale'][node_id] = stale
+                stale_values.inc(len(stale), (node_id,))
+            if not fresh and sensor_data == self.last[node_id]:
+                batch['unchanged'].add(node_id)
+            batch['readings'][node_id] = self.last[node_id] = sensor_data
+        return finish_batch(batch, start)
+
+
+# Function to open sources from a config: {plug-in name: {node id: location}},
+# or {plug-in name: {"nodes": {...}, "options": {...}}}
+def open_sources(config):
+    sources = []
+    for name, spec in config.items():
+        if name not in source_types:
+            raise ValueError(f"Unknown sensor source {name!r} (known: {', '.join(sorted(source_types))})")
+        if 'nodes' in spec:
+            sources.append(source_types[name](spec['nodes'], **spec.get('options', {})))
+        else:
+            sources.append(source_types[name](spec))
+    return sources
+
+
+# Function to load a sources config (see open_sources) from a JSON file
+def load_sources(path):
+    with open(path) as f:
+        return open_sources(json.load(f))
+
+
+# Function to combine the batches of several sources into one. Node ids are
+# unique across sources, so per-node maps are merged as they are.
+def merge_batches(batches, start):
+    merged = new_batch()
+    merged['started'] = min((batch['started'] for batch in batches), default=merged['started'])
+    for batch in batches:
+        merged['readings'].update(batch['readings'])
+        merged['errors'].update(batch['errors'])
+        merged['unchanged'] |= batch['unchanged']
+        for key in ('raw', 'stale', 'skipped', 'samples'):
+            if key in batch:
+                merged.setdefault(key, {}).update(batch[key])
+    return finish_batch(merged, start)
+
+
+# Function to read every source at once (one thread per source) into one batch
+def read_all(sources):
+    start = time.monotonic()
+    if len(sources) == 1:
+        batch = sources[0].read_many()
+        batch['duration'] = time.monotonic() - start
+        return batch
+    with ThreadPoolExecutor(max_workers=len(sources)) as executor:
+        batches = list(executor.map(lambda source: source.read_many(), sources))
+    return merge_batches(batches, start)
+
+
+async def aread_all(sources):
+    start = time.monotonic()
+    batches = await asyncio.gather(*(source.aread_many() for source in sources))
+    return merge_batches(batches, start)
+
+
+class SourcePipeline:
+    # `loop` labels the pipeline's cycles in the cycle_seconds metric. With a
+    # `detector` (anomaly.AnomalyDetector) new readings are checked before
+    # they are scored; unchanged ones are not, as a re-read is not a repeat.
+    def __init__(self, sources, thresholds=ideal_thresholds, scorer=None, loop='sources', detector=None):
+        self.sources = list(sources)
+        self.scorer = scorer if scorer is not None else IncrementalScorer(thresholds)
+        self.loop = loop
+        self.detector = detector
+
+    def close(self):
+        for source in self.sources:
+            source.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    # Read every source and score what was read. Returns (batch, results):
+    # results maps node id -> (total_score, recommendation records, changed),
+    # `changed` being whether the node's result moved since the last cycle.
+    # Flagged sensors are listed in batch['anomalies'] (node id -> {sensor:
+    # [check, ...]}).
+    def cycle(self):
+        return self.score(read_all(self.sources))
+
+    async def acycle(self):
+        return self.score(await aread_all(self.sources))
+
+    def score(self, batch):
+        started = time.perf_counter()
+        results = {}
+        batch['anomalies'] = {}
+        for node_id, sensor_data in batch['readings'].items():
+            if node_id in batch['unchanged']:
+                cached = self.scorer.result(node_id, structured=True)
+                if cached is not None:
+                    self.scorer.skip_cycle()
+                    results[node_id] = cached
+                    continue
+            if self.detector is not None:
+                found, sensor_data = self.detector.check(node_id, sensor_data)
+                if found:
+                    batch['anomalies'][node_id] = found
+            results[node_id] = self.scorer.assess(node_id, sensor_data, structured=True)
+        dirty = set(self.scorer.pop_dirty())
+        results = {node_id: (total_score, records, node_id in dirty)
+                   for node_id, (total_score, records) in results.items()}
+        score_seconds.observe(time.perf_counter() - started, ('incremental',))
+        cycle_seconds.observe(batch['duration'] + time.perf_counter() - started, (self.loop,))
+        return batch, results
+
+
+# Time one plug-in on its own: cycles where every node changed, cycles where
+# none did, and the same through asyncio
+def benchmark(source_type='all', n_nodes=200, cycles=5):
+    from fake_esp32 import FakeESP32Server, FakeFleet
+    from sensor_page import synthetic_page
+
+    root = tempfile.mkdtemp(prefix='aquiferst-sources-')
+    server = FakeESP32Server(FakeFleet(etags=True))
+    server.start()
+    try:
+        paths = {}
+        for i in range(n_nodes):
+            paths[f"file-{i}"] = os.path.join(root, f"node-{i}.html")
+
+        def touch_pages(cycle):
+            for i, path in enumerate(paths.values()):
+                with open(path, 'w') as f:
+                    f.write(synthetic_page(filler=20, values=(553 + cycle, 4, 25, 60, 35 + i % 5, 10)))
+
+        def change_fleet(cycle):
+            for i in range(n_nodes):
+                server.fleet.set_value(str(i), 'moisture', str(30 + cycle))
+
+        plugins = {
+            'file': (lambda: PageFileSource(paths), touch_pages),
+            'page': (lambda: PageUrlSource({f"page-{i}": f"{server.node_url(i)}/page" for i in range(n_nodes)},
+                                           max_in_flight=32), change_fleet),
+            'esp32': (lambda: ESP32Source({f"esp32-{i}": server.node_url(i) for i in range(n_nodes)},
+                                          max_in_flight=32), change_fleet),
+            'readings': (lambda: ESP32ReadingsSource({f"readings-{i}": server.node_url(i) for i in range(n_nodes)},
+                                                     max_in_flight=32), change_fleet),
+        }
+        print(f"{n_nodes} nodes per source, {cycles} cycles")
+        print(f"{'source':>8} {'changed nodes/s':>16} {'unchanged nodes/s':>18} {'async nodes/s':>14}")
+        for name in (plugins if source_type == 'all' else [source_type]):
+            make, change = plugins[name]
+            change(0)
+            with make() as source:
+                source.read_many()  # warm up connections and caches
+                rates = []
+                for unchanged in (False, True):
+                    seconds = 0.0
+                    for cycle in range(1, cycles + 1):
+                        if not unchanged:
+                            change(cycle)
+                        start = time.perf_counter()
+                        batch = source.read_many()
+                        seconds += time.perf_counter() - start
+                        if batch['errors']:
+                            raise AssertionError(f"{name}: {next(iter(batch['errors'].values()))}")
+                        if unchanged and len(batch['unchanged']) != n_nodes:
+                            raise AssertionError(f"{name}: unchanged nodes were re-read")
+                    rates.append(n_nodes * cycles / seconds)
+                seconds = 0.0
+                for cycle in range(cycles + 1, 2 * cycles + 1):
+                    change(cycle)
+                    start = time.perf_counter()
+                    asyncio.run(source.aread_many())
+                    seconds += time.perf_counter() - start
+                rates.append(n_nodes * cycles / seconds)
+            print(f"{name:>8} {rates[0]:>16,.0f} {rates[1]:>18,.0f} {rates[2]:>14,.0f}")
+
+        # Python1.py's way for comparison: a new connection and a full
+        # BeautifulSoup parse per page, one page at a time
+        if source_type in ('all', 'page'):
+            from bs4 import BeautifulSoup
+            start = time.perf_counter()
+            for i in range(n_nodes):
+                soup = BeautifulSoup(requests.get(f"{server.node_url(i)}/page", timeout=5).content, 'html.parser')
+                [float(soup.find(id=name.lower()).text) for group, name in sensor_columns]
+            print(f"{'Python1':>8} {n_nodes / (time.perf_counter() - start):>16,.0f}")
+
+        # Every plug-in feeding one pipeline
+        if source_type == 'all':
+            with SourcePipeline(make() for make, change in plugins.values()) as pipeline:
+                start = time.perf_counter()
+                batch, results = pipeline.cycle()
+                print(f"pipeline over all sources: {len(results)} nodes read and scored in "
+                      f"{(time.perf_counter() - start) * 1000:.1f} ms, {len(batch['errors'])} errors")
+    finally:
+        server.stop()
+        shutil.rmtree(root)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Read sensors through the source plug-ins, or benchmark them.')
+    parser.add_argument('config', nargs='?', help='JSON sources config, e.g. {"esp32": {"probe-1": "http://..."}}')
+    parser.add_argument('--bench', choices=['all'] + sorted(source_types), help='benchmark one plug-in, or all')
+    parser.add_argument('--nodes', type=int, default=200)
+    parser.add_argument('--cycles', type=int, default=5)
+    args = parser.parse_args()
+
+    if args.bench or not args.config:
+        benchmark(args.bench or 'all', args.nodes, args.cycles)
+        return
+    with SourcePipeline(load_sources(args.config)) as pipeline:
+        batch, results = pipeline.cycle()
+    for node_id, (total_score, records, changed) in sorted(results.items()):
+        print(f"{node_id}: Soil Health Score {total_score:.2f}")
+        for record in records:
+            print(f"  {record.text}")
+    for node_id, error in sorted(batch['errors'].items()):
+        print(f"{node_id}: {error}")
+
+
+if __name__ == "__main__":
+    main()
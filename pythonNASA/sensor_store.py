@@ -0,0 +1,412 @@
+import argparse
+import logging
+import os
+import shutil
+import struct
+import tempfile
+import threading
+import time
+import zlib
+from urllib.parse import quote, unquote
+
+import numpy as np
+
+from soil_health import flatten_sensor_data, sensor_columns, unflatten_sensor_data
+
+logger = logging.getLogger(__name__)
+
+# Append-only, time-partitioned columnar store for sensor history.
+#
+# Layout on disk:
+#   <root>/<node id>/<partition start>.seg
+# Each node has one segment file per time partition (a day by default), named
+# after the partition's start in whole seconds. A segment is a sequence of
+# self-describing chunks, appended as the in-memory buffer for a node fills
+# or once its oldest reading has waited `max_buffer_seconds`:
+#
+#   header  (chunk_header, little-endian)
+#     magic, row count, first/last timestamp (ms), payload length
+#   payload (zlib)
+#     timestamps   int64 ms, delta-encoded
+#     six columns  float64 in soil_health.sensor_columns order; each value is
+#                  XORed with the previous one and the bytes are shuffled so
+#                  that slowly-changing readings compress to runs of zeros
+#
+# Range queries only open the segments whose partition overlaps the range and
+# skip chunk payloads using the header timestamps, so reading a day of one node
+# costs the same whether the store holds a week or ten years.
+#
+# An append interrupted by a crash leaves a torn chunk at the end of a
+# segment. Reads stop at the first chunk that is cut short or does not
+# decode, and the first append to a segment after opening the store cuts
+# the file back to its last good chunk, so new chunks never land behind
+# garbage.
+
+chunk_header = struct.Struct('<4sIqqI')
+chunk_magic = b'AQC1'
+segment_suffix = '.seg'
+n_columns = len(sensor_columns)
+
+
+# Function to encode sorted timestamps (int64 ms) and an (n, 6) float64 array into a chunk
+def encode_chunk(timestamps_ms, values):
+    n_rows = len(timestamps_ms)
+    deltas = np.diff(timestamps_ms, prepend=timestamps_ms[0])
+
+    bits = np.ascontiguousarray(values.T).view(np.uint64)
+    xored = bits.copy()
+    xored[:, 1:] ^= bits[:, :-1]
+    shuffled = xored.view(np.uint8).reshape(n_columns, n_rows, 8).transpose(0, 2, 1)
+
+    payload = zlib.compress(deltas.astype('<i8').tobytes() + shuffled.tobytes(), 6)
+    header = chunk_header.pack(chunk_magic, n_rows, int(timestamps_ms[0]), int(timestamps_ms[-1]), len(payload))
+    return header + payload
+
+
+# Function to decode a chunk payload back into (timestamps_ms, values)
+def decode_chunk(payload, n_rows, first_ts):
+    raw = zlib.decompress(payload)
+    split = n_rows * 8
+    timestamps_ms = np.cumsum(np.frombuffer(raw[:split], dtype='<i8'))
+    timestamps_ms += first_ts - timestamps_ms[0]
+
+    shuffled = np.frombuffer(raw[split:], dtype=np.uint8).reshape(n_columns, 8, n_rows)
+    xored = np.ascontiguousarray(shuffled.transpose(0, 2, 1)).view(np.uint64).reshape(n_columns, n_rows)
+    bits = np.bitwise_xor.accumulate(xored, axis=1)
+    return timestamps_ms, bits.view(np.float64).T
+
+
+# Function to read (header fields, payload offset) for every chunk in a
+# segment file, stopping at the first torn or corrupt chunk. With `verify`
+# every payload is decoded too, not only bounds-checked.
+def read_chunk_index(f, verify=False):
+    size = os.fstat(f.fileno()).st_size
+    index = []
+    while True:
+        start = f.tell()
+        header = f.read(chunk_header.size)
+        if not header:
+            break
+        problem = None
+        if len(header) < chunk_header.size:
+            problem = 'torn chunk header'
+        else:
+            magic, n_rows, first_ts, last_ts, length = chunk_header.unpack(header)
+            if magic != chunk_magic:
+                problem = 'bad chunk magic'
+            elif start + chunk_header.size + length > size:
+                problem = 'torn chunk payload'
+            elif verify:
+                try:
+                    decode_chunk(f.read(length), n_rows, first_ts)
+                except (zlib.error, ValueError) as e:
+                    problem = f"undecodable chunk ({e})"
+        if problem:
+            logger.warning(f"Segment {f.name}: {problem} at byte {start}; ignoring the rest of the file")
+            break
+        index.append((n_rows, first_ts, last_ts, length, start + chunk_header.size))
+        f.seek(start + chunk_header.size + length)
+    return index
+
+
+# Function to cut a segment file back to its last good chunk; returns the
+# number of bytes removed
+def repair_segment(path):
+    with open(path, 'r+b') as f:
+        index = read_chunk_index(f, verify=True)
+        end = index[-1][4] + index[-1][3] if index else 0
+        size = os.fstat(f.fileno()).st_size
+        if end < size:
+            f.truncate(end)
+            logger.warning(f"Segment {path}: truncated {size - end} bytes of a torn append")
+        return size - end
+
+
+class SensorStore:
+    # A node's buffer is written out when it holds `chunk_rows` readings or
+    # its oldest has waited `max_buffer_seconds`, bounding what a crash loses
+    def __init__(self, root, partition_seconds=86400, chunk_rows=1024, max_buffer_seconds=300.0):
+        self.root = root
+        self.partition_ms = partition_seconds * 1000
+        self.chunk_rows = chunk_rows
+        self.max_buffer_seconds = max_buffer_seconds
+        self.buffers = {}  # node id -> (array of timestamps ms, list of value rows)
+        self.buffered_at = {}  # node id -> time.monotonic() of its oldest buffered reading
+        self.next_age_check = time.monotonic() + max_buffer_seconds
+        self.checked = set()  # segment paths repaired since the store was opened
+        self.lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self.flush()
+
+    def node_dir(self, node_id):
+        return os.path.join(self.root, quote(str(node_id), safe=''))
+
+    # Function to list the node ids that have data on disk or in memory
+    def nodes(self):
+        on_disk = [unquote(name) for name in os.listdir(self.root)
+                   if os.path.isdir(os.path.join(self.root, name))]
+        return sorted(set(on_disk) | set(self.buffers))
+
+    # Append one reading. `reading` is either a sensor_data dict (the
+    # assess_soil_health format) or a sequence in sensor_columns order.
+    # `timestamp` is in seconds, as returned by time.time().
+    def append(self, node_id, timestamp, reading):
+        if isinstance(reading, dict):
+            reading = flatten_sensor_data(reading)
+        row = [float('nan') if value is None else float(value) for value in reading]
+        if len(row) != n_columns:
+            raise ValueError(f"Expected {n_columns} values, got {len(row)}")
+        timestamp_ms = int(round(timestamp * 1000))
+
+        node_id = str(node_id)
+        with self.lock:
+            timestamps, rows = self._buffer(node_id)
+            # A chunk never straddles two partitions
+            if timestamps and timestamps[0] // self.partition_ms != timestamp_ms // self.partition_ms:
+                self._flush_node(node_id)
+                timestamps, rows = self._buffer(node_id)
+            timestamps.append(timestamp_ms)
+            rows.append(row)
+            if len(timestamps) >= self.chunk_rows:
+                self._flush_node(node_id)
+            self._flush_aged()
+
+    # Append many readings of one node at once; `values` is an (n, 6) array.
+    # Equivalent to calling append() per row, but fills buffers a slice at a time.
+    def append_many(self, node_id, timestamps, values):
+        values = np.asarray(values, dtype=np.float64).reshape(-1, n_columns)
+        timestamps_ms = np.round(np.asarray(timestamps, dtype=np.float64) * 1000).astype(np.int64)
+        partitions = timestamps_ms // self.partition_ms
+
+        node_id = str(node_id)
+        with self.lock:
+            i = 0
+            while i < len(timestamps_ms):
+                timestamps, rows = self._buffer(node_id)
+                if timestamps and timestamps[0] // self.partition_ms != partitions[i]:
+                    self._flush_node(node_id)
+                    continue
+                # Take rows up to the end of this partition or until the chunk is full
+                same_partition = np.flatnonzero(partitions[i:] != partitions[i])
+                j = i + (same_partition[0] if len(same_partition) else len(timestamps_ms) - i)
+                j = min(j, i + self.chunk_rows - len(timestamps))
+                timestamps.extend(timestamps_ms[i:j].tolist())
+                rows.extend(values[i:j].tolist())
+                if len(timestamps) >= self.chunk_rows:
+                    self._flush_node(node_id)
+                i = j
+            self._flush_aged()
+
+    # Write every buffered reading to disk
+    def flush(self):
+        with self.lock:
+            for node_id in list(self.buffers):
+                self._flush_node(node_id)
+
+    # Write out the buffers whose oldest reading has waited too long. Call it
+    # periodically when appends may stop for a while; append() calls it too.
+    def flush_aged(self):
+        with self.lock:
+            self.next_age_check = 0.0
+            self._flush_aged()
+
+    def _flush_aged(self):
+        now = time.monotonic()
+        if now < self.next_age_check:
+            return
+        self.next_age_check = now + self.max_buffer_seconds / 4
+        for node_id, buffered_at in list(self.buffered_at.items()):
+            if now - buffered_at >= self.max_buffer_seconds:
+                self._flush_node(node_id)
+
+    def _buffer(self, node_id):
+        if node_id not in self.buffers:
+            self.buffers[node_id] = ([], [])
+            self.buffered_at[node_id] = time.monotonic()
+        return self.buffers[node_id]
+
+    def _flush_node(self, node_id):
+        timestamps, rows = self.buffers.pop(node_id, ([], []))
+        self.buffered_at.pop(node_id, None)
+        if not timestamps:
+            return
+        timestamps_ms = np.array(timestamps, dtype=np.int64)
+        values = np.array(rows, dtype=np.float64)
+        order = np.argsort(timestamps_ms, kind='stable')
+        timestamps_ms, values = timestamps_ms[order], values[order]
+
+        partition = int(timestamps_ms[0] // self.partition_ms * self.partition_ms // 1000)
+        directory = self.node_dir(node_id)
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, f"{partition}{segment_suffix}")
+        # A torn append from before a crash must not stay ahead of new chunks
+        if path not in self.checked:
+            if os.path.exists(path):
+                repair_segment(path)
+            self.checked.add(path)
+        with open(path, 'ab') as f:
+            f.write(encode_chunk(timestamps_ms, values))
+
+    # Function to list (partition start in seconds, path) of a node's segments overlapping [start, end)
+    def segments(self, node_id, start=None, end=None):
+        directory = self.node_dir(node_id)
+        if not os.path.isdir(directory):
+            return []
+        partition_seconds = self.partition_ms // 1000
+        found = []
+        for name in os.listdir(directory):
+            if not name.endswith(segment_suffix):
+                continue
+            partition = int(name[:-len(segment_suffix)])
+            if end is not None and partition >= end:
+                continue
+            if start is not None and partition + partition_seconds <= start:
+                continue
+            found.append((partition, os.path.join(directory, name)))
+        return sorted(found)
+
+    # Yield (timestamps, values) for one node within [start, end), one time
+    # partition at a time and in time order. Timestamps are float64 seconds;
+    # values are (n, 6) float64 in sensor_columns order with NaN for missing
+    # readings. At most one partition of one node is held in memory.
+    def iter_chunks(self, node_id, start=None, end=None):
+        node_id = str(node_id)
+        start_ms = None if start is None else int(round(start * 1000))
+        end_ms = None if end is None else int(round(end * 1000))
+
+        # Readings not yet flushed are part of the answer too
+        with self.lock:
+            timestamps, rows = self.buffers.get(node_id, ([], []))
+            buffered = (np.array(timestamps, dtype=np.int64),
+                        np.array(rows, dtype=np.float64).reshape(-1, n_columns))
+        buffered_partition = None
+        if len(buffered[0]):
+            buffered_partition = int(buffered[0][0] // self.partition_ms * self.partition_ms // 1000)
+
+        segments = dict(self.segments(node_id, start, end))
+        if buffered_partition is not None:
+            segments.setdefault(buffered_partition, None)
+
+        for partition in sorted(segments):
+            parts = []
+            if segments[partition] is not None:
+                with open(segments[partition], 'rb') as f:
+                    for n_rows, first_ts, last_ts, length, offset in read_chunk_index(f):
+                        if (start_ms is not None and last_ts < start_ms) or (end_ms is not None and first_ts >= end_ms):
+                            continue
+                        f.seek(offset)
+                        try:
+                            parts.append(decode_chunk(f.read(length), n_rows, first_ts))
+                        except (zlib.error, ValueError) as e:
+                            logger.warning(f"Segment {segments[partition]}: undecodable chunk at byte {offset} "
+                                           f"({e}); ignoring the rest of the file")
+                            break
+            if partition == buffered_partition:
+                parts.append(buffered)
+            if not parts:
+                continue
+
+            timestamps_ms = np.concatenate([part[0] for part in parts])
+            values = np.concatenate([part[1] for part in parts])
+            # Chunks are sorted internally, but late readings can add an
+            # overlapping chunk to a partition, so sort the merged result.
+            if len(parts) > 1:
+                order = np.argsort(timestamps_ms, kind='stable')
+                timestamps_ms, values = timestamps_ms[order], values[order]
+            timestamps, values = self._select(timestamps_ms, values, start_ms, end_ms)
+            if len(timestamps):
+                yield timestamps, values
+
+    @staticmethod
+    def _select(timestamps_ms, values, start_ms, end_ms):
+        mask = np.ones(len(timestamps_ms), dtype=bool)
+        if start_ms is not None:
+            mask &= timestamps_ms >= start_ms
+        if end_ms is not None:
+            mask &= timestamps_ms < end_ms
+        return timestamps_ms[mask] / 1000.0, values[mask]
+
+    # Return every reading of one node in [start, end) as (timestamps, values) arrays
+    def query(self, node_id, start=None, end=None):
+        chunks = list(self.iter_chunks(node_id, start, end))
+        if not chunks:
+            return np.empty(0), np.empty((0, n_columns))
+        return np.concatenate([c[0] for c in chunks]), np.concatenate([c[1] for c in chunks])
+
+    # Yield (timestamp, sensor_data) pairs ready for assess_soil_health
+    def iter_sensor_data(self, node_id, start=None, end=None):
+        for timestamps, values in self.iter_chunks(node_id, start, end):
+            for timestamp, row in zip(timestamps.tolist(), values.tolist()):
+                yield timestamp, unflatten_sensor_data(row)
+
+    # Function to report the bytes used on disk by the whole store
+    def disk_usage(self):
+        total = 0
+        for directory, _, files in os.walk(self.root):
+            total += sum(os.path.getsize(os.path.join(directory, name)) for name in files)
+        return total
+
+
+def benchmark(n_nodes=100, days=7, interval=10):
+    from batch_scoring import synthetic_readings
+
+    rows_per_node = days * 86400 // interval
+    root = tempfile.mkdtemp(prefix='aquiferst-store-')
+    try:
+        start_time = 1_700_000_000
+        timestamps = start_time + np.arange(rows_per_node) * interval
+        # Sensor-like data: slow drift with sensor quantisation, not white noise
+        base = synthetic_readings(n_nodes, seed=1)
+        drift = np.cumsum(np.random.default_rng(2).normal(0, 0.05, size=(rows_per_node, n_columns)), axis=0)
+
+        store = SensorStore(root)
+        write_start = time.perf_counter()
+        for node in range(n_nodes):
+            values = np.round(base[node] + drift, 1)
+            store.append_many(f"probe-{node}", timestamps, values)
+        store.flush()
+        write_seconds = time.perf_counter() - write_start
+
+        total_rows = n_nodes * rows_per_node
+        disk = store.disk_usage()
+        raw = total_rows * (1 + n_columns) * 8
+        print(f"wrote {total_rows} rows ({n_nodes} nodes x {days} days @ {interval}s) "
+              f"in {write_seconds:.2f}s ({total_rows / write_seconds:,.0f} rows/s)")
+        print(f"on disk {disk / 1e6:.2f} MB = {disk / total_rows:.2f} bytes/row "
+              f"(raw {raw / total_rows:.0f} bytes/row, {raw / disk:.1f}x smaller)")
+
+        query_start = time.perf_counter()
+        ts, values = store.query('probe-7', start_time + 2 * 86400, start_time + 3 * 86400)
+        query_ms = (time.perf_counter() - query_start) * 1000
+        expected = np.round(base[7] + drift, 1)[2 * 86400 // interval:3 * 86400 // interval]
+        if not np.array_equal(values, expected):
+            raise AssertionError("round trip mismatch")
+        print(f"one-day range query for one node: {len(ts)} rows in {query_ms:.2f} ms")
+
+        query_start = time.perf_counter()
+        ts, values = store.query('probe-7', start_time + 2 * 86400 + 3600, start_time + 2 * 86400 + 7200)
+        print(f"one-hour range query for one node: {len(ts)} rows in "
+              f"{(time.perf_counter() - query_start) * 1000:.2f} ms")
+    finally:
+        shutil.rmtree(root)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the sensor history store.')
+    parser.add_argument('--nodes', type=int, default=100)
+    parser.add_argument('--days', type=int, default=7)
+    parser.add_argument('--interval', type=int, default=10, help='seconds between readings')
+    args = parser.parse_args()
+    benchmark(args.nodes, args.days, args.interval)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,12 @@
 import logging
+import os
 import requests
 
+from recommendations import fertilizer, too_high, too_low, water
+
 # ESP32 web server IP address
-esp32_ip = 'http://192.168.177.1'  # Replace with the actual IP address of your ESP32
+# Replace with the actual IP address of your ESP32, or set ESP32_IP in the environment
+esp32_ip = os.environ.get('ESP32_IP', 'http://192.168.177.1')
 
 # Thresholds for ideal sensor values
 ideal_thresholds = {
@@ -16,36 +20,80 @@ ideal_thresholds = {
     'Soil_Moisture': (25, 40)     # Ideal soil moisture percentage (%)
 }
 
+# Flat column order for columnar/batch code paths, matching the order in which
+# assess_soil_health walks a sensor_data dict. Each entry is (group, name);
+# group is None for top-level variables.
+sensor_columns = [
+    ('NPK_levels', 'Nitrogen'),
+    ('NPK_levels', 'Phosphorus'),
+    ('NPK_levels', 'Potassium'),
+    (None, 'Humidity'),
+    (None, 'Temperature'),
+    (None, 'Soil_Moisture')
+]
+
+# Function to flatten a nested sensor_data dict into a list in sensor_columns order.
+# Anything else (a readings.Reading, a row of six values) is already in that
+# order and is only copied into a list.
+def flatten_sensor_data(sensor_data):
+    if not isinstance(sensor_data, dict):
+        return list(sensor_data)
+    return [
+        sensor_data[group][name] if group else sensor_data[name]
+        for group, name in sensor_columns
+    ]
+
+# Function to rebuild the nested sensor_data dict from a sensor_columns-ordered sequence
+def unflatten_sensor_data(values):
+    sensor_data = {}
+    for (group, name), value in zip(sensor_columns, values):
+        if group:
+            sensor_data.setdefault(group, {})[name] = value
+        else:
+            sensor_data[name] = value
+    return sensor_data
+
+# Endpoints served by the ESP32 firmware, one value per request
+esp32_sensors = ['temperature', 'humidity', 'moisture']
+
+# Function to turn the raw text of one ESP32 endpoint into a float
+def parse_esp32_value(sensor, value):
+    value = value.strip()
+    try:
+        return float(value)
+    except ValueError:
+        print(f"Value for '{sensor}' is not a valid float: '{value}'")
+        return None
+
+# Function to map ESP32 sensor names to the names used by assess_soil_health.
+# A sensor that could not be read stays None: scoring it as 0 would look like
+# drought and order water.
+def format_esp32_readings(sensor_data):
+    return {
+        'NPK_levels': {
+            'Nitrogen': 50.0,    # Placeholder values since ESP32 doesn't provide NPK
+            'Phosphorus': 30.0,
+            'Potassium': 25.0
+        },
+        'Humidity': sensor_data['humidity'],
+        'Temperature': sensor_data['temperature'],
+        'Soil_Moisture': sensor_data['moisture']
+    }
+
 # Function to fetch sensor data from ESP32
 def fetch_sensor_data_from_esp32(esp32_ip):
-    sensors = ['temperature', 'humidity', 'moisture']
     sensor_data = {}
 
-    for sensor in sensors:
+    for sensor in esp32_sensors:
         try:
             response = requests.get(f"{esp32_ip}/{sensor}", timeout=5)
             response.raise_for_status()
-            value = response.text.strip()
-            try:
-                sensor_data[sensor] = float(value)
-            except ValueError:
-                print(f"Value for '{sensor}' is not a valid float: '{value}'")
-                sensor_data[sensor] = None
+            sensor_data[sensor] = parse_esp32_value(sensor, response.text)
         except requests.exceptions.RequestException as e:
             print(f"Error fetching {sensor} data from ESP32: {e}")
             sensor_data[sensor] = None
 
-    # Map ESP32 sensor names to expected names in the rest of the code
-    sensor_data_formatted = {
-        'NPK_levels': {
-            'Nitrogen': 50.0,    # Placeholder values since ESP32 doesn't provide NPK
-            'Phosphorus': 30.0,
-            'Potassium': 25.0
-        },
-        'Humidity': sensor_data['humidity'] if sensor_data['humidity'] is not None else 0,
-        'Temperature': sensor_data['temperature'] if sensor_data['temperature'] is not None else 0,
-        'Soil_Moisture': sensor_data['moisture'] if sensor_data['moisture'] is not None else 0
-    }
+    sensor_data_formatted = format_esp32_readings(sensor_data)
 
     # Debug print to verify sensor data
     print(f"Sensor Data: {sensor_data_formatted}")
@@ -69,6 +117,8 @@ def compute_score(value, ideal_min, ideal_max):
         else:
             return 0.0
 
+soil_bulk_density = 1300  # kg/m^3
+
 # Function to calculate water needed if soil moisture is low
 def calculate_water_needed(current_moisture, ideal_moisture, soil_volume_m3):
     moisture_deficit = (ideal_moisture - current_moisture) / 100.0  # Convert percentage to decimal
@@ -81,38 +131,83 @@ def calculate_nutrient_needed(current_level, ideal_level, soil_mass_kg):
     total_nutrient_needed_mg = nutrient_deficit_mg_per_kg * soil_mass_kg
     return total_nutrient_needed_mg / 1000.0  # Convert mg to grams
 
-# Main function to assess soil health and provide recommendations
-def assess_soil_health(sensor_data, thresholds, soil_volume_m3=1.0):
-    soil_bulk_density = 1300  # kg/m^3
-    soil_mass_kg = soil_bulk_density * soil_volume_m3
+# Function to score one variable and build its recommendation, a
+# recommendations.Recommendation record (None when in range).
+# `group` is 'NPK_levels' for nutrients and None for top-level variables.
+# A missing value (None) scores 0.0 with no recommendation, as NaN does in
+# batch_scoring.score_batch.
+def recommend_variable(group, variable, value, ideal_min, ideal_max, soil_volume_m3=1.0):
+    if value is None:
+        return 0.0, None
+    score = compute_score(value, ideal_min, ideal_max)
+    recommendation = None
+    if score < 1.0:
+        if group:
+            if value < ideal_min:
+                soil_mass_kg = soil_bulk_density * soil_volume_m3
+                amount_needed = calculate_nutrient_needed(value, ideal_min, soil_mass_kg)
+                recommendation = fertilizer(variable, amount_needed, value, ideal_min)
+            elif value > ideal_max:
+                recommendation = too_high(variable, value, ideal_max, nutrient=True)
+        elif value < ideal_min and variable == 'Soil_Moisture':
+            water_needed = calculate_water_needed(value, ideal_min, soil_volume_m3)
+            recommendation = water(water_needed, value, ideal_min)
+        elif value < ideal_min:
+            recommendation = too_low(variable, value, ideal_min)
+        elif value > ideal_max:
+            recommendation = too_high(variable, value, ideal_max)
+    return score, recommendation
+
+# Function to score one variable and build its suggestion text (None when in range)
+def assess_variable(group, variable, value, ideal_min, ideal_max, soil_volume_m3=1.0):
+    score, recommendation = recommend_variable(group, variable, value, ideal_min, ideal_max, soil_volume_m3)
+    return score, recommendation.text if recommendation else None
+
+# Function to flatten a thresholds dict into six (min, max) bands in
+# sensor_columns order, as a tuple. Callers scoring many readings against the
+# same thresholds flatten them once and pass the bands to assess_soil_health.
+def flatten_thresholds(thresholds):
+    return tuple(tuple(band) for band in flatten_sensor_data(thresholds))
+
+# Main function to assess soil health and provide recommendations.
+# `sensor_data` is the nested dict format, or a readings.Reading (or any six
+# values in sensor_columns order), which skips the walk over nested dicts.
+# `thresholds` is the nested dict, or its flatten_thresholds bands.
+# With structured=True the suggestions are recommendations.Recommendation
+# records instead of text; record.text renders the same sentence.
+def assess_soil_health(sensor_data, thresholds, soil_volume_m3=1.0, structured=False):
     scores = []
     suggestions = []
 
+    if not isinstance(sensor_data, dict) or isinstance(thresholds, tuple):
+        values = flatten_sensor_data(sensor_data) if isinstance(sensor_data, dict) else sensor_data
+        bands = thresholds if isinstance(thresholds, tuple) else flatten_thresholds(thresholds)
+        for (group, name), value, (ideal_min, ideal_max) in zip(sensor_columns, values, bands):
+            score, suggestion = recommend_variable(group, name, value, ideal_min, ideal_max, soil_volume_m3)
+            scores.append(score)
+            if suggestion:
+                suggestions.append(suggestion)
+        if not structured:
+            suggestions = [suggestion.text for suggestion in suggestions]
+        return sum(scores) / len(scores), suggestions
+
     for variable, value in sensor_data.items():
         if isinstance(value, dict):
             for subvar, subval in value.items():
                 ideal_min, ideal_max = thresholds[variable][subvar]
-                score = compute_score(subval, ideal_min, ideal_max)
+                score, suggestion = recommend_variable(variable, subvar, subval, ideal_min, ideal_max, soil_volume_m3)
                 scores.append(score)
-                if score < 1.0:
-                    if subval < ideal_min:
-                        amount_needed = calculate_nutrient_needed(subval, ideal_min, soil_mass_kg)
-                        suggestions.append(f"Add {amount_needed:.2f} grams of {subvar} fertilizer to reach the ideal level.")
-                    elif subval > ideal_max:
-                        suggestions.append(f"Decrease {subvar} level: current {subval}, ideal maximum {ideal_max}.")
+                if suggestion:
+                    suggestions.append(suggestion)
         else:
             ideal_min, ideal_max = thresholds[variable]
-            score = compute_score(value, ideal_min, ideal_max)
+            score, suggestion = recommend_variable(None, variable, value, ideal_min, ideal_max, soil_volume_m3)
             scores.append(score)
-            if score < 1.0:
-                if value < ideal_min and variable == 'Soil_Moisture':
-                    water_needed = calculate_water_needed(value, ideal_min, soil_volume_m3)
-                    suggestions.append(f"Add {water_needed:.2f} liters of water to increase soil moisture.")
-                elif value < ideal_min:
-                    suggestions.append(f"Increase {variable}: current {value}, ideal minimum {ideal_min}.")
-                elif value > ideal_max:
-                    suggestions.append(f"Decrease {variable}: current {value}, ideal maximum {ideal_max}.")
+            if suggestion:
+                suggestions.append(suggestion)
 
+    if not structured:
+        suggestions = [suggestion.text for suggestion in suggestions]
     total_score = sum(scores) / len(scores)
     return total_score, suggestions
 
@@ -1,28 +1,72 @@
+// Sentences for each kind of recommendation record, as recommendations.py
+// renders them
+const recommendationTemplates = {
+    fertilizer: r => `Add ${r.amount.toFixed(2)} grams of ${r.variable} fertilizer to reach the ideal level.`,
+    water: r => `Add ${r.amount.toFixed(2)} liters of water to increase soil moisture.`,
+    nutrient_high: r => `Decrease ${r.variable} level: current ${r.current}, ideal maximum ${r.limit}.`,
+    low: r => `Increase ${r.variable}: current ${r.current}, ideal minimum ${r.limit}.`,
+    high: r => `Decrease ${r.variable}: current ${r.current}, ideal maximum ${r.limit}.`
+};
+
+// Latest result received; drawn when the page is visible
+let latestSensorData = null;
+
+// Show one result ({score, recommendations}) on the page. While the tab is
+// hidden the result is only kept, and drawn when the tab is shown again.
+function showSensorData(data) {
+    latestSensorData = data;
+    if (!document.hidden) {
+        drawSensorData(data);
+    }
+}
+
+function drawSensorData(data) {
+    // Update the score
+    document.getElementById('score').textContent = data.score.toFixed(2);
+
+    // Clear the current suggestions
+    const suggestionsList = document.getElementById('suggestions');
+    suggestionsList.innerHTML = '';
+
+    // Display the recommendations as sentences
+    (data.recommendations || []).forEach(recommendation => {
+        const listItem = document.createElement('li');
+        listItem.textContent = recommendationTemplates[recommendation.kind](recommendation);
+        suggestionsList.appendChild(listItem);
+    });
+}
+
+document.addEventListener('visibilitychange', () => {
+    if (!document.hidden && latestSensorData) {
+        drawSensorData(latestSensorData);
+    }
+});
+
 function fetchSensorData() {
     fetch('/sensor-data')
         .then(response => response.json())
-        .then(data => {
-            // Update the score
-            document.getElementById('score').textContent = data.score.toFixed(2);
-            
-            // Clear the current suggestions
-            const suggestionsList = document.getElementById('suggestions');
-            suggestionsList.innerHTML = '';
-            
-            // Display recommendations from the Python output
-            data.suggestions.forEach(suggestion => {
-                const listItem = document.createElement('li');
-                listItem.textContent = suggestion;
-                suggestionsList.appendChild(listItem);
-            });
-        })
+        .then(showSensorData)
         .catch(error => {
             console.error('Error fetching sensor data:', error);
         });
 }
 
-// Fetch data every 5 minutes (300,000 ms)
-setInterval(fetchSensorData, 300000);
+// Receive changed results as soon as the server computes them. The browser
+// reconnects on its own after a dropped connection and resumes from the last
+// event it saw; 'resync' means we fell too far behind and should refetch.
+function subscribeSensorData() {
+    const events = new EventSource('/events');
+    events.addEventListener('score', event => showSensorData(JSON.parse(event.data)));
+    events.addEventListener('resync', fetchSensorData);
+}
 
-// Initial fetch on page load
-window.onload = fetchSensorData;
+// Initial fetch on page load, then live updates
+window.onload = () => {
+    fetchSensorData();
+    if (window.EventSource) {
+        subscribeSensorData();
+    } else {
+        // Fetch data every 5 minutes (300,000 ms)
+        setInterval(fetchSensorData, 300000);
+    }
+};
@@ -0,0 +1,27 @@
+import numpy as np
+
+from anomaly import AnomalyDetector, describe_flags, synthetic_streams
+from soil_health import unflatten_sensor_data
+
+
+def test_check_matches_check_batch():
+    values, faulty, node_ids, groups = synthetic_streams(40, 200)
+    batch = AnomalyDetector(groups=groups, neighbour_refresh=0.0)
+    single = AnomalyDetector(groups=groups, neighbour_refresh=0.0)
+    for step in range(len(values)):
+        for node_id, row in zip(node_ids, values[step].tolist()):
+            flags, _ = batch.check_batch([node_id], np.array([row]))
+            found, _ = single.check(node_id, unflatten_sensor_data([None if v != v else v for v in row]))
+            assert found == describe_flags(flags[0].tolist())
+    assert single.stats == batch.stats and single.stats['flagged']
+    for name in ('history', 'count', 'last', 'run', 'usual_run', 'spikes', 'latest'):
+        assert np.array_equal(getattr(single, name), getattr(batch, name), equal_nan=True)
+
+
+def test_quarantine_and_flag_modes():
+    sensor_data = {'NPK_levels': {'Nitrogen': 553.0, 'Phosphorus': 4.0, 'Potassium': 25.0},
+                   'Humidity': 60.0, 'Temperature': 35.0, 'Soil_Moisture': 10.0}
+    found, cleaned = AnomalyDetector().check('local', sensor_data)
+    assert found == {'Nitrogen': ['range']}
+    assert cleaned['NPK_levels']['Nitrogen'] is None and cleaned['Soil_Moisture'] == 10.0
+    assert AnomalyDetector(mode='flag').check('local', sensor_data) == (found, sensor_data)
@@ -0,0 +1,93 @@
+import pytest
+
+from esp32_collector import ESP32Collector
+from fake_esp32 import FakeESP32Server, FakeFleet, default_values
+from soil_health import format_esp32_readings
+
+expected = format_esp32_readings(default_values)
+
+
+@pytest.fixture
+def server():
+    server = FakeESP32Server(FakeFleet(etags=True, dead_latency=2.0))
+    server.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def fleet(server):
+    return server.fleet
+
+
+# Collectors are used as context managers, which closes them
+@pytest.fixture
+def collector_for(server):
+    def collector_for(node_ids, **options):
+        options = dict({'max_in_flight': 4, 'node_deadline': 0.3, 'connect_timeout': 0.3, 'hedge_after': None},
+                       **options)
+        return ESP32Collector({node_id: server.node_url(node_id) for node_id in node_ids}, **options)
+    return collector_for
+
+
+def test_collect_reads_every_node(collector_for):
+    with collector_for(['0', '1', '2']) as collector:
+        batch = collector.collect()
+    assert batch['errors'] == {} and batch['stale'] == {}
+    assert batch['readings'] == {node_id: expected for node_id in ('0', '1', '2')}
+    assert len(batch['packed']) == 3
+
+
+def test_unchanged_node_is_reported(fleet, collector_for):
+    with collector_for(['0', '1']) as collector:
+        collector.collect()
+        fleet.set_value('1', 'moisture', '12.5')
+        batch = collector.collect()
+    assert batch['unchanged'] == {'0'}
+    assert batch['readings']['0'] == expected
+    assert batch['readings']['1']['Soil_Moisture'] == 12.5
+
+
+def test_garbage_values_fall_back_to_last_good(fleet, collector_for):
+    with collector_for(['0']) as collector:
+        collector.collect()
+        fleet.garbage_nodes.add('0')
+        batch = collector.collect()
+    assert batch['raw']['0'] == {'temperature': None, 'humidity': None, 'moisture': None}
+    assert batch['readings']['0'] == expected
+    assert set(batch['stale']['0']) == {'temperature', 'humidity', 'moisture'}
+
+
+def test_stale_values_expire(fleet, collector_for):
+    with collector_for(['0'], max_stale=0.0) as collector:
+        collector.collect()
+        fleet.garbage_nodes.add('0')
+        batch = collector.collect()
+    assert batch['readings']['0'] == format_esp32_readings({'temperature': None, 'humidity': None, 'moisture': None})
+    assert batch['stale'] == {}
+
+
+def test_dead_node_is_skipped_once_its_breaker_opens(fleet, collector_for):
+    with collector_for(['0', '1'], breaker_threshold=2) as collector:
+        collector.collect()
+        fleet.dead_nodes.add('1')
+        for _ in range(2):
+            batch = collector.collect()
+            assert '1' in batch['errors'] and not batch['skipped']
+        batch = collector.collect()
+    assert set(batch['skipped']) == {'1'}
+    assert batch['errors']['1'].startswith('circuit open')
+    # Skipped nodes are not contacted but still report their last good values
+    assert batch['readings'] == {'0': expected, '1': expected}
+    assert set(batch['stale']) == {'1'}
+
+
+def test_cycle_is_bounded_by_the_node_deadline(fleet, collector_for):
+    fleet.dead_nodes.add('1')
+    with collector_for(['0', '1']) as collector:
+        batch = collector.collect()
+    assert batch['duration'] < 1.5
+    assert batch['readings']['0'] == expected
+    assert batch['readings']['1'] == format_esp32_readings({'temperature': None, 'humidity': None, 'moisture': None})
+    assert set(batch['errors']) == {'1'}
@@ -0,0 +1,99 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from resilient_fetch import CircuitBreaker, LastGoodValues, hedged_call
+
+
+@pytest.fixture
+def executor():
+    executor = ThreadPoolExecutor(max_workers=4)
+    yield executor
+    executor.shutdown(wait=False, cancel_futures=True)
+
+
+def test_breaker_opens_after_threshold_failures():
+    breaker = CircuitBreaker(failure_threshold=3, base_backoff=10.0, jitter=0.0)
+    breaker.record_failure(now=0.0)
+    breaker.record_failure(now=0.0)
+    assert breaker.allow(now=0.0)
+
+    breaker.record_failure(now=0.0)
+    assert not breaker.allow(now=5.0)
+    assert breaker.retry_in(now=5.0) == 5.0
+    assert breaker.allow(now=10.0)  # half open: one probe goes through
+
+
+def test_breaker_backoff_doubles_up_to_max():
+    breaker = CircuitBreaker(failure_threshold=1, base_backoff=10.0, max_backoff=25.0, jitter=0.0)
+    breaker.record_failure(now=0.0)
+    assert breaker.retry_at == 10.0
+    breaker.record_failure(now=10.0)
+    assert breaker.retry_at == 30.0
+    breaker.record_failure(now=30.0)
+    assert breaker.retry_at == 55.0
+
+
+def test_breaker_success_closes():
+    breaker = CircuitBreaker(failure_threshold=1, jitter=0.0)
+    breaker.record_failure()
+    assert breaker.state == 'open'
+    breaker.record_success()
+    assert breaker.state == 'closed'
+    assert breaker.allow() and breaker.retry_in() == 0.0
+    # Closed again, so it takes the full threshold to re-open
+    breaker = CircuitBreaker(failure_threshold=2, jitter=0.0)
+    breaker.record_failure()
+    breaker.record_success()
+    breaker.record_failure()
+    assert breaker.state == 'closed'
+
+
+def test_hedged_call_answers_without_hedge_when_fast(executor):
+    assert hedged_call(executor, lambda: 'fast', hedge_after=0.5, timeout=2.0) == ('fast', False)
+
+
+def test_hedged_call_takes_the_hedge_when_first_attempt_stalls(executor):
+    attempts = []
+    lock = threading.Lock()
+
+    def call():
+        with lock:
+            attempts.append(None)
+            attempt = len(attempts)
+        if attempt == 1:
+            time.sleep(1.0)
+        return attempt
+
+    started = time.monotonic()
+    result, hedged = hedged_call(executor, call, hedge_after=0.05, timeout=2.0)
+    assert (result, hedged) == (2, True)
+    assert time.monotonic() - started < 0.5
+
+
+def test_hedged_call_raises_when_every_attempt_fails(executor):
+    def call():
+        raise ConnectionError('refused')
+
+    with pytest.raises(ConnectionError):
+        hedged_call(executor, call, hedge_after=0.01, timeout=1.0)
+
+
+def test_hedged_call_times_out(executor):
+    with pytest.raises(TimeoutError):
+        hedged_call(executor, lambda: time.sleep(0.5), hedge_after=0.05, timeout=0.1)
+
+
+def test_last_good_values_fill_until_max_age():
+    last_good = LastGoodValues(max_age=60.0)
+    filled, stale = last_good.fill('a', {'moisture': 30.0, 'humidity': None}, now=0.0)
+    assert filled == {'moisture': 30.0, 'humidity': None} and stale == {}
+
+    filled, stale = last_good.fill('a', {'moisture': None, 'humidity': None}, now=45.0)
+    assert filled == {'moisture': 30.0, 'humidity': None}
+    assert stale == {'moisture': 45.0}
+
+    filled, stale = last_good.fill('a', {'moisture': None, 'humidity': None}, now=61.0)
+    assert filled == {'moisture': None, 'humidity': None} and stale == {}
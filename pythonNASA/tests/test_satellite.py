@@ -0,0 +1,90 @@
+import numpy as np
+import pytest
+
+from satellite import GridIndex, TiledGrid, _fill_axis, convert_granules, read_smap_granule
+
+
+def test_fill_axis_interpolates_missing_coordinates():
+    axis = _fill_axis([10.0, np.nan, np.nan, 40.0])
+    assert axis.tolist() == [10.0, 20.0, 30.0, 40.0]
+    with pytest.raises(ValueError):
+        _fill_axis([np.nan, np.nan])
+
+
+def test_grid_index_matches_brute_force():
+    lat_axis = np.linspace(85.0, -85.0, 40)  # north to south, as in SMAP
+    lon_axis = np.linspace(-180.0, 180.0, 96, endpoint=False) + 180.0 / 96
+    index = GridIndex(lat_axis, lon_axis)
+    rng = np.random.default_rng(0)
+    for lat, lon in zip(rng.uniform(-84, 84, 500).tolist(), rng.uniform(-180, 180, 500).tolist()):
+        distance = np.abs(lon_axis - lon)
+        assert index.nearest(lat, lon) == (int(np.argmin(np.abs(lat_axis - lat))),
+                                           int(np.argmin(np.minimum(distance, 360 - distance))))
+
+
+def test_grid_index_wraps_across_the_antimeridian():
+    lon_axis = np.arange(-179.5, 180.0, 1.0)
+    index = GridIndex([0.0], lon_axis)
+    assert index.nearest(0.0, 179.9) == (0, len(lon_axis) - 1)
+    assert index.nearest(0.0, -179.9) == (0, 0)
+    assert index.nearest(0.0, 180.1) == (0, 0)
+
+
+def test_tiled_grid_series_in_time_order(tmp_path):
+    lat_axis, lon_axis = np.array([10.0, 0.0, -10.0]), np.array([-5.0, 5.0])
+    grid = TiledGrid.create(str(tmp_path), 'imerg', lat_axis, lon_axis, tile=2, block_len=2)
+    for timestamp in (300.0, 100.0, 200.0):
+        values = np.full((3, 2), timestamp, dtype=np.float32)
+        values[2, 1] = np.nan
+        grid.append(timestamp, values)
+
+    reopened = TiledGrid(str(tmp_path))
+    times, values = reopened.cell_series(1, 0)
+    assert times.tolist() == [100.0, 200.0, 300.0]
+    assert values.tolist() == [100.0, 200.0, 300.0]
+    times, values = reopened.series(-9.0, 4.0, start=150.0)
+    assert times.tolist() == [200.0, 300.0] and np.isnan(values).all()
+
+
+def test_tiled_grid_rejects_a_grid_of_the_wrong_shape(tmp_path):
+    grid = TiledGrid.create(str(tmp_path), 'smap', [1.0, 0.0], [0.0, 1.0])
+    with pytest.raises(ValueError):
+        grid.append(0.0, np.zeros((3, 2)))
+
+
+def test_smap_granule_needs_a_date_in_its_name(tmp_path):
+    pytest.importorskip('h5py')
+    with pytest.raises(ValueError):
+        read_smap_granule(str(tmp_path / 'SMAP_L3_SM_P.h5'))
+
+
+def test_smap_granules_convert_to_their_cell_series(tmp_path):
+    pytest.importorskip('h5py')
+    from satellite import write_synthetic_smap
+
+    paths = [write_synthetic_smap(str(tmp_path), date, n_rows=8, n_cols=16, seed=seed)
+             for seed, date in enumerate(['20230102', '20230101'])]
+    decoded = sorted((read_smap_granule(path) for path in paths), key=lambda granule: granule[0])
+    timestamp, lat_axis, lon_axis, values = decoded[0]
+    assert not np.isnan(lat_axis).any() and not np.isnan(lon_axis).any()
+    assert np.isnan(values).any() and not (values == -9999.0).any()
+
+    grid = convert_granules(paths, str(tmp_path / 'smap'), 'smap', tile=4, block_len=4)
+    times, series = grid.cell_series(3, 5)
+    assert times.tolist() == [granule[0] for granule in decoded]
+    np.testing.assert_array_equal(series, [granule[3][3, 5] for granule in decoded])
+
+
+def test_granules_on_another_grid_are_rejected(tmp_path):
+    pytest.importorskip('h5py')
+    from satellite import granule_time, write_synthetic_imerg
+
+    paths = [write_synthetic_imerg(str(tmp_path), timestamp, n_lat=6, n_lon=12) for timestamp in (3600.0, 0.0)]
+    assert [granule_time(path, 'imerg') for path in paths] == [3600, 0]
+    grid = convert_granules(paths, str(tmp_path / 'imerg'), 'imerg', tile=4, block_len=4)
+    assert grid.sorted_times.tolist() == [0.0, 3600.0] and grid.times == [0.0, 3600.0]
+
+    coarser = write_synthetic_imerg(str(tmp_path), 7200.0, n_lat=3, n_lon=6)
+    with pytest.raises(ValueError):
+        convert_granules([coarser], str(tmp_path / 'imerg'), 'imerg')
+    assert TiledGrid(str(tmp_path / 'imerg')).times == [0.0, 3600.0]
@@ -0,0 +1,16 @@
+from recommendations import water
+from score_cache import ScoreCache
+
+
+def test_unchanged_result_keeps_its_body_and_timestamp():
+    cache = ScoreCache()
+    assert cache.update('a', 0.5, [water(3.14159, 20.0, 25)], timestamp=100.0)
+    body, bulk = cache.node_body('a'), cache.bulk_body()
+    assert b'"amount":3.14' in body.body and b'"suggestions"' not in body.body
+
+    assert not cache.update('a', 0.5, [water(3.14159, 20.0, 25)], timestamp=200.0)
+    assert cache.node_body('a') is body and cache.bulk_body() is bulk
+    assert cache.entries['a']['lastUpdated'] == '1970-01-01T00:01:40.000Z'
+
+    assert cache.update_many(['a', 'b'], [(0.5, []), (0.7, [])], [300.0, 300.0]) == 2
+    assert cache.node_body('a').etag != body.etag and cache.bulk_body() is not bulk
@@ -0,0 +1,30 @@
+import time
+
+import pytest
+
+from sensor_page import no_reading_page, parse_element_values, parse_sensor_values, synthetic_element_page, synthetic_page
+
+values = [553.0, 4.0, 25.0, 60.0, 35.0, 10.0]
+
+
+@pytest.mark.parametrize('malformed', [False, True])
+def test_synthetic_pages(malformed):
+    assert parse_sensor_values(synthetic_page(200, malformed)) == values
+
+
+def test_inline_tags_and_first_occurrence():
+    html = ('<p><b>Nitrogen</b> <i>=</i> <span>553</span></p><p>Soil  Moisture =\n1.5e1 </p>'
+            '<p>Nitrogen = 1</p><p>Humidity = 60 %</p>')
+    assert parse_sensor_values(html) == [553.0, None, None, None, None, 15.0]
+
+
+def test_large_page_without_readings_is_linear():
+    html = no_reading_page(4_000)  # 120 KB
+    start = time.perf_counter()
+    assert parse_sensor_values(html) == [None] * 6
+    assert parse_sensor_values('<p>' + '<' * 40_000) == [None] * 6
+    assert time.perf_counter() - start < 0.5
+
+
+def test_element_page():
+    assert parse_element_values(synthetic_element_page(50)) == values
@@ -0,0 +1,14 @@
+import numpy as np
+
+from threshold_model import ThresholdModel, default_bands, order_columns
+
+
+def test_dry_history_cannot_lower_order_minimums():
+    model = ThresholdModel(prior_weight=10)
+    centres = default_bands.mean(axis=1)
+    model.observe('dry', centres - 30 + np.random.default_rng(0).normal(0, 1, (1000, len(centres))))
+    bands = np.array(model.refit().bands('dry'))
+    assert (bands[order_columns, 0] == default_bands[order_columns, 0]).all()
+    assert (bands[:, 0] <= bands[:, 1]).all()
+    # Other bands still follow the node
+    assert (bands[~order_columns, 0] < default_bands[~order_columns, 0]).all()
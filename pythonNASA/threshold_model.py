@@ -0,0 +1,267 @@
+import argparse
+import threading
+import time
+
+import numpy as np
+
+from soil_health import compute_score, flatten_sensor_data, ideal_thresholds, sensor_columns, unflatten_sensor_data
+
+# Per-node (or per-zone) threshold bands fitted from history.
+#
+# ideal_thresholds is a sensible default for every field, but a probe in a
+# naturally cooler valley or on sandy soil sits outside it all the time. The
+# model keeps running statistics (count, mean, variance) per node and column,
+# folded in incrementally as readings arrive, and periodically compiles them
+# into a ThresholdTable:
+#
+#   centre     = the default band's centre, pulled towards the node's mean by
+#                n / (n + prior_weight) and never more than `max_shift` band
+#                half-widths away from the default
+#   half-width = the default half-width, blended the same way with
+#                `spread` standard deviations of the node, kept within
+#                [0.5, 2] x the default
+#
+# so a new node starts on ideal_thresholds and drifts only as evidence builds
+# up. A minimum below which scoring orders something (fertilizer for the NPK
+# nutrients, water for Soil_Moisture) never drops below the default's,
+# though: a node whose history is dry or whose probe reads low would
+# otherwise learn to stop asking for water or fertilizer, so refits can only
+# raise it. With a SMAP product and node locations, the satellite soil-moisture
+# climatology of each node's cell replaces the default moisture centre as the
+# prior. Scoring reads `model.table` once and never waits for a refit: a refit
+# builds a new table and swaps the reference in one assignment.
+
+n_columns = len(sensor_columns)
+default_bands = np.array(flatten_sensor_data(ideal_thresholds), dtype=np.float64)
+moisture_column = [name for group, name in sensor_columns].index('Soil_Moisture')
+# Columns whose minimum triggers an order (see soil_health.recommend_variable)
+order_columns = np.array([bool(group) or name == 'Soil_Moisture' for group, name in sensor_columns])
+
+
+# Compiled, immutable bands for every known node. Row 0 holds `defaults`
+# (ideal_thresholds unless given), used for nodes the model has not seen.
+class ThresholdTable:
+    def __init__(self, keys, bands, zones=None, version=0, defaults=default_bands):
+        self.rows = {key: i + 1 for i, key in enumerate(keys)}
+        self.array = np.concatenate((np.asarray(defaults, dtype=np.float64)[None], bands.reshape(-1, n_columns, 2)))
+        self.zones = zones or {}
+        self.version = version
+        # Tuples per row so scoring never touches NumPy scalars
+        self.band_rows = [tuple((lo, hi) for lo, hi in row) for row in self.array.tolist()]
+        self.threshold_rows = [None] * len(self.band_rows)
+
+    # Return the six (ideal_min, ideal_max) bands of a node in sensor_columns order
+    def bands(self, node_id):
+        return self.band_rows[self.rows.get(self.zones.get(node_id, node_id), 0)]
+
+    # Return the bands of a node in the nested ideal_thresholds format
+    def thresholds(self, node_id):
+        row = self.rows.get(self.zones.get(node_id, node_id), 0)
+        thresholds = self.threshold_rows[row]
+        if thresholds is None:
+            thresholds = self.threshold_rows[row] = unflatten_sensor_data(self.band_rows[row])
+        return thresholds
+
+    # Per-variable compute_score of a sensor_columns-ordered reading
+    def scores(self, node_id, values):
+        return [compute_score(value, lo, hi) for value, (lo, hi) in zip(values, self.bands(node_id))]
+
+
+class ThresholdModel:
+    # `zones` maps node id -> zone id so nodes of one field share a band;
+    # `smap` is a satellite.TiledGrid of SMAP soil moisture and `locations`
+    # maps node (or zone) id -> (lat, lon) for the satellite prior.
+    def __init__(self, base=ideal_thresholds, prior_weight=500, spread=2.0, max_shift=1.0,
+                 zones=None, smap=None, locations=None):
+        self.base = np.array(flatten_sensor_data(base), dtype=np.float64)
+        self.prior_weight = prior_weight
+        self.spread = spread
+        self.max_shift = max_shift
+        self.zones = dict(zones or {})
+        self.smap = smap
+        self.locations = dict(locations or {})
+
+        self.lock = threading.Lock()
+        self.keys = {}  # node or zone id -> accumulator row
+        self.count = np.zeros((0, n_columns))
+        self.mean = np.zeros((0, n_columns))
+        self.m2 = np.zeros((0, n_columns))
+        self.observed = 0
+        self.fitted = 0
+        self.consumed = {}  # node id -> newest store timestamp already observed
+        self.priors = {}    # key -> prior centre override per column (satellite context)
+
+        self.table = ThresholdTable([], np.zeros((0, n_columns, 2)), self.zones, defaults=self.base)
+        self.refit_thread = None
+        self.stop_event = threading.Event()
+        self.update_satellite_priors()
+
+    def _row(self, key):
+        row = self.keys.get(key)
+        if row is None:
+            row = self.keys[key] = len(self.keys)
+            if row >= len(self.count):
+                grow = max(16, len(self.count))
+                self.count = np.concatenate((self.count, np.zeros((grow, n_columns))))
+                self.mean = np.concatenate((self.mean, np.zeros((grow, n_columns))))
+                self.m2 = np.concatenate((self.m2, np.zeros((grow, n_columns))))
+        return row
+
+    # Fold readings of one node into its statistics. `values` is an (n, 6)
+    # array or a single reading (sensor_data dict or sequence); NaN is skipped.
+    # Batches are merged with Chan's parallel variance update.
+    def observe(self, node_id, values):
+        if isinstance(values, dict):
+            values = flatten_sensor_data(values)
+        values = np.array(values, dtype=np.float64).reshape(-1, n_columns)
+        present = ~np.isnan(values)
+        n = present.sum(axis=0).astype(np.float64)
+        if not n.any():
+            return
+        with np.errstate(invalid='ignore', divide='ignore'):
+            batch_mean = np.where(n > 0, np.nansum(values, axis=0) / n, 0.0)
+            batch_m2 = np.nansum((values - batch_mean) ** 2, axis=0)
+
+        with self.lock:
+            row = self._row(self.zones.get(node_id, node_id))
+            count, mean = self.count[row], self.mean[row]
+            total = count + n
+            with np.errstate(invalid='ignore', divide='ignore'):
+                delta = batch_mean - mean
+                self.mean[row] = np.where(n > 0, mean + delta * n / total, mean)
+                self.m2[row] += np.where(n > 0, batch_m2 + delta ** 2 * count * n / total, 0.0)
+            self.count[row] = total
+            self.observed += 1
+
+    # Observe everything a SensorStore holds that this model has not seen yet.
+    # Progress is tracked per node by timestamp, so readings written later
+    # with an older timestamp than the newest one observed are not picked up.
+    def observe_store(self, store, node_ids=None):
+        for node_id in node_ids if node_ids is not None else store.nodes():
+            for timestamps, values in store.iter_chunks(node_id, self.consumed.get(node_id)):
+                self.observe(node_id, values)
+                # The store keeps millisecond timestamps
+                self.consumed[node_id] = max(self.consumed.get(node_id, 0.0), float(timestamps[-1]) + 0.001)
+
+    # Look up the SMAP climatology of every located node or zone as a moisture prior
+    def update_satellite_priors(self):
+        if self.smap is None:
+            return
+        for key, (lat, lon) in self.locations.items():
+            times, values = self.smap.series(lat, lon)
+            values = values[~np.isnan(values)]
+            if len(values):
+                self.priors[key] = {moisture_column: float(values.mean()) * 100.0}  # m3/m3 -> %
+
+    # Compile the current statistics into a new table and swap it in
+    def refit(self):
+        with self.lock:
+            keys = list(self.keys)
+            count = self.count[:len(keys)].copy()
+            mean = self.mean[:len(keys)].copy()
+            m2 = self.m2[:len(keys)].copy()
+            observed = self.observed
+
+        base_lo, base_hi = self.base[:, 0], self.base[:, 1]
+        centre = np.tile((base_lo + base_hi) / 2, (len(keys), 1))
+        half = np.tile((base_hi - base_lo) / 2, (len(keys), 1))
+        for i, key in enumerate(keys):
+            for column, prior in self.priors.get(key, {}).items():
+                centre[i, column] = prior
+
+        weight = count / (count + self.prior_weight)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            std = np.sqrt(np.where(count > 1, m2 / np.maximum(count - 1, 1), 0.0))
+        fitted_centre = (1 - weight) * centre + weight * mean
+        fitted_half = (1 - weight) * half + weight * np.clip(self.spread * std, 0.5 * half, 2 * half)
+        base_centre = (base_lo + base_hi) / 2
+        base_half = (base_hi - base_lo) / 2
+        fitted_centre = np.clip(fitted_centre,
+                                base_centre - self.max_shift * base_half,
+                                base_centre + self.max_shift * base_half)
+
+        # Rounded so suggestions stay readable, e.g. "ideal minimum 27.5"
+        bands = np.round(np.stack((fitted_centre - fitted_half, fitted_centre + fitted_half), axis=-1), 1)
+        bands[:, order_columns, 0] = np.maximum(bands[:, order_columns, 0], base_lo[order_columns])
+        bands[:, order_columns, 1] = np.maximum(bands[:, order_columns, 1], bands[:, order_columns, 0])
+        self.table = ThresholdTable(keys, bands, self.zones, self.table.version + 1, self.base)
+        self.fitted = observed
+        return self.table
+
+    # Refit every `interval` seconds in a daemon thread, when there is new data
+    def start(self, interval=60.0, store=None):
+        def run():
+            while not self.stop_event.wait(interval):
+                if store is not None:
+                    self.observe_store(store)
+                if self.observed != self.fitted:
+                    self.refit()
+
+        self.stop_event.clear()
+        self.refit_thread = threading.Thread(target=run, daemon=True, name='threshold-refit')
+        self.refit_thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.refit_thread is not None:
+            self.refit_thread.join()
+
+
+def benchmark(n_nodes=1000, readings_per_node=2000):
+    rng = np.random.default_rng(0)
+    centres = (default_bands[:, 0] + default_bands[:, 1]) / 2
+    offsets = rng.normal(0, 3, size=(n_nodes, n_columns))
+    model = ThresholdModel()
+
+    start = time.perf_counter()
+    for node in range(n_nodes):
+        values = centres + offsets[node] + rng.normal(0, 2, size=(readings_per_node, n_columns))
+        model.observe(f"probe-{node}", values)
+    observe_seconds = time.perf_counter() - start
+    print(f"observed {n_nodes * readings_per_node} readings in {observe_seconds:.2f}s")
+
+    start = time.perf_counter()
+    table = model.refit()
+    print(f"refit {n_nodes} nodes in {(time.perf_counter() - start) * 1000:.1f} ms")
+    print(f"probe-0 bands: {table.bands('probe-0')}")
+    print(f"unknown node:  {table.bands('elsewhere')}")
+
+    values = flatten_sensor_data(unflatten_sensor_data(centres.tolist()))
+    node_ids = [f"probe-{node}" for node in range(n_nodes)]
+    start = time.perf_counter()
+    for node_id in node_ids:
+        model.table.bands(node_id)
+    lookup_us = (time.perf_counter() - start) / n_nodes * 1e6
+    start = time.perf_counter()
+    for node_id in node_ids:
+        model.table.scores(node_id, values)
+    score_us = (time.perf_counter() - start) / n_nodes * 1e6
+    print(f"band lookup {lookup_us:.2f} us, lookup + 6 compute_score {score_us:.2f} us per reading")
+
+    # Scoring keeps going while a background thread refits as fast as it can
+    model.start(interval=0.0)
+    latencies = []
+    deadline = time.perf_counter() + 1.0
+    versions = model.table.version
+    while time.perf_counter() < deadline:
+        start = time.perf_counter()
+        for node_id in node_ids[:100]:
+            model.table.scores(node_id, values)
+        latencies.append((time.perf_counter() - start) / 100)
+        model.observe(node_ids[len(latencies) % n_nodes], values)
+    model.stop()
+    latencies.sort()
+    print(f"during {model.table.version - versions} background refits: per-reading scoring "
+          f"p50 {latencies[len(latencies) // 2] * 1e6:.2f} us, p99 {latencies[int(len(latencies) * 0.99)] * 1e6:.2f} us")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark fitting and serving per-node threshold bands.')
+    parser.add_argument('--nodes', type=int, default=1000)
+    parser.add_argument('--readings', type=int, default=2000, help='history readings per node')
+    args = parser.parse_args()
+    benchmark(args.nodes, args.readings)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,267 @@
+import argparse
+import struct
+import time
+from collections import namedtuple
+
+import numpy as np
+
+from readings import ReadingBatch
+from soil_health import esp32_sensors, flatten_sensor_data, format_esp32_readings, parse_esp32_value
+
+# Compact binary readings, as served by GET /readings on the ground sensor
+# firmware (GroundSensorCode_v3) and accepted by ingest_server.py.
+#
+# A packet is one node's buffered samples: a 16-byte header followed by
+# `count` fixed-width records, all little-endian.
+#
+#   header  magic 'AQ', version (u8), flags (u8), node id (u32),
+#           clock (u32: the node's clock when it built the packet),
+#           count (u16), record size (u16)
+#   record  sequence number (u32), time (u32, same clock as the header),
+#           temperature (i16, 0.01 degC), humidity (u16, 0.01 %),
+#           moisture (u16, 0.01 %)
+#
+# Sensors that could not be read are sent as the field's most negative
+# (i16) or largest (u16) value and decode to None / NaN. The record size is
+# in the header so a later version can append fields: decoders read the
+# fields they know and skip the rest. Several packets (e.g. from a gateway
+# that collects a whole field) can be sent back to back in one body.
+#
+# Times are Unix seconds once the node has synced over NTP. Until then the
+# CLOCK_UPTIME flag is set and times are seconds since boot; decoding maps
+# them to wall-clock time through the header's clock and the time the
+# packet was received.
+#
+# Decoding never copies the body: packets are walked with struct over a
+# memoryview, iter_samples unpacks records in place, and decode_batch reads
+# a lone packet's records with numpy.frombuffer on that memoryview (a body
+# of several packets costs one gather of the record bytes).
+
+magic = b'AQ'
+version = 1
+media_type = 'application/x-aquiferst-readings'
+CLOCK_UPTIME = 1
+
+header = struct.Struct('<2sBBIIHH')
+record = struct.Struct('<IIhHH')
+missing_i16 = -0x8000
+missing_u16 = 0xFFFF
+scale = 100.0
+max_count = 0xFFFF
+
+PacketHeader = namedtuple('PacketHeader', ['version', 'flags', 'node', 'clock', 'count', 'record_size'])
+
+# Record fields by name, for numpy.frombuffer; `itemsize` skips any fields a
+# newer version appends
+record_fields = {'names': ['seq', 'time', 'temperature', 'humidity', 'moisture'],
+                 'formats': ['<u4', '<u4', '<i2', '<u2', '<u2'],
+                 'offsets': [0, 4, 8, 10, 12]}
+
+# Row an ESP32 reading starts from in sensor_columns order (NPK placeholders)
+esp32_row = flatten_sensor_data(format_esp32_readings({sensor: None for sensor in esp32_sensors}))
+esp32_columns = {'humidity': 3, 'temperature': 4, 'moisture': 5}
+
+
+class WireFormatError(ValueError):
+    pass
+
+
+# Function to name a node by its numeric wire id, e.g. 'esp32-1a2b3c4d'
+def node_name(node):
+    return f"esp32-{node:08x}"
+
+
+# Function to turn a sensor value into its fixed-point field
+def _fixed(value, missing, low, high):
+    if value is None or value != value:
+        return missing
+    return min(max(round(value * scale), low), high)
+
+
+# Function to build one packet for `node` (u32) from samples of
+# (seq, time, temperature, humidity, moisture); None marks an unread sensor.
+# `clock` defaults to now, and `uptime` marks times as seconds since boot.
+def encode_packet(node, samples, clock=None, uptime=False):
+    samples = list(samples)
+    if len(samples) > max_count:
+        raise WireFormatError(f"at most {max_count} samples fit in one packet, got {len(samples)}")
+    clock = int(time.time()) if clock is None else int(clock)
+    body = bytearray(header.size + record.size * len(samples))
+    header.pack_into(body, 0, magic, version, CLOCK_UPTIME if uptime else 0, node, clock,
+                     len(samples), record.size)
+    offset = header.size
+    for seq, timestamp, temperature, humidity, moisture in samples:
+        record.pack_into(body, offset, seq, int(timestamp),
+                         _fixed(temperature, missing_i16, -0x7FFF, 0x7FFF),
+                         _fixed(humidity, missing_u16, 0, 0xFFFE),
+                         _fixed(moisture, missing_u16, 0, 0xFFFE))
+        offset += record.size
+    return bytes(body)
+
+
+# Function to walk the packets in `body` without copying it. Yields
+# (PacketHeader, memoryview of its records); raises WireFormatError on a
+# truncated or foreign packet.
+def iter_packets(body):
+    view = memoryview(body).cast('B')
+    for packet, start in _packet_offsets(view):
+        yield packet, view[start:start + packet.count * packet.record_size]
+
+
+def _packet_offsets(view):
+    offset = 0
+    while offset < len(view):
+        if len(view) - offset < header.size:
+            raise WireFormatError(f"truncated header at byte {offset}")
+        found, packet_version, flags, node, clock, count, record_size = header.unpack_from(view, offset)
+        if found != magic:
+            raise WireFormatError(f"not a readings packet at byte {offset}")
+        if packet_version < version or record_size < record.size:
+            raise WireFormatError(f"unsupported packet version {packet_version} with {record_size}-byte records")
+        start = offset + header.size
+        offset = start + count * record_size
+        if offset > len(view):
+            raise WireFormatError(f"packet from {node_name(node)} is truncated")
+        yield PacketHeader(packet_version, flags, node, clock, count, record_size), start
+
+
+# Function to map a packet's record times to Unix seconds
+def _wall_time(packet, timestamp, received):
+    if packet.flags & CLOCK_UPTIME:
+        return received - (packet.clock - timestamp)
+    return float(timestamp)
+
+
+# Function to decode `body` sample by sample. Yields (node id, seq,
+# timestamp, raw) with raw the {sensor: float or None} of
+# ESP32Collector's batches.
+def iter_samples(body, received=None):
+    received = time.time() if received is None else received
+    for packet, records in iter_packets(body):
+        name = node_name(packet.node)
+        if packet.record_size == record.size:
+            fields = record.iter_unpack(records)
+        else:
+            fields = (record.unpack_from(records, i * packet.record_size) for i in range(packet.count))
+        for seq, timestamp, temperature, humidity, moisture in fields:
+            yield name, seq, _wall_time(packet, timestamp, received), {
+                'temperature': None if temperature == missing_i16 else temperature / scale,
+                'humidity': None if humidity == missing_u16 else humidity / scale,
+                'moisture': None if moisture == missing_u16 else moisture / scale,
+            }
+
+
+# Function to decode every sample in `body` into one ReadingBatch, plus the
+# (n,) array of sequence numbers. A lone packet is read in place; the records
+# of several packets are gathered into one array in a single step.
+def decode_batch(body, received=None):
+    received = time.time() if received is None else received
+    view = memoryview(body).cast('B')
+    packets = [(packet, start) for packet, start in _packet_offsets(view) if packet.count]
+    counts = np.array([packet.count for packet, start in packets], dtype=np.intp)
+    total = int(counts.sum())
+    if len(packets) == 1:
+        packet, start = packets[0]
+        fields = np.frombuffer(view, dtype=np.dtype(dict(record_fields, itemsize=packet.record_size)),
+                               count=packet.count, offset=start)
+    else:
+        # Byte offset of every record, then its first record.size bytes
+        first = np.repeat(np.cumsum(counts) - counts, counts)
+        sizes = np.repeat(np.array([packet.record_size for packet, start in packets], dtype=np.intp), counts)
+        offsets = np.repeat(np.array([start for packet, start in packets], dtype=np.intp), counts)
+        offsets += (np.arange(total) - first) * sizes
+        raw = np.frombuffer(view, dtype=np.uint8)[offsets[:, None] + np.arange(record.size)]
+        fields = raw.view(np.dtype(dict(record_fields, itemsize=record.size))).reshape(total)
+
+    values = np.empty((total, len(esp32_row)), dtype=np.float64)
+    values[:] = esp32_row
+    for sensor, column in esp32_columns.items():
+        raw = fields[sensor]
+        values[:, column] = raw / scale
+        values[raw == (missing_i16 if raw.dtype.kind == 'i' else missing_u16), column] = np.nan
+    shift = [received - packet.clock if packet.flags & CLOCK_UPTIME else 0.0 for packet, start in packets]
+    timestamps = fields['time'] + np.repeat(np.array(shift, dtype=np.float64), counts)
+    node_ids = np.repeat(np.array([node_name(packet.node) for packet, start in packets], dtype=object),
+                         counts).tolist()
+    return ReadingBatch.from_arrays(node_ids, timestamps, values), fields['seq'].copy()
+
+
+# Function to make `n_nodes` packets of `per_packet` samples each, concatenated
+def synthetic_body(n_nodes, per_packet, start=1_700_000_000):
+    packets = []
+    for node in range(n_nodes):
+        samples = [(seq, start + 10 * seq, 21.5 + seq % 7 * 0.1, 60.0, 25.0 + (node + seq) % 10)
+                   for seq in range(per_packet)]
+        packets.append(encode_packet(0x10000 + node, samples, clock=start + 10 * per_packet))
+    return b''.join(packets)
+
+
+# Compare decoding the binary format against the current text paths: three
+# text/plain endpoint responses per reading (ESP32Collector) and pushed
+# NDJSON lines (ingest_server.py)
+def benchmark(n_nodes=1000, per_packet=10, repeat=5):
+    from ingest_server import parse_push_line
+
+    n = n_nodes * per_packet
+    body = synthetic_body(n_nodes, per_packet)
+    texts = [(f"{21.5 + i % 7 * 0.1:.2f}", '60.00', f"{25 + i % 10}") for i in range(n)]
+    lines = [f'{{"node": "esp32-{i % n_nodes:08x}", "t": {1_700_000_000 + i}, "temperature": {t}, '
+             f'"humidity": {h}, "moisture": {m}}}'.encode('utf-8') for i, (t, h, m) in enumerate(texts)]
+    # What the probe sends per reading today: three responses with headers
+    text_bytes = sum(len(f"HTTP/1.1 200 OK\r\nContent-Length: {len(v)}\r\nContent-Type: text/plain\r\n"
+                         f"Connection: keep-alive\r\n\r\n{v}") for reading in texts for v in reading)
+
+    def text_path():
+        for i, reading in enumerate(texts):
+            raw = {sensor: parse_esp32_value(sensor, value) for sensor, value in zip(esp32_sensors, reading)}
+            flatten_sensor_data(format_esp32_readings(raw))
+
+    def json_path():
+        received = time.time()
+        for line in lines:
+            parse_push_line(line, received)
+
+    def struct_path():
+        for sample in iter_samples(body):
+            flatten_sensor_data(format_esp32_readings(sample[3]))
+
+    def numpy_path():
+        decode_batch(body)
+
+    print(f"{n:,} readings from {n_nodes:,} nodes, {per_packet} per packet")
+    print(f"bytes per reading: text endpoints {text_bytes / n:.0f} (3 requests), "
+          f"NDJSON {sum(len(line) + 1 for line in lines) / n:.0f}, binary {len(body) / n:.1f} (1 request per packet)")
+    timings = {}
+    for label, fn in (('text endpoints', text_path), ('NDJSON lines', json_path),
+                      ('binary, struct', struct_path), ('binary, numpy', numpy_path)):
+        fn()
+        best = float('inf')
+        for _ in range(repeat):
+            began = time.perf_counter()
+            fn()
+            best = min(best, time.perf_counter() - began)
+        timings[label] = best
+        print(f"{label:>15}: {best / n * 1e6:6.2f} us/reading ({n / best:,.0f} readings/s)")
+    baseline = timings['text endpoints']
+    print(f"binary numpy decode is {baseline / timings['binary, numpy']:.0f}x the text path, "
+          f"struct {baseline / timings['binary, struct']:.1f}x")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Decode binary readings packets, or benchmark the decoder.')
+    parser.add_argument('path', nargs='?', help='file holding one or more packets (e.g. a saved /readings body)')
+    parser.add_argument('--nodes', type=int, default=1000)
+    parser.add_argument('--per-packet', type=int, default=10)
+    args = parser.parse_args()
+
+    if args.path is None:
+        benchmark(args.nodes, args.per_packet)
+        return
+    with open(args.path, 'rb') as f:
+        body = f.read()
+    for node_id, seq, timestamp, raw in iter_samples(body):
+        print(f"{node_id} #{seq} {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(timestamp))} {raw}")
+
+
+if __name__ == "__main__":
+    main()